@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src'))
+
+from predictions import filter_outliers, get_area
+from synthetic import get_predictions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = 'Scaling of the per well area outlier filter with the number of frames')
+    parser.add_argument(
+        '--frames',
+        default = [100, 500, 1000, 5000, 10000],
+        type = int,
+        nargs = '+',
+        help = 'Frame counts to benchmark'
+        )
+    parser.add_argument(
+        '--wells',
+        default = 384,
+        type = int,
+        help = 'Number of wells in each frame'
+        )
+    parser.add_argument(
+        '--mad_bounds',
+        default = [3.0, 3.0],
+        type = float,
+        nargs = 2,
+        help = 'Lower and upper number of MADs'
+        )
+    parser.add_argument(
+        '--max_reference_frames',
+        default = 1000,
+        type = int,
+        help = 'Largest frame count the row-wise reference is timed on'
+        )
+
+    return parser.parse_args()
+
+def reference_filter(predictions, mad_bounds):
+    '''
+        Row-wise area and per well MultiIndex slicing, as predict.predict used to do
+    '''
+    def area(x, y):
+        return np.abs(0.5*( (x[0]*(y[1]-y[2])) + (x[1]*(y[2]-y[0])) + (x[2]*(y[0]-y[1])) ))
+
+    predictions['area'] = predictions.apply(lambda row: area([row['left_eye_x'], row['right_eye_x'], row['yolk_x']],
+                                                             [row['left_eye_y'], row['right_eye_y'], row['yolk_y']]),
+                                            axis = 1)
+
+    for idx, idy in predictions.loc[1, :, :].index.tolist():
+        well = predictions.loc[:, idx, idy]
+        median = well['area'].median()
+        mad = stats.median_abs_deviation(well['area'].tolist())
+        cond = (well['area'] < median - mad_bounds[0] * mad) | (well['area'] > median + mad_bounds[1] * mad)
+        cond = np.tile(cond, [well.shape[1], 1]).transpose()
+
+        predictions.loc[:, idx, idy] = well.mask(cond).values
+
+    return predictions
+
+def vectorized_filter(predictions, mad_bounds):
+
+    predictions['area'] = get_area(predictions)
+    return filter_outliers(predictions, mad_bounds)
+
+def time_filter(function, predictions, mad_bounds):
+
+    predictions = predictions.copy()
+    start = time.perf_counter()
+    predictions = function(predictions, mad_bounds)
+
+    return time.perf_counter() - start, predictions
+
+
+if __name__ == '__main__':
+
+    args = parse_arguments()
+
+    print("{:>8} {:>12} {:>14} {:>14} {:>9}".format('frames', 'rows', 'reference (s)', 'vectorized (s)', 'speed-up'))
+
+    for frames in args.frames:
+        predictions = get_predictions(frames, args.wells)
+
+        vectorized, filtered = time_filter(vectorized_filter, predictions, args.mad_bounds)
+
+        if frames <= args.max_reference_frames:
+            reference, expected = time_filter(reference_filter, predictions, args.mad_bounds)
+            pd.testing.assert_frame_equal(filtered, expected)
+            print("{:>8} {:>12} {:>14.3f} {:>14.3f} {:>8.1f}x".format(frames, len(predictions), reference,
+                                                                      vectorized, reference / vectorized), flush = True)
+        else:
+            print("{:>8} {:>12} {:>14} {:>14.3f} {:>9}".format(frames, len(predictions), '-', vectorized, '-'), flush = True)
@@ -0,0 +1,224 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import argparse
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src'))
+
+from data_analysis import analyze_df, analyze_df_vectorized
+from read_data import Data
+from synthetic import get_predictions, get_wells, write_plate_sequence, write_stub_model
+from video_analysis import analysis
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = 'Time the stages of the analysis on synthetic plates of several sizes')
+    parser.add_argument(
+        '--wells',
+        default = [24, 96, 384],
+        type = int,
+        nargs = '+',
+        help = 'Number of wells of each plate benchmarked'
+        )
+    parser.add_argument(
+        '--pitch',
+        default = 180,
+        type = int,
+        help = 'Distance between neighbouring wells in pixels, which sets the resolution (at least 150)'
+        )
+    parser.add_argument(
+        '--frames',
+        default = 20,
+        type = int,
+        help = 'Number of images in each sequence'
+        )
+    parser.add_argument(
+        '--batch_size',
+        default = 4,
+        type = int,
+        help = 'Number of frames fed to the stub model at once'
+        )
+    parser.add_argument(
+        '--decode_workers',
+        default = 1,
+        type = int,
+        help = 'Number of threads decoding images'
+        )
+    parser.add_argument(
+        '--export_workers',
+        default = 1,
+        type = int,
+        help = 'Number of threads encoding the videos of crop_to_video'
+        )
+    parser.add_argument(
+        '--analysis_frames',
+        default = 1000,
+        type = int,
+        help = 'Number of frames of the synthetic predictions the behaviours are computed on'
+        )
+    parser.add_argument(
+        '--max_reference_rows',
+        default = 20000,
+        type = int,
+        help = 'Largest number of predictions the row-wise analyze_df is timed on'
+        )
+    parser.add_argument(
+        '--repeats',
+        default = 3,
+        type = int,
+        help = 'Each stage is run this many times and the fastest run is kept'
+        )
+    parser.add_argument(
+        '--output',
+        default = None,
+        type = str,
+        help = 'JSON file the timings are written to'
+        )
+    parser.add_argument(
+        '--compare',
+        default = None,
+        type = str,
+        help = 'JSON file written by an earlier run (eg. on another commit) to compare against'
+        )
+
+    return parser.parse_args()
+
+def get_commit():
+    '''
+        Commit the benchmark runs on, None outside of a git checkout
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__)), check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def time_stage(function, repeats):
+    '''
+        Fastest of several runs in seconds, the slower ones are disturbed by the rest of the machine
+    '''
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+
+    return min(seconds)
+
+def benchmark_plate(folder, wells, args):
+    '''
+        Time reading, well detection, cropping, video export and prediction on a synthetic plate
+
+        output:
+            timings: dictionary of stage name to (seconds, frames)
+    '''
+    filename, radius = write_plate_sequence(folder, frames = args.frames, wells = wells, pitch = args.pitch)
+    R = [int(radius * 0.85), int(np.ceil(radius * 1.15))]
+
+    data = Data(filename, workers = args.decode_workers)
+    experiment = analysis(data)
+
+    def read():
+        data.reset()
+        for _ in range(args.frames):
+            data.read()
+
+    timings = {'read': (time_stage(read, args.repeats), args.frames)}
+
+    # the wells are detected on the first image
+    data.reset()
+    timings['detect_wells'] = (time_stage(lambda: experiment.detect_wells(R = R), args.repeats), 1)
+    detected = experiment.detect_wells(R = R)
+    if len(detected) != wells:
+        print("Detected {} wells instead of {}".format(len(detected), wells), flush = True)
+
+    data.reset()
+    images = [data.read()[1] for _ in range(args.frames)]
+    out = experiment.get_crop_buffer(detected)
+
+    def crop():
+        for image in images:
+            experiment.crop_wells(detected, image, out = out)
+
+    timings['crop_wells'] = (time_stage(crop, args.repeats), args.frames)
+
+    timings['crop_to_video'] = (time_stage(lambda: experiment.crop_to_video(detected, crop_dir = os.path.join(folder, 'videos'),
+                                                                            no_wells_to_record = None,
+                                                                            workers = args.export_workers),
+                                           args.repeats), args.frames)
+
+    try:
+        from predictions import predict
+        model_path = write_stub_model(os.path.join(folder, 'stub.pb'))
+    except ImportError:
+        print("tensorflow is not installed, predict is not timed", flush = True)
+    else:
+        with predict(data, experiment, model_path) as infer:
+            # the first run loads the model
+            infer.predict(wells = detected, batch_size = args.batch_size)
+            timings['predict'] = (time_stage(lambda: infer.predict(wells = detected, batch_size = args.batch_size),
+                                             args.repeats), args.frames)
+
+    data.close()
+
+    return timings
+
+def benchmark_analysis(wells, args):
+    '''
+        Time the behaviours computed from synthetic predictions
+
+        output:
+            timings: dictionary of stage name to (seconds, frames)
+    '''
+    predictions = get_predictions(args.analysis_frames, wells)
+    layout = get_wells(wells)
+
+    timings = {'analyze_df_vectorized': (time_stage(lambda: analyze_df_vectorized(predictions, layout, starting_image = 0),
+                                                    args.repeats), args.analysis_frames)}
+
+    # the row-wise analysis takes minutes on real experiments, it is only timed on small ones
+    frames = max(1, min(args.analysis_frames, args.max_reference_rows // wells))
+    predictions = get_predictions(frames, wells)
+    timings['analyze_df'] = (time_stage(lambda: analyze_df(predictions.copy(), layout, starting_image = 0), 1), frames)
+
+    return timings
+
+
+if __name__ == '__main__':
+
+    args = parse_arguments()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    results = {}
+    print("{:>6} {:>22} {:>8} {:>12} {:>14} {:>10}".format('wells', 'stage', 'frames', 'seconds', 'frames/s', 'vs ' + (
+                os.path.basename(args.compare) if args.compare else '-')))
+
+    for wells in args.wells:
+        with tempfile.TemporaryDirectory() as folder:
+            timings = benchmark_plate(folder, wells, args)
+        timings.update(benchmark_analysis(wells, args))
+
+        results[str(wells)] = {}
+        for stage, (seconds, frames) in timings.items():
+            results[str(wells)][stage] = {'seconds': seconds, 'frames': frames, 'frames_per_second': frames / seconds}
+
+            reference = previous.get(str(wells), {}).get(stage)
+            # above 1 the current tree is faster
+            ratio = '{:.2f}x'.format(frames / seconds / reference['frames_per_second']) if reference else '-'
+            print("{:>6} {:>22} {:>8} {:>12.4f} {:>14.2f} {:>10}".format(wells, stage, frames, seconds,
+                                                                          frames / seconds, ratio), flush = True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': get_commit(), 'arguments': vars(args), 'results': results}, f, indent = 2)
+        print("Timings written to " + args.output, flush = True)
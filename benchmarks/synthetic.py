@@ -0,0 +1,151 @@
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from predictions import PREDICTION_COLUMNS
+
+# Synthetic multi well plates and predictions, so that benchmarks (and tests) need no experiment data
+
+# rows and columns of the standard plate formats
+PLATES = {6: (2, 3), 24: (4, 6), 48: (6, 8), 96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+
+def get_plate_shape(wells):
+    '''
+        Rows and columns of a plate, standard formats or the closest 2:3 grid
+    '''
+    if wells in PLATES:
+        return PLATES[wells]
+
+    rows = max(1, int(round(np.sqrt(wells / 1.5))))
+
+    return rows, int(np.ceil(wells / rows))
+
+def get_plate(wells = 96, pitch = 180, margin = 100, fish = 1, seed = 0):
+    '''
+        Synthetic image of a multi well plate, with dark spots standing for the larvae
+
+        input:
+            wells: number of wells, laid out like a standard plate (see PLATES)
+            pitch: distance between the centers of neighbouring wells in pixels,
+                   which sets the resolution. Well detection needs at least 150
+            margin: distance between the border of the image and the first wells
+            fish: number of spots drawn in each well
+            seed: seed of the spot positions
+
+        output:
+            image: BGR image of the plate
+            radius: radius of the wells in pixels
+    '''
+    rng = np.random.default_rng(seed)
+    rows, columns = get_plate_shape(wells)
+    radius = int(round(pitch * 7 / 18))
+
+    image = np.full((2*margin + pitch*(rows - 1), 2*margin + pitch*(columns - 1), 3), 30, dtype = np.uint8)
+    for well in range(wells):
+        center = (margin + pitch*(well % columns), margin + pitch*(well // columns))
+        cv2.circle(image, center, radius, (200, 200, 200), 4, cv2.LINE_AA)
+        for _ in range(fish):
+            offset = rng.uniform(-0.6, 0.6, 2) * radius
+            cv2.circle(image, (int(center[0] + offset[0]), int(center[1] + offset[1])), max(2, radius // 12),
+                       (int(rng.integers(0, 100)),)*3, -1)
+
+    return image, radius
+
+def write_plate_sequence(folder, frames = 10, wells = 96, pitch = 180, seed = 0):
+    '''
+        Write an image sequence of a plate whose larvae move between frames
+
+        output:
+            filename: pattern of the image sequence, to be read with read_data.Data
+            radius: radius of the wells in pixels
+    '''
+    os.makedirs(folder, exist_ok = True)
+
+    for i in range(1, frames + 1):
+        image, radius = get_plate(wells = wells, pitch = pitch, seed = seed + i)
+        cv2.imwrite(os.path.join(folder, 'IMG_{:04d}.JPG'.format(i)), image)
+
+    return os.path.join(folder, 'IMG_%04d.JPG'), radius
+
+def get_circles(wells = 96, pitch = 180, margin = 100, angle = 0.0, jitter = 0.5, missing = 0, seed = 0):
+    '''
+        Circles (center_x, center_y, radius) of a plate as detected by HoughCircles,
+        in random order, to benchmark the labelling of wells without decoding images
+
+        input:
+            angle: rotation of the plate in degrees
+            jitter: standard deviation of the error on the centers in pixels
+            missing: number of wells the detection missed
+    '''
+    rng = np.random.default_rng(seed)
+    rows, columns = get_plate_shape(wells)
+    radius = pitch * 7 / 18
+    theta = np.deg2rad(angle)
+
+    column, row = np.arange(wells) % columns, np.arange(wells) // columns
+    x = margin + pitch * (column * np.cos(theta) - row * np.sin(theta)) + rng.normal(0, jitter, wells)
+    y = margin + pitch * (column * np.sin(theta) + row * np.cos(theta)) + rng.normal(0, jitter, wells)
+    circles = np.column_stack([x, y, radius + rng.normal(0, jitter, wells)])
+
+    return rng.permutation(np.delete(circles, rng.choice(wells, missing, replace = False), axis = 0)).astype(np.float32)
+
+def get_well_index(wells):
+    '''
+        (X-coord, Y-coord) labels of the wells of a plate
+    '''
+    rows, columns = get_plate_shape(wells)
+
+    return [(float(i % columns), float(i // columns)) for i in range(wells)]
+
+def get_predictions(frames, wells, seed = 0, first_frame = 1, missing = 0, dtype = np.float32):
+    '''
+        Synthetic predictions laid out like the output of predict.predict
+
+        input:
+            frames: number of frames
+            wells: number of wells, laid out like get_well_index
+            first_frame: number of the first frame
+            missing: number of predictions set to NaN, as if the model missed the larva
+            dtype: dtype of the predictions
+    '''
+    rng = np.random.default_rng(seed)
+
+    index = pd.MultiIndex.from_tuples([(frame, x, y) for frame in range(first_frame, first_frame + frames)
+                                       for x, y in get_well_index(wells)],
+                                      names = ['frame', 'X-coord', 'Y-coord'])
+    predictions = pd.DataFrame(rng.uniform(0, 152, size = (len(index), 9)).astype(dtype),
+                               columns = PREDICTION_COLUMNS, index = index)
+    if missing:
+        predictions.iloc[rng.integers(0, len(index), missing)] = np.nan
+
+    return predictions
+
+def get_wells(wells, radius = 76.0):
+    '''
+        Synthetic well layout matching get_predictions
+    '''
+    return pd.DataFrame({'center_x': 0.0, 'center_y': 0.0, 'radius': radius},
+                        index = pd.MultiIndex.from_tuples(get_well_index(wells), names = ['well_id_x', 'well_id_y']))
+
+def write_stub_model(filename):
+    '''
+        Frozen graph with the input/output names of an exported DLC model, predicting
+        3 body parts from simple statistics of each crop. It costs about as little
+        as a model can, so that predict.predict is timed without the network itself
+    '''
+    import tensorflow.compat.v1 as tf
+
+    graph = tf.Graph()
+    with graph.as_default():
+        crops = tf.placeholder(tf.float32, [None, None, None, 3], name = 'Placeholder')
+        mean = tf.reduce_mean(crops, axis = [1, 2])
+        pose = tf.reshape(tf.concat([mean, tf.reduce_max(crops, axis = [1, 2]), mean + 1.0], axis = 1), [-1, 3])
+        tf.concat([pose, pose[:0]], axis = 0, name = 'concat_1')
+
+    with open(filename, 'wb') as f:
+        f.write(graph.as_graph_def().SerializeToString())
+
+    return filename
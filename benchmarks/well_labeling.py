@@ -0,0 +1,140 @@
+import os
+import sys
+import tempfile
+import time
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src'))
+
+from read_data import Data
+from synthetic import get_circles, write_plate_sequence
+from video_analysis import analysis, label_wells
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = 'Labelling of detected wells on plates of increasing density')
+    parser.add_argument(
+        '--wells',
+        default = [24, 96, 384, 1536],
+        type = int,
+        nargs = '+',
+        help = 'Number of wells of each plate benchmarked'
+        )
+    parser.add_argument(
+        '--pitch',
+        default = 180,
+        type = int,
+        help = 'Distance between neighbouring wells in pixels'
+        )
+    parser.add_argument(
+        '--angle',
+        default = 0.0,
+        type = float,
+        help = 'Rotation of the plate in degrees'
+        )
+    parser.add_argument(
+        '--repeats',
+        default = 5,
+        type = int,
+        help = 'Each labelling is run this many times and the fastest run is kept'
+        )
+    parser.add_argument(
+        '--detect',
+        action = 'store_true',
+        help = 'Also time detect_wells on a synthetic image of each plate'
+        )
+
+    return parser.parse_args()
+
+def reference_label_wells(circles):
+    '''
+        Reference rows and columns with boolean masks over all the wells, relabelled
+        with DataFrame.replace, as analysis.detect_wells used to do
+    '''
+    wells = np.asarray(sorted(circles, key = lambda x: (x[0], x[1])))
+    wells = np.append(np.zeros([len(wells), 2]), wells, axis = 1)
+
+    x_ref = wells[0, 2]; y_ref= wells[0, 3]; r_ref = wells[0, 4]
+    x_ind = np.nonzero((wells[:, 2] > x_ref - r_ref) & (wells[:, 2] < x_ref + r_ref))[0]
+    y_ind = np.nonzero((wells[:, 3] > y_ref - r_ref) & (wells[:, 3] < y_ref + r_ref))[0]
+
+    median_x = []
+    median_y = []
+
+    for index in x_ind:
+        median = np.median(wells[(wells[:, 3] > (wells[index, 3] - r_ref)) & (wells[:, 3] < (wells[index, 3] + r_ref)), 3])
+        wells[(wells[:, 3] > (wells[index, 3] - r_ref)) & (wells[:, 3] < (wells[index, 3] + r_ref)), 1] = median
+        median_y.append(median)
+
+    for index in y_ind:
+        median = np.median(wells[(wells[:, 2] > (wells[index, 2] - r_ref)) & (wells[:, 2] < (wells[index, 2] + r_ref)), 2])
+        wells[(wells[:, 2] > (wells[index, 2] - r_ref)) & (wells[:, 2] < (wells[index, 2] + r_ref)), 0] = median
+        median_x.append(median)
+
+    wells = pd.DataFrame(wells, columns=['well_id_x', 'well_id_y', 'center_x', 'center_y', 'radius'])
+
+    wells.replace({'well_id_x' : dict(zip(sorted(median_x), np.arange(0, len(median_x), 1, dtype = np.int16)))}, inplace = True)
+    wells.replace({'well_id_y' : dict(zip(sorted(median_y), np.arange(0, len(median_y), 1, dtype = np.int16)))}, inplace = True)
+    wells['radius'] = np.ceil(wells['radius'].median())
+
+    wells.set_index(['well_id_x', 'well_id_y'], inplace = True)
+
+    return wells
+
+def get_accuracy(wells, pitch, angle, margin = 100):
+    '''
+        Share of the wells labelled with their true column and row, recovered by
+        undoing the rotation of the synthetic plate (see synthetic.get_circles)
+    '''
+    theta = np.deg2rad(angle)
+    x = wells['center_x'].to_numpy() - margin
+    y = wells['center_y'].to_numpy() - margin
+
+    column = np.round((x * np.cos(theta) + y * np.sin(theta)) / pitch)
+    row = np.round((y * np.cos(theta) - x * np.sin(theta)) / pitch)
+
+    return np.mean((column == wells.index.get_level_values('well_id_x')) & (row == wells.index.get_level_values('well_id_y')))
+
+def time_labelling(function, circles, repeats):
+
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        wells = function(circles)
+        seconds.append(time.perf_counter() - start)
+
+    return min(seconds), wells
+
+
+if __name__ == '__main__':
+
+    args = parse_arguments()
+
+    # the reference labels drift on rotated plates, where a row spans more than a radius
+    print("{:>6} {:>15} {:>14} {:>9} {:>13} {:>14} {:>11}".format('wells', 'reference (ms)', 'vectorized (ms)', 'speed-up',
+                                                                  'reference ok', 'vectorized ok', 'detect (s)'))
+
+    for wells in args.wells:
+        circles = get_circles(wells, pitch = args.pitch, angle = args.angle)
+
+        reference, expected = time_labelling(reference_label_wells, circles, args.repeats)
+        vectorized, labelled = time_labelling(label_wells, circles, args.repeats)
+
+        detect = '-'
+        if args.detect:
+            with tempfile.TemporaryDirectory() as folder:
+                filename, radius = write_plate_sequence(folder, frames = 1, wells = wells, pitch = args.pitch)
+                start = time.perf_counter()
+                detected = analysis(Data(filename)).detect_wells(R = [int(radius * 0.85), int(np.ceil(radius * 1.15))])
+                detect = '{:.3f}'.format(time.perf_counter() - start)
+                if detected is None or len(detected) != wells:
+                    print("Detected {} wells instead of {}".format(0 if detected is None else len(detected), wells))
+
+        print("{:>6} {:>15.2f} {:>14.2f} {:>8.1f}x {:>13.1%} {:>14.1%} {:>11}".format(
+                    wells, 1000 * reference, 1000 * vectorized, reference / vectorized,
+                    get_accuracy(expected, args.pitch, args.angle), get_accuracy(labelled, args.pitch, args.angle), detect),
+              flush = True)
@@ -0,0 +1,174 @@
+import glob
+import os
+import pathlib
+import time
+
+import argparse
+import concurrent.futures
+import multiprocessing
+
+import pandas as pd
+
+from inference_script import add_arguments, get_results_file, run_experiment
+from read_data import get_image_sequence
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--experiments',
+        type=str,
+        nargs='+',
+        help = "Experiment folders to analyze, glob patterns (eg. '/data/plates/*') are expanded"
+        )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help = "Number of experiments analyzed at the same time, each in its own process",
+        required = False
+        )
+    parser.add_argument(
+        '--threads_per_worker',
+        default=None,
+        type=int,
+        help = "Threads each worker may use for decoding and inference (all the cores split between the workers by default), "
+               "the model gets those left by --decode_workers unless --intra_op_threads is given",
+        required = False
+        )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help = "Analyze the experiments whose results are up to date again"
+        )
+    parser.add_argument(
+        '--report',
+        default='batch_report.csv',
+        type=str,
+        help = "File the summary of the batch is written to",
+        required = False
+        )
+    add_arguments(parser)
+
+    return parser.parse_args()
+
+def get_experiments(patterns):
+    '''
+        Expand the experiment folders and glob patterns, in the given order and without duplicates
+    '''
+    experiments = []
+    for pattern in patterns:
+        for folder in sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]:
+            folder = os.path.abspath(folder)
+            if os.path.isdir(folder) and folder not in experiments:
+                experiments.append(folder)
+
+    return experiments
+
+def is_up_to_date(image_folder, model_path, output_format = 'csv'):
+    '''
+        Whether the results of an experiment are newer than its images and the model
+    '''
+    results_file = get_results_file(image_folder, output_format)
+    if not os.path.exists(results_file):
+        return False
+
+    inputs = get_image_sequence(image_folder + '/IMG_%04d.JPG') + [model_path]
+    newest = max(os.path.getmtime(filename) for filename in inputs if os.path.exists(filename))
+
+    return os.path.getmtime(results_file) >= newest
+
+def set_thread_budget(threads):
+    '''
+        Limit the threads of a worker process, runs once in every worker before any experiment
+    '''
+    # read by the math libraries when tensorflow and onnxruntime are first imported
+    for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[variable] = str(threads)
+
+    import cv2
+    cv2.setNumThreads(threads)
+
+def run_job(image_folder, args):
+    '''
+        Analyze one experiment in a worker process, failures are reported instead of raised
+
+        output:
+            summary: dictionary of the status, number of frames, run time and error of the experiment
+    '''
+    summary = {'experiment': image_folder, 'status': 'done',
+               'frames': len(get_image_sequence(image_folder + '/IMG_%04d.JPG')), 'seconds': 0.0, 'error': ''}
+
+    start = time.perf_counter()
+    try:
+        if run_experiment(image_folder, args) is None:
+            summary.update(status = 'failed', error = 'Images could not be loaded or no well was found')
+    except Exception as e:
+        summary.update(status = 'failed', error = '{}: {}'.format(type(e).__name__, e))
+    summary['seconds'] = time.perf_counter() - start
+
+    return summary
+
+
+if __name__ =='__main__':
+
+    # Replaces shell loops over inference_script.py, eg.
+    #   python batch_inference.py --experiments '/data/plates/*' --model_name model.pb --workers 4
+
+    args = parse_arguments()
+
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    # the decoding threads of a worker run next to the model, which gets the rest of its
+    # threads for single operations (a single decode worker decodes in the model's thread)
+    decode_threads = args.decode_workers if args.decode_workers > 1 else 0
+    if not args.intra_op_threads:
+        args.intra_op_threads = max(1, threads - decode_threads)
+    if not args.inter_op_threads:
+        args.inter_op_threads = 1
+    if decode_threads + args.intra_op_threads * args.inter_op_threads > threads:
+        print("Warning: {} decode workers and {}x{} model threads exceed the budget of {} threads per worker".format(
+                    args.decode_workers, args.intra_op_threads, args.inter_op_threads, threads), flush = True)
+
+    model_path = os.path.join(pathlib.Path(__file__).parent.absolute(), '../model_zoo', args.model_name)
+
+    summaries = []
+    jobs = []
+    for image_folder in get_experiments(args.experiments):
+        if not args.force and is_up_to_date(image_folder, model_path, args.output_format):
+            print("Skipping {}, results are up to date".format(image_folder), flush = True)
+            summaries.append({'experiment': image_folder, 'status': 'skipped',
+                              'frames': 0, 'seconds': 0.0, 'error': ''})
+        else:
+            jobs.append(image_folder)
+
+    print("Analyzing {} experiments with {} workers of {} threads ({} decoding, {} for the model)".format(
+                len(jobs), args.workers, threads, args.decode_workers, args.intra_op_threads), flush = True)
+
+    start = time.perf_counter()
+    # spawned workers start without the state of this process, the thread budget applies before any import
+    with concurrent.futures.ProcessPoolExecutor(max_workers = args.workers,
+                                                mp_context = multiprocessing.get_context('spawn'),
+                                                initializer = set_thread_budget, initargs = (threads,)) as pool:
+        futures = {pool.submit(run_job, image_folder, args): image_folder for image_folder in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as e:
+                # the worker itself died (eg. out of memory)
+                summary = {'experiment': futures[future], 'status': 'failed',
+                           'frames': 0, 'seconds': 0.0, 'error': '{}: {}'.format(type(e).__name__, e)}
+            print("{} {} ({} frames in {:.1f} s)".format(summary['status'].capitalize(), summary['experiment'],
+                                                         summary['frames'], summary['seconds']), flush = True)
+            summaries.append(summary)
+    elapsed = time.perf_counter() - start
+
+    report = pd.DataFrame(summaries, columns = ['experiment', 'status', 'frames', 'seconds', 'error'])
+    report.insert(4, 'frames_per_second', report['frames'] / report['seconds'].where(report['seconds'] > 0))
+    report.to_csv(args.report, index = False)
+
+    done = report[report['status'] == 'done']
+    print(report.to_string(index = False), flush = True)
+    print("{} done, {} skipped, {} failed, {:.2f} frames/s overall".format(
+        len(done), (report['status'] == 'skipped').sum(), (report['status'] == 'failed').sum(),
+        done['frames'].sum() / elapsed if elapsed > 0 else 0.0), flush = True)
+    print("Report written to " + args.report, flush = True)
@@ -1,6 +1,5 @@
 import os
 import pathlib
-import sys
 
 import argparse
 from time import sleep
@@ -8,67 +7,303 @@ from time import sleep
 import numpy as np
 import pandas as pd
 
-from data_analysis import analyze_df
-from predictions import predict
-from read_data import Data
+from data_analysis import THRESHOLDS, analyze_stream
+from predictions import convert_to_onnx, filter_outliers, hold_out_crops, predict, quantize_model
+from profiling import NO_PROFILER, profiler
+from read_data import Data, get_image_sequence
+from sharding import get_shard_range, merge_shards, write_shard
+from storage import (RESULT_FORMATS, get_file_hash, get_wells_hash, prediction_cache,
+                     read_wells, write_wells)
 from video_analysis import analysis
 
 
-def parse_arguments():
-    parser = argparse.ArgumentParser()
+def add_analysis_arguments(parser):
+    '''
+        Options of the behaviours computed from the predictions, shared with reanalyze.py
+    '''
+    parser.add_argument(
+        '--starting_image', 
+        default=0, 
+        type=int, 
+        help = "Index for the starting image",
+        required = False
+        )
+    parser.add_argument(
+        '--mad_bounds',
+        default=[np.inf, np.inf],
+        type=float,
+        nargs=2,
+        help = "Lower and upper number of median absolute deviations of the area of a well beyond which predictions are discarded",
+        required = False
+        )
+    parser.add_argument(
+        '--output_format',
+        default='csv',
+        type=str,
+        choices=['csv', 'parquet', 'feather'],
+        help = "Format of the results file, parquet and feather store compact dtypes and load much faster",
+        required = False
+        )
+    parser.add_argument(
+        '--move_threshold',
+        default=THRESHOLDS['move'],
+        type=float,
+        help = "Speed (pixels between images) above which the zebrafish moves, up to burst_threshold it scoots",
+        required = False
+        )
+    parser.add_argument(
+        '--burst_threshold',
+        default=THRESHOLDS['burst'],
+        type=float,
+        help = "Speed (pixels between images) above which a move is a burst",
+        required = False
+        )
+    parser.add_argument(
+        '--edge_threshold',
+        default=THRESHOLDS['edge'],
+        type=float,
+        help = "Distance (pixels) from the center of the well beyond which the zebrafish is on the edge",
+        required = False
+        )
+    parser.add_argument(
+        '--period_images',
+        default=THRESHOLDS['period'],
+        type=int,
+        help = "Number of images in a period of stimulation",
+        required = False
+        )
+
+    return parser
+
+def get_thresholds(args):
+    '''
+        Thresholds of the behaviours (see data_analysis.THRESHOLDS) given on the command line
+    '''
+    return {'move': args.move_threshold, 'burst': args.burst_threshold,
+            'edge': args.edge_threshold, 'period': args.period_images}
+
+def add_arguments(parser):
+    '''
+        Options of the analysis of an experiment, shared with batch_inference.py
+    '''
     parser.add_argument(
         '--rmin',
         default = 72, 
+        type=int,
         help = 'Minimum radius of the well'
         )
     parser.add_argument(
         '--rmax', 
         default = 100, 
+        type=int,
         help = 'Maximum radius of the well'
         )
-    parser.add_argument(
-        '--experiment_dir', 
-        type=str, 
-        help = "which folder would you like to analyze"
-        )
     parser.add_argument(
         '--model_name', 
         type=str, 
         help = "name of the model you want to use"
         )
     parser.add_argument(
-        '--starting_image', 
-        default=0, 
-        type=int, 
-        help = "Index for the starting image",
+        '--batch_size',
+        default='1',
+        type=str,
+        help = "Number of frames fed to the model at once, 'auto' picks the fastest on this machine",
+        required = False
+        )
+    parser.add_argument(
+        '--decode_workers',
+        default=1,
+        type=int,
+        help = "Number of threads decoding images in parallel",
+        required = False
+        )
+    parser.add_argument(
+        '--detection_scale',
+        default=1,
+        type=int,
+        choices=[1, 2, 4, 8],
+        help = "Detect and plot the wells on images decoded at 1/scale resolution",
+        required = False
+        )
+    parser.add_argument(
+        '--roi',
+        action='store_true',
+        help = "Only keep the well regions of each decoded image"
+        )
+    parser.add_argument(
+        '--crop_cache',
+        action='store_true',
+        help = "Keep the decoded wells in the crops folder of the experiment (memory-mapped, frames x wells x (2r)^2 x 3 bytes), later runs read them without decoding. Implies --roi"
+        )
+    parser.add_argument(
+        '--checkpoint_every',
+        default=0,
+        type=int,
+        help = "Save the predicted images every n images, so that an interrupted run can be resumed (0 disables checkpoints)",
+        required = False
+        )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help = "Skip the images already predicted with the same model and wells by an interrupted run"
+        )
+    parser.add_argument(
+        '--pipelined',
+        action='store_true',
+        help = "Overlap decoding, cropping and inference in separate threads"
+        )
+    parser.add_argument(
+        '--shard_index',
+        default=0,
+        type=int,
+        help = "Index of the shard of frames predicted by this worker, from 0 to shard_count - 1",
+        required = False
+        )
+    parser.add_argument(
+        '--shard_count',
+        default=1,
+        type=int,
+        help = "Number of workers the frames of the experiment are split between",
+        required = False
+        )
+    parser.add_argument(
+        '--frame_range',
+        default=None,
+        type=int,
+        nargs=2,
+        help = "First and last image predicted by this worker, instead of shard_index and shard_count",
+        required = False
+        )
+    parser.add_argument(
+        '--wells_file',
+        default=None,
+        type=str,
+        help = "Well layout shared by all the workers, detected and saved by the first worker if missing",
+        required = False
+        )
+    parser.add_argument(
+        '--wells_cache',
+        default=None,
+        type=str,
+        help = "Folder of well layouts reused across runs of the same plate, as long as the plate has not moved",
+        required = False
+        )
+    parser.add_argument(
+        '--engine',
+        default='tf',
+        type=str,
+        choices=['tf', 'onnx'],
+        help = "Inference engine, frozen graphs are converted to ONNX next to the model for the onnx engine",
+        required = False
+        )
+    parser.add_argument(
+        '--quantize',
+        default=None,
+        type=str,
+        choices=['int8', 'float16'],
+        help = "Run a reduced precision copy of the model with the onnx engine, calibrated on this experiment",
+        required = False
+        )
+    parser.add_argument(
+        '--intra_op_threads',
+        default=0,
+        type=int,
+        help = "Threads used inside a single model operation (0 lets the engine decide)",
+        required = False
+        )
+    parser.add_argument(
+        '--inter_op_threads',
+        default=0,
+        type=int,
+        help = "Model operations run in parallel (0 lets the engine decide)",
         required = False
         )
+    parser.add_argument(
+        '--merge',
+        action='store_true',
+        help = "Merge the predictions of all the shards and write the results"
+        )
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help = "Do not reuse or save the raw predictions in the predictions folder of the experiment"
+        )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help = "Time each stage of the analysis and write the metrics to metrics.json next to the results"
+        )
+    add_analysis_arguments(parser)
+
+    return parser
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--experiment_dir', 
+        type=str, 
+        help = "which folder would you like to analyze"
+        )
+    add_arguments(parser)
 
     return parser.parse_args()
 
+def get_results_file(image_folder, output_format = 'csv'):
+    '''
+        Results file of an experiment
+    '''
+    return image_folder + '/results' + RESULT_FORMATS[output_format]
 
-if __name__ =='__main__':
-    
-    user = os.getenv("USER")
-    data_dir = "/gpfs/data/rcretonp/experiment_data"
+def run_experiment(image_folder, args):
+    '''
+        Detect the wells, predict and analyze the images of an experiment
+
+        input:
+            image_folder: folder of the IMG_%04d.JPG images
+            args: options of the analysis (see add_arguments)
+
+        output:
+            filename: results file, or predictions of the shard, None if the images could not
+                      be loaded or no well was found
+    '''
 
-    args = parse_arguments()
     rmin = args.rmin
     rmax = args.rmax
-    experiment_dir = args.experiment_dir
     model_name = args.model_name
     starting_image = args.starting_image
+    batch_size = args.batch_size if args.batch_size == 'auto' else int(args.batch_size)
+    pipelined = args.pipelined
+    roi = args.roi
+    mad_bounds = args.mad_bounds
+    resume = args.resume
+    checkpoint_every = args.checkpoint_every or (100 if resume else 0)
+    decode_workers = args.decode_workers
+    detection_scale = args.detection_scale
+    merge = args.merge
+    sharded = merge or (args.frame_range is not None) or (args.shard_count > 1)
+    stages = profiler() if args.profile else NO_PROFILER
 
-    image_folder = os.path.join(data_dir, user, experiment_dir)
-
-    images = Data(image_folder + '/IMG_%04d.JPG')
-    results_file = image_folder + '/results.csv'
+    data = Data(image_folder + '/IMG_%04d.JPG', workers = decode_workers)
+    output_format = args.output_format
+    results_file = get_results_file(image_folder, output_format)
     img_file = image_folder + '/wells.png'
+    checkpoint_dir = image_folder + '/checkpoint' if checkpoint_every else None
+    wells_file = args.wells_file if args.wells_file else image_folder + '/wells.csv'
+    shard_dir = image_folder + '/shards'
+    cache_dir = image_folder + '/predictions'
 
     model_path = os.path.join(pathlib.Path(__file__).parent.absolute(), '../model_zoo', model_name)
 
-    experiment = analysis(images)
-    infer = predict(images, experiment, model_path)
+    if (args.engine == 'onnx' or args.quantize) and not model_path.endswith('.onnx'):
+        onnx_path = os.path.splitext(model_path)[0] + '.onnx'
+        if not os.path.exists(onnx_path):
+            print("Converting {} to ONNX".format(model_path), flush = True)
+            convert_to_onnx(model_path, onnx_path)
+        model_path = onnx_path
+
+    experiment = analysis(data)
+    infer = predict(data, experiment, model_path, engine = 'onnx' if args.quantize else args.engine,
+                    intra_op_threads = args.intra_op_threads, inter_op_threads = args.inter_op_threads)
 
     print("Loading images ...")
 
@@ -80,23 +315,144 @@ if __name__ =='__main__':
         print("1. Images are directly not under this folder. If so please provide the folder where the images are stored")
         print("2. Images are not named IMG_%04d.JPG -> first image = IMG_0001.JPG, 1400th image = IMG_1400.JPG .")
         print("Closing this session. Please launch again with recommended changes")
-        sys.exit()
+        return None
 
     images.reset()
 
-    wells = experiment.detect_wells(R = [rmin, rmax])
 
-    experiment.plot_wells(wells = wells, img_file = img_file, R = [rmin, rmax])
+    with stages.stage('detect_wells'):
+        if sharded and os.path.exists(wells_file):
+            # every shard has to use the same wells, so they are detected only once
+            wells = read_wells(wells_file)
+        else:
+            if args.wells_cache:
+                wells = experiment.load_or_detect_wells(R = [rmin, rmax], cache_dir = args.wells_cache, scale = detection_scale)
+            else:
+                wells = experiment.detect_wells(R = [rmin, rmax], scale = detection_scale)
+
+            if wells is None:
+                print("No wells found between radii {} and {}, check --rmin and --rmax".format(rmin, rmax), flush = True)
+                infer.close()
+                data.close()
+                return None
+
+            experiment.plot_wells(wells = wells, img_file = img_file, R = [rmin, rmax], scale = detection_scale)
+
+            if sharded:
+                write_wells(wells, wells_file)
 
     print("Total number of wells detected = {}".format(len(wells)), flush = True)
 
-    print("Running predictions. This will take a while!", flush = True)
+    if args.crop_cache:
+        _, bounds = experiment.get_crop_geometry(wells)
+        cache = data.use_crop_cache(image_folder + '/crops', bounds)
+        print("{} of {} images cached in {}".format(cache.get_cached_frames(), images.get_total_frames(),
+                                                   image_folder + '/crops'), flush = True)
+        # only the wells are cached
+        roi = True
+
+    if args.quantize and not merge:
+        # the model is calibrated on the wells of this experiment, and reused by later runs of the same model on it
+        quantized_path = image_folder + '/model.{}.{}.onnx'.format(get_file_hash(model_path)[:16], args.quantize)
+        if not os.path.exists(quantized_path):
+            print("Quantizing the model to " + args.quantize, flush = True)
+            calibration_crops, held_out_crops = hold_out_crops(infer.get_calibration_crops(wells, frames = 20), len(wells))
+            quantize_model(model_path, calibration_crops, quantized_path, mode = args.quantize)
+            if len(held_out_crops):
+                infer.get_deviation_report(quantized_path, held_out_crops)
+
+        infer.close()
+        infer = predict(data, experiment, quantized_path, engine = 'onnx',
+                        intra_op_threads = args.intra_op_threads, inter_op_threads = args.inter_op_threads)
+        model_path = quantized_path
+
+    if merge:
+        print("Merging the predictions of the shards in " + shard_dir, flush = True)
+
+        with stages.stage('merge'):
+            predictions = merge_shards(shard_dir, images.get_total_frames())
+        with stages.stage('filter'):
+            predictions = filter_outliers(predictions, mad_bounds)
+        stages.add_frames(images.get_total_frames())
+
+    elif sharded:
+        if args.frame_range:
+            frame_range = tuple(args.frame_range)
+        else:
+            frame_range = get_shard_range(images.get_total_frames(), args.shard_index, args.shard_count)
+
+        if checkpoint_dir:
+            checkpoint_dir = checkpoint_dir + '_{:06d}_{:06d}'.format(*frame_range)
+
+        print("Running predictions on images {} to {}. This will take a while!".format(*frame_range), flush = True)
+
+        # outliers are filtered on the merged predictions, where every frame of a well is known
+        predictions = infer.predict(wells = wells, batch_size = batch_size, pipelined = pipelined, roi = roi,
+                                    checkpoint_dir = checkpoint_dir,
+                                    checkpoint_every = checkpoint_every, resume = resume, frame_range = frame_range,
+                                    profiler = stages)
+
+        shard_file = write_shard(predictions, shard_dir, frame_range, get_file_hash(model_path), get_wells_hash(wells))
+
+        print("Wrote predictions to {}, run with --merge once every shard is done".format(shard_file), flush = True)
+        if stages.enabled:
+            stages.report()
+            stages.write(image_folder + '/metrics_{:06d}_{:06d}.json'.format(*frame_range))
+        infer.close()
+        data.close()
+        return shard_file
 
-    predictions = infer.predict(wells = wells)
+    elif args.no_cache:
+        print("Running predictions. This will take a while!", flush = True)
+
+        predictions = infer.predict(wells = wells, batch_size = batch_size, pipelined = pipelined, roi = roi,
+                                    mad_bounds = mad_bounds, checkpoint_dir = checkpoint_dir,
+                                    checkpoint_every = checkpoint_every, resume = resume, profiler = stages)
+
+    else:
+        # the raw predictions are kept, so that reanalyze.py can change the thresholds without the model
+        cache = prediction_cache(cache_dir)
+        model_hash = get_file_hash(model_path)
+        frames_hash = cache.get_frames_hash(get_image_sequence(image_folder + '/IMG_%04d.JPG'))
+
+        predictions, _ = cache.load(model_hash, frames_hash, get_wells_hash(wells))
+        if predictions is not None:
+            print("Reusing the predictions in " + cache_dir, flush = True)
+        else:
+            print("Running predictions. This will take a while!", flush = True)
+
+            predictions = infer.predict(wells = wells, batch_size = batch_size, pipelined = pipelined, roi = roi,
+                                        checkpoint_dir = checkpoint_dir, checkpoint_every = checkpoint_every,
+                                        resume = resume, profiler = stages)
+            cache.save(predictions, wells, model_hash, frames_hash)
+
+        with stages.stage('filter'):
+            predictions = filter_outliers(predictions, mad_bounds)
 
     print("Anlysing and writing results to " + results_file, flush = True)
 
-    observations = analyze_df(predictions, wells, starting_image)
-    observations.to_csv(results_file)
+    # behaviours are written 100 frames at a time, the full results table is never held in memory
+    analyze_stream(predictions, wells, starting_image, results_file, chunk_frames = 100,
+                   format = output_format, profiler = stages,
+                   summary_file = image_folder + '/summary.csv', thresholds = get_thresholds(args))
+
+    if stages.enabled:
+        stages.report()
+        stages.write(image_folder + '/metrics.json')
+
+    infer.close()
+    data.close()
+
+    print("Done", flush = True)
+
+    return results_file
+
+
+if __name__ =='__main__':
+    
+    user = os.getenv("USER")
+    data_dir = "/gpfs/data/rcretonp/experiment_data"
+
+    args = parse_arguments()
 
-    print("Done", flush = True)
\ No newline at end of file
+    run_experiment(os.path.join(data_dir, user, args.experiment_dir), args)
@@ -0,0 +1,85 @@
+import os
+import pathlib
+
+import argparse
+
+from server import server
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--model_name',
+        type=str,
+        help = "name of the model you want to use"
+        )
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        type=str,
+        help = "Address the server listens on",
+        required = False
+        )
+    parser.add_argument(
+        '--port',
+        default=8765,
+        type=int,
+        help = "Port the server listens on",
+        required = False
+        )
+    parser.add_argument(
+        '--engine',
+        default=None,
+        type=str,
+        choices=['tf', 'onnx'],
+        help = "Inference engine, chosen by the model extension by default",
+        required = False
+        )
+    parser.add_argument(
+        '--max_crops',
+        default=768,
+        type=int,
+        help = "Maximum number of well crops, from any job, fed to the model at once",
+        required = False
+        )
+    parser.add_argument(
+        '--max_jobs',
+        default=2,
+        type=int,
+        help = "Number of jobs decoding images at the same time, the others wait in the queue",
+        required = False
+        )
+    parser.add_argument(
+        '--intra_op_threads',
+        default=0,
+        type=int,
+        help = "Threads used inside a single model operation (0 lets the engine decide)",
+        required = False
+        )
+    parser.add_argument(
+        '--inter_op_threads',
+        default=0,
+        type=int,
+        help = "Model operations run in parallel (0 lets the engine decide)",
+        required = False
+        )
+
+    return parser.parse_args()
+
+
+if __name__ =='__main__':
+
+    # Submit jobs with eg.
+    #   curl -X POST -d '{"experiment_dir": "/images/plate_1", "rmin": 72, "rmax": 100}' http://127.0.0.1:8765/jobs
+    # and follow them with
+    #   curl http://127.0.0.1:8765/jobs
+
+    args = parse_arguments()
+
+    model_path = os.path.join(pathlib.Path(__file__).parent.absolute(), '../model_zoo', args.model_name)
+
+    print("Loading model {}".format(model_path), flush = True)
+
+    inference = server(model_path, engine = args.engine, max_crops = args.max_crops, max_jobs = args.max_jobs,
+                       intra_op_threads = args.intra_op_threads, inter_op_threads = args.inter_op_threads)
+    inference.serve(host = args.host, port = args.port)
@@ -0,0 +1,78 @@
+import os
+import pathlib
+
+import argparse
+
+from data_analysis import analyze_stream
+from inference_script import add_analysis_arguments, get_results_file, get_thresholds
+from predictions import filter_outliers
+from read_data import get_image_sequence
+from storage import get_file_hash, prediction_cache
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--experiment_dir',
+        type=str,
+        help = "which folder would you like to analyze again"
+        )
+    parser.add_argument(
+        '--model_name',
+        default=None,
+        type=str,
+        help = "Only reuse the predictions of this model, the latest predictions of the images otherwise",
+        required = False
+        )
+    add_analysis_arguments(parser)
+
+    return parser.parse_args()
+
+def reanalyze(image_folder, args):
+    '''
+        Compute the behaviours of an experiment again from the predictions saved by
+        inference_script.py, eg. with other thresholds, without running the model
+
+        input:
+            image_folder: folder of the IMG_%04d.JPG images
+            args: options of the analysis (see inference_script.add_analysis_arguments)
+
+        output:
+            results_file: file the behaviours are written to
+    '''
+    cache_dir = image_folder + '/predictions'
+    results_file = get_results_file(image_folder, args.output_format)
+
+    model_hash = None
+    if args.model_name:
+        model_hash = get_file_hash(os.path.join(pathlib.Path(__file__).parent.absolute(), '../model_zoo', args.model_name))
+
+    # predictions of images changed since are never reused, only changed images are hashed again
+    cache = prediction_cache(cache_dir)
+    frames_hash = cache.get_frames_hash(get_image_sequence(image_folder + '/IMG_%04d.JPG'))
+
+    predictions, wells = cache.load(model_hash, frames_hash)
+    if predictions is None:
+        raise FileNotFoundError("No predictions of these images in {}, run inference_script.py first".format(cache_dir))
+
+    predictions = filter_outliers(predictions, args.mad_bounds)
+
+    print("Anlysing and writing results to " + results_file, flush = True)
+
+    analyze_stream(predictions, wells, args.starting_image, results_file, chunk_frames = 100,
+                   format = args.output_format,
+                   summary_file = image_folder + '/summary.csv', thresholds = get_thresholds(args))
+
+    print("Done", flush = True)
+
+    return results_file
+
+
+if __name__ =='__main__':
+
+    user = os.getenv("USER")
+    data_dir = "/gpfs/data/rcretonp/experiment_data"
+
+    args = parse_arguments()
+
+    reanalyze(os.path.join(data_dir, user, args.experiment_dir), args)
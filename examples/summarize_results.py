@@ -0,0 +1,49 @@
+import os
+
+import argparse
+
+from data_analysis import summarize_results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--results_file',
+        type=str,
+        help = "results.csv (or .parquet, .feather) written by inference_script.py"
+        )
+    parser.add_argument(
+        '--summary_file',
+        default=None,
+        type=str,
+        help = "File the summary is written to, summary.csv next to the results by default",
+        required = False
+        )
+    parser.add_argument(
+        '--chunk_rows',
+        default=1000000,
+        type=int,
+        help = "Number of rows of the results read at once",
+        required = False
+        )
+
+    return parser.parse_args()
+
+
+if __name__ =='__main__':
+
+    # inference_script.py writes the summary along with the results,
+    # this recomputes it for results written before summaries existed
+
+    args = parse_arguments()
+
+    summary_file = args.summary_file or os.path.join(os.path.dirname(os.path.abspath(args.results_file)), 'summary.csv')
+
+    print("Summarizing " + args.results_file, flush = True)
+
+    summary = summarize_results(args.results_file, chunk_rows = args.chunk_rows)
+    summary.to_csv(summary_file)
+
+    print("Wrote the summary of {} wells and {} periods to {}".format(
+                summary.index.get_level_values('Well').nunique(),
+                summary.index.get_level_values('Period').nunique(), summary_file), flush = True)
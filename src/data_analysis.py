@@ -1,6 +1,9 @@
 import numpy as np
 import pandas as pd
 
+from profiling import NO_PROFILER
+from storage import read_result_chunks, results_writer
+
 # Routines required to run post prediction analysis
 
 def move_threshhold(distance, lower_bound, upper_bound):
@@ -225,4 +228,386 @@ def analyze_df(observations, wells, starting_image):
         #     'prob_RE', 
         #     'prob_Y', 
         #     'p_Edge'
-        # ]])
\ No newline at end of file
+        # ]])
+
+# Vectorized analysis engine
+#
+# analyze_df builds most behaviours with row-wise DataFrame.apply calls, which
+# means millions of Python calls for a 384 well plate. The routines below compute
+# the same output directly from the column arrays.
+
+RESULT_COLUMNS = ['Label', 'Area', 'X', 'Y', 'MinThr', 'MaxThr', 'Image', 'Period', 'Well',
+                  'Xmid', 'Ymid', 'Exp', 'Move', 'Up', 'Speed', 'Scoot', 'Burst', 'B_Up',
+                  'Edge', 'p_Edge', 'CW', 'Angle', 'Upw', 'Turn', 'Tabs', 'XLE', 'YLE',
+                  'XRE', 'YRE', 'prob_LE', 'prob_RE', 'prob_Y']
+
+# result column of each prediction column copied to the results
+PREDICTION_RESULT_NAMES = {'yolk_x': 'X', 'yolk_y': 'Y',
+                           'left_eye_x': 'XLE', 'left_eye_y': 'YLE',
+                           'right_eye_x': 'XRE', 'right_eye_y': 'YRE',
+                           'prob_LE': 'prob_LE', 'prob_RE': 'prob_RE', 'prob_Y': 'prob_Y'}
+
+# Speeds (pixels between consecutive images) and distance from the center of
+# the well (pixels) defining the behaviours, and number of images in a period
+#   move: Move above this speed, Scoot between move and burst
+#   burst: Burst above this speed
+#   edge: p_Edge beyond this distance
+#   period: images per Period
+THRESHOLDS = {'move': 3, 'burst': 20, 'edge': 50, 'period': 100}
+
+def get_thresholds(thresholds = None):
+    '''
+        THRESHOLDS updated with the given ones
+    '''
+    thresholds = dict(THRESHOLDS, **(thresholds or {}))
+    if len(thresholds) != len(THRESHOLDS):
+        raise ValueError("thresholds should be among {}".format(', '.join(THRESHOLDS)))
+
+    return thresholds
+
+def get_flag(condition, valid = None):
+    '''
+        Vectorized logical (100 or 0), NaN wherever the input is not valid
+
+        Like DataFrame.apply on the row-wise helpers, the result is an integer
+        array unless it holds a NaN
+    '''
+    flag = np.where(condition, 100, 0)
+    if valid is None or valid.all():
+        return flag
+
+    return np.where(valid, flag, np.nan)
+
+def shift_frames(values, n_wells, previous = None):
+    '''
+        Vectorized equivalent of Series.shift(n_wells), i.e. the value of the
+        same well in the previous frame
+
+        input:
+            values: array of values ordered frame by frame
+            n_wells: number of wells in each frame
+            previous: values of the frame preceding the array (NaN if None)
+    '''
+    shifted = np.full(len(values), np.nan, dtype = np.result_type(values, np.float32))
+    head = min(n_wells, len(values))
+
+    if previous is not None:
+        shifted[:head] = previous[:head]
+    shifted[head:] = values[:len(values) - head]
+
+    return shifted
+
+def get_labels(image, starting_image):
+    '''
+        Image labels (IMG_%04d) for an array of image numbers, formatted once per image
+    '''
+    images, inverse = np.unique(image, return_inverse = True)
+    labels = np.array(["IMG_{:04d}".format(int(i + starting_image)) for i in images], dtype = object)
+
+    return labels[inverse]
+
+def analyze_arrays(columns, image, xcor, ycor, n_wells, radius, starting_image, previous = None, thresholds = None):
+    '''
+        Get zebrafish behaviours from prediction arrays
+
+        input:
+            columns: dictionary of prediction arrays named as in the output
+                     (X, Y, XLE, YLE, XRE, YRE, prob_LE, prob_RE, prob_Y)
+            image: image number of each row
+            xcor, ycor: well coordinates of each row
+            n_wells: number of wells in a frame, rows are ordered frame by frame
+            radius: mean radius of the wells
+            starting_image: index of the starting image
+            previous: dictionary with the 'X', 'Y' and 'Angle' arrays of the frame
+                      preceding these rows (None for the first frame)
+            thresholds: dictionary of thresholds replacing the default ones (see THRESHOLDS)
+
+        output:
+            behaviours: dictionary of behaviour arrays, see analyze_df for a description
+                        rows are in the same order as the input
+    '''
+    xd, yd = 12, 8
+    if previous is None:
+        previous = {}
+    thresholds = get_thresholds(thresholds)
+    move, burst = thresholds['move'], thresholds['burst']
+
+    X, Y = columns['X'], columns['Y']
+    XLE, YLE = columns['XLE'], columns['YLE']
+    XRE, YRE = columns['XRE'], columns['YRE']
+
+    behaviours = dict(columns)
+    size = len(X)
+    # midpoints are kept as float64 arrays so that mixed precision arithmetic
+    # promotes exactly like the pandas columns in analyze_df
+    Xmid = behaviours['Xmid'] = np.full(size, radius, dtype = np.float64)
+    Ymid = behaviours['Ymid'] = np.full(size, radius, dtype = np.float64)
+    behaviours['Image'] = image
+    behaviours['Label'] = get_labels(image, starting_image)
+    behaviours['Xcor'] = xcor
+    behaviours['Ycor'] = ycor
+    for column in ['MinThr', 'MaxThr', 'Area', 'Exp']:
+        behaviours[column] = np.full(size, np.nan)
+
+    behaviours['Up'] = get_flag(Y < Ymid, valid = ~np.isnan(Y))
+    behaviours['Well'] = ((xcor % xd + 1) + (ycor % yd) * xd
+                          + (ycor // yd) * xd * yd + (xcor // xd) * xd * yd * 2)
+    behaviours['Period'] = image // thresholds['period'] + 1
+
+    speed = np.sqrt((X - shift_frames(X, n_wells, previous.get('X')))**2 +
+                    (Y - shift_frames(Y, n_wells, previous.get('Y')))**2)
+    moved = ~np.isnan(speed)
+    behaviours['Speed'] = speed
+    behaviours['Move'] = get_flag((speed > move) & (speed < np.inf), valid = moved)
+    behaviours['Scoot'] = get_flag((speed > move) & (speed < burst), valid = moved)
+    behaviours['Burst'] = get_flag((speed > burst) & (speed < np.inf), valid = moved)
+    behaviours['B_Up'] = np.where(behaviours['Burst'] == 100, behaviours['Up'], np.nan)
+
+    behaviours['CW'] = get_flag(((YRE - Ymid)**2 + (XRE - Xmid)**2) <
+                                ((YLE - Ymid)**2 + (XLE - Xmid)**2))
+
+    # the row-wise helpers see every value as a python float, so orientations
+    # are computed in double precision whatever the prediction dtype
+    X64, Y64 = X.astype(np.float64), Y.astype(np.float64)
+    XLE64, YLE64 = XLE.astype(np.float64), YLE.astype(np.float64)
+    XRE64, YRE64 = XRE.astype(np.float64), YRE.astype(np.float64)
+
+    angle = np.arctan2((YRE64 + YLE64)/2 - Y64, (XRE64 + XLE64)/2 - X64)*180/np.pi
+    behaviours['Angle'] = angle
+    behaviours['Upw'] = get_flag((YLE64 + YRE64)/2 < Y64)
+
+    turn = angle - shift_frames(angle, n_wells, previous.get('Angle'))
+    turn = np.where(turn < -180, turn + 360, np.where(turn > 180, turn - 360, turn))
+    behaviours['Turn'] = turn
+    behaviours['Tabs'] = np.abs(turn)
+
+    behaviours['Edge'] = np.sqrt((Y - Ymid)**2 + (X - Xmid)**2)
+    behaviours['p_Edge'] = get_flag(behaviours['Edge'] > thresholds['edge'])
+
+    return behaviours
+
+def analyze_df_vectorized(observations, wells, starting_image, thresholds = None):
+    '''
+        Vectorized equivalent of analyze_df, computes the same behaviours
+        straight from the column arrays instead of row-wise apply calls.
+        Unlike analyze_df, observations are not modified.
+
+        input:
+            observations: predictions of zebrafish locations by the model
+            wells: pandas dictionary of location of wells
+            starting_image: index of the starting image
+            thresholds: dictionary of thresholds replacing the default ones (see THRESHOLDS)
+
+        output:
+            observations: pandas dictionary of zebrafish behaviours (see analyze_df)
+    '''
+    columns = {name: observations[column].to_numpy() for column, name in PREDICTION_RESULT_NAMES.items()}
+
+    behaviours = analyze_arrays(columns,
+                                image = observations.index.get_level_values(0).to_numpy(),
+                                xcor = observations.index.get_level_values(1).to_numpy(),
+                                ycor = observations.index.get_level_values(2).to_numpy(),
+                                n_wells = len(wells),
+                                radius = wells['radius'].mean(),
+                                starting_image = starting_image,
+                                thresholds = thresholds)
+
+    order = np.lexsort((behaviours['Well'], behaviours['Image']))
+
+    return pd.DataFrame({column: behaviours[column][order] for column in RESULT_COLUMNS})
+
+def get_frame_chunks(observations, chunk_frames = 100):
+    '''
+        Split predictions ordered by frame into chunks of whole frames
+
+        input:
+            observations: predictions of zebrafish locations by the model
+            chunk_frames: number of frames in each chunk
+
+        output:
+            generator of pandas dictionaries holding chunk_frames frames
+    '''
+    frames = observations.index.get_level_values(0).to_numpy()
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(frames)) + 1])[::chunk_frames]
+
+    for start, stop in zip(starts, list(starts[1:]) + [len(observations)]):
+        yield observations.iloc[start:stop]
+
+def analyze_stream(predictions, wells, starting_image, filename, chunk_frames = 100, format = 'csv', profiler = None,
+                   summary_file = None, thresholds = None):
+    '''
+        Streaming equivalent of analyze_df_vectorized, the behaviours of each
+        chunk of frames are appended to a file as soon as they are computed. Only
+        the positions and orientations of the last frame are carried to the next
+        chunk, so the results of the whole experiment are never held in memory
+
+        A csv file is identical to the one written by analyze_df_vectorized(...).to_csv
+
+        input:
+            predictions: predictions of zebrafish locations by the model, in frame order
+            wells: pandas dictionary of location of wells
+            starting_image: index of the starting image
+            filename: file the behaviours are written to
+            chunk_frames: number of frames analysed at once (see get_frame_chunks)
+            format: 'csv', 'parquet' or 'feather' (see storage.results_writer)
+            profiler: profiling.profiler timing the analyze and write stages, None times nothing
+            summary_file: csv file the per well and period summary is written to (see summary),
+                          None skips the summary
+            thresholds: dictionary of thresholds replacing the default ones (see THRESHOLDS)
+
+        output:
+            rows: number of rows written
+    '''
+    profiler = profiler or NO_PROFILER
+    n_wells = len(wells)
+    radius = wells['radius'].mean()
+
+    # the batch analysis writes Up as floats when any yolk prediction is missing (masked outliers),
+    # every chunk has to, even those without missing predictions
+    float_up = bool(predictions['yolk_y'].isna().any())
+
+    writer = results_writer(filename, format)
+    totals = summary() if summary_file else None
+    previous = None
+    rows = 0
+    try:
+        for chunk in get_frame_chunks(predictions, chunk_frames):
+            with profiler.stage('analyze'):
+                columns = {name: chunk[column].to_numpy() for column, name in PREDICTION_RESULT_NAMES.items()}
+
+                behaviours = analyze_arrays(columns,
+                                            image = chunk.index.get_level_values(0).to_numpy(),
+                                            xcor = chunk.index.get_level_values(1).to_numpy(),
+                                            ycor = chunk.index.get_level_values(2).to_numpy(),
+                                            n_wells = n_wells,
+                                            radius = radius,
+                                            starting_image = starting_image,
+                                            previous = previous,
+                                            thresholds = thresholds)
+
+                # the first frame of an experiment has no speed, which makes these floats in the batch analysis
+                for column in ['Move', 'Scoot', 'Burst'] + (['Up'] if float_up else []):
+                    behaviours[column] = behaviours[column].astype(np.float64)
+
+                previous = {column: behaviours[column][-n_wells:] for column in ['X', 'Y', 'Angle']}
+
+                order = np.lexsort((behaviours['Well'], behaviours['Image']))
+                observations = pd.DataFrame({column: behaviours[column][order] for column in RESULT_COLUMNS})
+
+            if totals is not None:
+                with profiler.stage('summarize'):
+                    totals.add(observations)
+
+            with profiler.stage('write'):
+                writer.write(observations)
+            rows += len(order)
+    finally:
+        writer.close()
+
+    if totals is not None:
+        totals.get().to_csv(summary_file)
+
+    return rows
+
+# Per well and period summaries
+#
+# Behaviours are 0/100 flags, so their mean over the frames of a period is the
+# percentage of frames showing the behaviour
+
+SUMMARY_PERCENTS = ['Move', 'Up', 'Scoot', 'Burst', 'p_Edge']
+SUMMARY_MEANS = ['Speed']
+SUMMARY_TOTALS = ['Tabs']
+SUMMARY_COLUMNS = ['Well', 'Period'] + SUMMARY_PERCENTS + SUMMARY_MEANS + SUMMARY_TOTALS
+
+
+class summary:
+
+    def __init__(self):
+        '''
+            Accumulate per well and per period statistics of behaviours, one chunk at a time,
+            so that the summary of an experiment never needs the whole results table
+
+                Frames: number of images of the well in the period
+                Move, Up, Scoot, Burst, p_Edge: percentage of the images showing the
+                                                behaviour, undefined values (eg. Move of
+                                                the first image) are left out
+                Speed: mean speed
+                Tabs: total absolute change in orientation (degrees)
+        '''
+
+        self.__sums = None
+        self.__counts = None
+        self.__frames = None
+
+    def add(self, observations):
+        '''
+            Add the behaviours of some frames, the frames of a period may be split between calls
+
+            input:
+                observations: pandas dictionary with at least the SUMMARY_COLUMNS
+                              (see analyze_df and storage.read_result_chunks)
+        '''
+
+        values = observations[SUMMARY_PERCENTS + SUMMARY_MEANS + SUMMARY_TOTALS].astype(np.float64)
+        keys = pd.MultiIndex.from_arrays([observations['Well'].to_numpy(dtype = np.int64),
+                                          observations['Period'].to_numpy(dtype = np.int64)],
+                                         names = ['Well', 'Period'])
+        grouped = values.set_axis(keys).groupby(level = ['Well', 'Period'], sort = False)
+
+        sums, counts, frames = grouped.sum(), grouped.count(), grouped.size()
+
+        if self.__sums is None:
+            self.__sums, self.__counts, self.__frames = sums, counts, frames
+        else:
+            self.__sums = self.__sums.add(sums, fill_value = 0)
+            self.__counts = self.__counts.add(counts, fill_value = 0)
+            self.__frames = self.__frames.add(frames, fill_value = 0)
+
+    def get(self):
+        '''
+            output:
+                summary: pandas dictionary indexed by (Well, Period)
+        '''
+
+        if self.__sums is None:
+            return pd.DataFrame(columns = ['Frames'] + SUMMARY_PERCENTS + SUMMARY_MEANS + SUMMARY_TOTALS,
+                                index = pd.MultiIndex.from_tuples([], names = ['Well', 'Period']))
+
+        averages = SUMMARY_PERCENTS + SUMMARY_MEANS
+        result = self.__sums[averages] / self.__counts[averages].where(self.__counts[averages] > 0)
+        result[SUMMARY_TOTALS] = self.__sums[SUMMARY_TOTALS]
+        result.insert(0, 'Frames', self.__frames.astype(np.int64))
+
+        return result.sort_index()
+
+def summarize(observations):
+    '''
+        Per well and per period summary of behaviours (see summary)
+
+        input:
+            observations: pandas dictionary of zebrafish behaviours (see analyze_df)
+
+        output:
+            summary: pandas dictionary indexed by (Well, Period)
+    '''
+    totals = summary()
+    totals.add(observations)
+
+    return totals.get()
+
+def summarize_results(filename, chunk_rows = 1000000):
+    '''
+        Per well and per period summary of a results file, only the summarized
+        columns are read, chunk_rows rows at a time
+
+        input:
+            filename: results file written by analyze_stream (csv, parquet or feather)
+
+        output:
+            summary: pandas dictionary indexed by (Well, Period)
+    '''
+    totals = summary()
+    for chunk in read_result_chunks(filename, columns = SUMMARY_COLUMNS, chunk_rows = chunk_rows):
+        totals.add(chunk)
+
+    return totals.get()
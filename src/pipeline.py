@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+
+# marks the end of the items produced by a stage
+_END = object()
+
+
+class pipeline:
+
+    def __init__(self, queue_size = 4):
+        '''
+            Run a chain of producer/consumer stages, each in its own thread,
+            connected by bounded queues so that a slow stage applies back
+            pressure instead of letting frames pile up in memory
+
+            input:
+                queue_size: maximum number of items waiting between two stages
+        '''
+
+        self.__queue_size = queue_size
+        self.__stages = []
+        self.stats = {}
+
+    def add_stage(self, name, function):
+        '''
+            Append a stage to the pipeline
+
+            input:
+                name: name of the stage used in the report
+                function: generator function taking the iterable of items produced
+                          by the previous stage and yielding the items for the next one.
+                          The first stage receives None and acts as the source
+        '''
+
+        self.__stages.append((name, function))
+
+    def run(self):
+        '''
+            Run all the stages until the source is exhausted
+
+            output:
+                results: list of the items yielded by the last stage
+        '''
+
+        stop = threading.Event()
+        errors = []
+        queues = [queue.Queue(maxsize = self.__queue_size) for _ in self.__stages[:-1]]
+        self.stats = {name: {'items': 0, 'busy': 0.0, 'wall': 0.0, 'queue_depth': []}
+                      for name, _ in self.__stages}
+
+        def consume(name, input_queue):
+            '''
+                Iterate over the items of a queue, not counting the waiting time as busy
+            '''
+            while True:
+                start = time.perf_counter()
+                self.stats[name]['queue_depth'].append(input_queue.qsize())
+                while True:
+                    try:
+                        item = input_queue.get(timeout = 0.1)
+                        break
+                    except queue.Empty:
+                        if stop.is_set():
+                            return
+                self.stats[name]['busy'] -= time.perf_counter() - start
+                if item is _END:
+                    return
+                yield item
+
+        def produce(name, item, output_queue):
+            '''
+                Put an item on the next queue, giving up if the pipeline is stopped
+            '''
+            start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    output_queue.put(item, timeout = 0.1)
+                    break
+                except queue.Full:
+                    continue
+            self.stats[name]['busy'] -= time.perf_counter() - start
+
+        def worker(i, name, function, results = None):
+            input_queue = queues[i - 1] if i > 0 else None
+            output_queue = queues[i] if i < len(queues) else None
+
+            start = time.perf_counter()
+            try:
+                for item in function(consume(name, input_queue) if input_queue else None):
+                    self.stats[name]['items'] += 1
+                    if output_queue is None:
+                        results.append(item)
+                    else:
+                        produce(name, item, output_queue)
+                    if stop.is_set():
+                        break
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                # the wait to hand over the end is within the wall time, as it is subtracted from busy
+                if output_queue is not None:
+                    produce(name, _END, output_queue)
+                self.stats[name]['wall'] = time.perf_counter() - start
+                self.stats[name]['busy'] += self.stats[name]['wall']
+
+        results = []
+        threads = [threading.Thread(target = worker, args = (i, name, function), daemon = True)
+                   for i, (name, function) in enumerate(self.__stages[:-1])]
+        for thread in threads:
+            thread.start()
+
+        # the last stage runs in the calling thread
+        name, function = self.__stages[-1]
+        worker(len(self.__stages) - 1, name, function, results)
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return results
+
+    def report(self):
+        '''
+            Print the throughput of each stage and the depth of its input queue.
+            The stage with the lowest busy throughput is the bottleneck, a full
+            queue in front of a stage also indicates it cannot keep up
+
+            output:
+                report: dictionary of per stage statistics
+        '''
+
+        report = {}
+        for name, stats in self.stats.items():
+            depth = stats['queue_depth']
+            report[name] = {
+                'items': stats['items'],
+                'busy_seconds': stats['busy'],
+                'items_per_second': stats['items'] / stats['busy'] if stats['busy'] > 0 else float('inf'),
+                'mean_queue_depth': sum(depth) / len(depth) if depth else 0.0,
+                'max_queue_depth': max(depth) if depth else 0,
+            }
+            print("{:>10}: {:6d} items, {:8.2f} items/s busy, queue depth mean {:.1f} max {}/{}".format(
+                        name, report[name]['items'], report[name]['items_per_second'],
+                        report[name]['mean_queue_depth'], report[name]['max_queue_depth'],
+                        self.__queue_size), flush = True)
+
+        return report
+
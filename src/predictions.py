@@ -1,18 +1,333 @@
 import os
+import queue
+import time
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2' 
 
 import numpy as np
 import pandas as pd
-import tensorflow.compat.v1 as tf
 
+from pipeline import pipeline
+from profiling import NO_PROFILER
 from read_data import Data
+from storage import checkpoint, get_file_hash, get_wells_hash
 from video_analysis import analysis
 
 
+def get_area(predictions):
+    '''
+        Area occupied by zebrafish in pixels, i.e. the area of the triangle
+        formed by the eyes and the yolk of each prediction
+
+        input:
+            predictions: pandas dictionary of predicted images
+
+        output:
+            area: numpy array of areas
+    '''
+
+    x = [predictions[column].to_numpy() for column in ['left_eye_x', 'right_eye_x', 'yolk_x']]
+    y = [predictions[column].to_numpy() for column in ['left_eye_y', 'right_eye_y', 'yolk_y']]
+
+    area=0.5*( (x[0]*(y[1]-y[2])) + (x[1]*(y[2]-y[0])) + (x[2]*(y[0]-y[1])) )
+    return np.abs(area).astype(np.float64)
+
+def filter_outliers(predictions, mad_bounds = (np.inf, np.inf)):
+    '''
+        Mask the predictions whose area is an outlier for their well
+
+        The median and the median absolute deviation (MAD) of the area are computed
+        for every well over all the frames in a single grouped pass. Predictions
+        with an area below median - lower*MAD or above median + upper*MAD are set to NaN
+
+        input:
+            predictions: pandas dictionary of predicted images with an 'area' column,
+                         indexed by (frame, X-coord, Y-coord)
+            mad_bounds: (lower, upper) number of MADs, an infinite bound masks nothing
+
+        output:
+            predictions: pandas dictionary with the outliers masked
+    '''
+
+    lower, upper = mad_bounds
+    if np.isinf(lower) and np.isinf(upper):
+        return predictions
+
+    area = predictions['area']
+    median = area.groupby(level = [1, 2], sort = False).transform('median')
+    mad = (area - median).abs().groupby(level = [1, 2], sort = False).transform('median')
+
+    outliers = np.zeros(len(predictions), dtype = bool)
+    if not np.isinf(lower):
+        outliers |= (area < median - lower * mad).to_numpy()
+    if not np.isinf(upper):
+        outliers |= (area > median + upper * mad).to_numpy()
+
+    predictions.loc[outliers, :] = np.nan
+
+    return predictions
+
+# columns of a predicted image, in the order of the model output
+PREDICTION_COLUMNS = ['right_eye_y', 'right_eye_x', 'prob_RE',
+                      'left_eye_y', 'left_eye_x', 'prob_LE',
+                      'yolk_y', 'yolk_x', 'prob_Y']
+
+def get_predicted_images(well_ind, output):
+    '''
+        Split the engine output for the wells of one or more frames into one pandas dictionary per frame
+
+        input:
+            well_ind: list of well indices as returned by crop_wells
+            output: engine output of shape (frames*wells*3, 3) (see tf_engine.run)
+
+        output:
+            predicted_images: list of pandas dictionaries indexed by well
+    '''
+    output = np.asarray(output).reshape(-1, len(well_ind), len(PREDICTION_COLUMNS))
+    index = pd.MultiIndex.from_tuples(well_ind)
+
+    return [pd.DataFrame(predicted_image, columns = PREDICTION_COLUMNS, index = index) for predicted_image in output]
+
+def load_graph_def(frozen_graph_filename):
+    '''
+        Read the GraphDef of a frozen DLC model
+    '''
+    import tensorflow.compat.v1 as tf
+
+    with tf.gfile.GFile(frozen_graph_filename, "rb") as f:
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(f.read())
+
+    return graph_def
+
+def convert_to_onnx(model_path, onnx_path = None, opset = 13):
+    '''
+        Convert a frozen DLC model to ONNX, to run it with onnx_engine
+
+        input:
+            model_path: location of a frozen DLC model (.pb)
+            onnx_path: location of the converted model, the .pb extension replaced by .onnx if None
+            opset: ONNX opset the model is converted to
+
+        output:
+            onnx_path: location of the converted model
+    '''
+    import tf2onnx
+
+    if onnx_path is None:
+        onnx_path = os.path.splitext(model_path)[0] + '.onnx'
+
+    # the input height and width are free, any well size can be fed to the converted model
+    tf2onnx.convert.from_graph_def(load_graph_def(model_path), name = os.path.basename(model_path),
+                                   input_names = ['Placeholder:0'], output_names = ['concat_1:0'],
+                                   opset = opset, output_path = onnx_path)
+
+    return onnx_path
+
+def quantize_model(model_path, calibration_crops, quantized_path = None, mode = 'int8', batch_size = 32):
+    '''
+        Reduced precision copy of an ONNX model (see convert_to_onnx), to run with onnx_engine
+
+        'int8' quantizes weights and activations to 8 bits (static QDQ quantization), the
+        activation ranges are calibrated by running the model on calibration_crops.
+        'float16' stores the weights and runs the model in half precision, the inputs and
+        outputs stay float32. It halves the model size but only speeds up CPUs with
+        native float16 arithmetic
+
+        input:
+            model_path: location of an ONNX model
+            calibration_crops: array of wells of shape (crops, 2r, 2r, 3), representative of
+                               the experiments (see predict.get_calibration_crops)
+            quantized_path: location of the quantized model, <model>.<mode>.onnx if None
+            mode: 'int8' or 'float16'
+            batch_size: number of crops per calibration run
+
+        output:
+            quantized_path: location of the quantized model
+    '''
+    import onnx
+
+    if mode not in ('int8', 'float16'):
+        raise ValueError("mode should be 'int8' or 'float16'")
+
+    if quantized_path is None:
+        quantized_path = os.path.splitext(model_path)[0] + '.' + mode + '.onnx'
+
+    # workers starting together may all quantize the model, none of them should load a partial file
+    temporary_path = quantized_path + '.{}.tmp'.format(os.getpid())
+
+    model = onnx.load(model_path)
+
+    if mode == 'float16':
+        from onnxruntime.transformers.float16 import convert_float_to_float16
+        onnx.save(convert_float_to_float16(model, keep_io_types = True), temporary_path)
+        os.replace(temporary_path, quantized_path)
+        return quantized_path
+
+    from onnxruntime import quantization
+
+    input_name = model.graph.input[0].name
+
+    class crop_reader(quantization.CalibrationDataReader):
+        # feeds the calibration crops batch by batch
+
+        def __init__(self):
+            self.starts = iter(range(0, len(calibration_crops), batch_size))
+
+        def get_next(self):
+            start = next(self.starts, None)
+            if start is None:
+                return None
+            return {input_name: calibration_crops[start:start + batch_size].astype(np.float32)}
+
+    quantization.quantize_static(model_path, temporary_path, crop_reader(),
+                                 quant_format = quantization.QuantFormat.QDQ, per_channel = True,
+                                 activation_type = quantization.QuantType.QUInt8,
+                                 weight_type = quantization.QuantType.QInt8)
+    os.replace(temporary_path, quantized_path)
+
+    return quantized_path
+
+def hold_out_crops(crops, wells, every = 4):
+    '''
+        Split calibration crops by frame, so that the deviation of a quantized model
+        is measured on frames it was not calibrated on
+
+        input:
+            crops: array of shape (frames*wells, 2r, 2r, 3) (see predict.get_calibration_crops)
+            wells: number of wells of each frame
+            every: one frame in every this many is held out, at least one if there are two frames
+
+        output:
+            calibration_crops: crops of the other frames
+            held_out_crops: crops of the frames held out
+    '''
+    frames = crops.reshape((-1, wells) + crops.shape[1:])
+
+    held_out = np.arange(len(frames)) % every == every - 1
+    if len(frames) > 1 and not held_out.any():
+        held_out[-1] = True
+
+    return frames[~held_out].reshape((-1,) + crops.shape[1:]), frames[held_out].reshape((-1,) + crops.shape[1:])
+
+# body parts predicted for each crop, in the order of the model output
+BODY_PARTS = ['right_eye', 'left_eye', 'yolk']
+
+def get_keypoint_deviation(reference, predictions):
+    '''
+        Deviation of the keypoints predicted by a model from those of a reference model
+
+        input:
+            reference, predictions: engine outputs of shape (crops*3, 3), (y, x, probability)
+                                    of each body part, for the same crops
+
+        output:
+            deviation: pandas dictionary indexed by body part with the mean, 99th percentile
+                       and maximum distance between the keypoints (pixels) and the mean
+                       absolute difference of their probabilities
+    '''
+
+    reference = np.asarray(reference, dtype = np.float64).reshape(-1, len(BODY_PARTS), 3)
+    predictions = np.asarray(predictions, dtype = np.float64).reshape(-1, len(BODY_PARTS), 3)
+
+    distance = np.hypot(*(predictions[..., :2] - reference[..., :2]).transpose(2, 0, 1))
+
+    return pd.DataFrame({'mean_px': distance.mean(axis = 0),
+                         'p99_px': np.percentile(distance, 99, axis = 0),
+                         'max_px': distance.max(axis = 0),
+                         'mean_prob_diff': np.abs(predictions[..., 2] - reference[..., 2]).mean(axis = 0)},
+                        index = BODY_PARTS)
+
+
+class tf_engine:
+
+    def __init__(self, model_path, intra_op_threads = 0, inter_op_threads = 0):
+        '''
+            Run a frozen DLC model with tensorflow
+
+            input:
+                model_path: location of a frozen DLC model (.pb)
+                intra_op_threads: threads used inside a single operation, 0 lets tensorflow decide
+                inter_op_threads: operations run in parallel, 0 lets tensorflow decide
+        '''
+        import tensorflow.compat.v1 as tf
+
+        with tf.Graph().as_default() as graph:
+            tf.import_graph_def(load_graph_def(model_path))
+
+        config = tf.ConfigProto(intra_op_parallelism_threads = intra_op_threads,
+                                inter_op_parallelism_threads = inter_op_threads)
+
+        self.__sess = tf.Session(graph = graph, config = config)
+        self.__output = graph.get_tensor_by_name("import/concat_1:0")
+        self.__input = graph.get_tensor_by_name("import/Placeholder:0")
+
+    def run(self, data):
+        '''
+            Predict the body parts of a stack of crops of shape (crops, height, width, 3)
+
+            output:
+                predictions: array of shape (crops*3, 3), (y, x, probability) of each body part
+        '''
+        return self.__sess.run(self.__output, feed_dict = {self.__input : data})
+
+    def close(self):
+
+        self.__sess.close()
+
+
+class onnx_engine:
+
+    def __init__(self, model_path, intra_op_threads = 0, inter_op_threads = 0):
+        '''
+            Run a DLC model converted to ONNX (see convert_to_onnx) with ONNX Runtime,
+            which starts much faster than tensorflow and needs no tensorflow install
+
+            input:
+                model_path: location of the converted model (.onnx)
+                intra_op_threads: threads used inside a single operation, 0 lets onnxruntime decide
+                inter_op_threads: operations run in parallel, 0 lets onnxruntime decide
+        '''
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        self.__session = ort.InferenceSession(model_path, options, providers = ['CPUExecutionProvider'])
+        self.__input = self.__session.get_inputs()[0].name
+        self.__output = self.__session.get_outputs()[0].name
+
+    def run(self, data):
+        '''
+            Predict the body parts of a stack of crops of shape (crops, height, width, 3)
+
+            output:
+                predictions: array of shape (crops*3, 3), (y, x, probability) of each body part
+        '''
+        # unlike tensorflow, onnxruntime does not cast the uint8 crops to the model input type
+        return self.__session.run([self.__output], {self.__input : data.astype(np.float32)})[0]
+
+    def close(self):
+
+        self.__session = None
+
+
+# inference engines, chosen by the extension of the model if not given
+ENGINES = {'tf': tf_engine, 'onnx': onnx_engine}
+
+def get_engine_name(model_path):
+    '''
+        Engine running a model: onnx for .onnx files, tf for frozen graphs
+    '''
+    return 'onnx' if model_path.endswith('.onnx') else 'tf'
+
+
 class predict:
 
-    def __init__(self, data, analysis, model_path):
+    def __init__(self, data, analysis, model_path, engine = None, intra_op_threads = 0, inter_op_threads = 0):
         '''
             This class contains routines to predict zebrafish locations inside 
             images given a DLC model
@@ -20,123 +335,403 @@ class predict:
                 input:
                     data: An instantiation of Data class
                     analysis: An instantiation of Analysis class
-                    model_path: location of a frozen DLC model
+                    model_path: location of a frozen DLC model, or of a model converted
+                                to ONNX (see convert_to_onnx)
+                    engine: 'tf' or 'onnx' (see ENGINES), chosen by the model extension if None
+                    intra_op_threads, inter_op_threads: thread counts of the engine,
+                                                        0 lets the engine decide
+
+            The engine is started on first use and kept warm between calls, so that
+            interactive or service use pays the model loading once. Call close()
+            (or use the predictor as a context manager) to release it
         '''
 
-        def load_graph(frozen_graph_filename):
-
-            with tf.gfile.GFile(frozen_graph_filename, "rb") as f:
-                graph_def = tf.GraphDef()
-                graph_def.ParseFromString(f.read())
-                with tf.Graph().as_default() as graph:
-                    tf.import_graph_def(graph_def)
-            return graph
+        if engine is None:
+            engine = get_engine_name(model_path)
+        if engine not in ENGINES:
+            raise ValueError("engine should be one of {}".format(', '.join(ENGINES)))
 
         self.__analysis = analysis
         self.__data = data
-        self.__graph = load_graph(model_path)
+        self.__model_path = model_path
+        self.__engine_name = engine
+        self.__threads = {'intra_op_threads': intra_op_threads, 'inter_op_threads': inter_op_threads}
+        self.__engine = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
 
-    def predict(self, wells, image = None):
+        self.close()
+
+    def predict(self, wells, image = None, batch_size = 1, pipelined = False, queue_size = 4, roi = False,
+                mad_bounds = (np.inf, np.inf), checkpoint_dir = None, checkpoint_every = 100, resume = False,
+                frame_range = None, profiler = None):
         '''
             Predict the location of zebrafish inside images
 
             input:
                 wells: pandas dictionary of well locations
+                image: single image to predict instead of the whole experiment, the
+                       predictions of its wells are returned (see predict_frames)
+                batch_size: number of consecutive frames whose wells are fed to the model
+                            in a single session run. 'auto' picks the batch size with the
+                            best throughput on this machine (see tune_batch_size)
+                pipelined: run decoding, cropping and inference in separate threads
+                           connected by bounded queues, so that the next frames are
+                           decoded while the model runs. Per stage throughput and
+                           queue depths are reported at the end
+                queue_size: maximum number of frames waiting between two stages
+                roi: read only the wells of each frame (see Data.read_wells), with
+                     parallel decoding the full frames never leave the decoding workers
+                mad_bounds: (lower, upper) number of median absolute deviations from the median
+                            area of a well beyond which predictions are masked as outliers
+                            (see filter_outliers), infinite bounds keep every prediction
+                checkpoint_dir: folder where the predicted frames are saved every checkpoint_every
+                                frames (see storage.checkpoint), None disables checkpoints
+                checkpoint_every: number of frames between two checkpoints
+                resume: skip the frames found in checkpoint_dir, if they were predicted with
+                        the same model and well layout. Otherwise the checkpoint is cleared
+                frame_range: (first, last) frame numbers to predict (inclusive), None predicts
+                             every frame. Used to split an experiment between several workers
+                             (see sharding), the outliers should then be filtered once the
+                             shards are merged
+                profiler: profiling.profiler timing the decode, crop, infer, collect and
+                          filter stages, None times nothing
 
             output: 
                 predictions: pandas dictionary of predicted images
         '''
 
-        from scipy import stats
+        if image is not None:
+            return next(self.predict_frames(wells, [image]))
+
+        profiler = profiler or NO_PROFILER
+
+        self.__data.reset()
+
+        if batch_size == 'auto':
+            batch_size = self.tune_batch_size(wells)
+
+        total_frames = self.__data.get_total_frames()
+
+        _, bounds = self.__analysis.get_crop_geometry(wells)
+
+        done = set()
+        previous = None
+        if checkpoint_dir:
+            saved = checkpoint(checkpoint_dir, get_file_hash(self.__model_path), get_wells_hash(wells))
+            previous = saved.load() if resume else None
+            if previous is None:
+                saved.clear()
+            else:
+                done = set(previous.index.get_level_values(0))
+                print("Resuming from checkpoint, {} images already predicted".format(len(done)), flush = True)
+
+        first, last = frame_range if frame_range else (1, total_frames)
+
+        def decode(_):
+            # frames are checkpointed in order, so the predicted frames are
+            # normally the first ones and are skipped without being decoded
+            start = first - 1
+            while start + 1 in done:
+                start += 1
+            self.__data.seek(start)
+
+            for i in range(start, last):
+                if roi:
+                    ret, image, img_no = self.__data.read_wells(bounds)
+                else:
+                    ret, image, img_no = self.__data.read()
+
+                if not ret:
+                    print("Can't receive frame (stream end?). Exiting ...")
+                    break
+
+                if img_no in done:
+                    continue
+
+                yield img_no, image
+
+        buffers = self.__get_buffers(wells, batch_size, queue_size + 2 if pipelined else 1)
+
+        def write_checkpoint(pending):
+            saved.write(pd.concat([predicted_image for _, predicted_image in pending],
+                                  keys = [img_no for img_no, _ in pending]))
+
+        def collect(predicted_images):
+            pending = []
+            for i, predicted_image in enumerate(predicted_images, len(done)):
+                if (i%10) == 0:
+                    print ("Analyzed {}/{} images".format(i, last - first + 1), flush = True)
+
+                if checkpoint_dir:
+                    pending.append(predicted_image)
+                    if len(pending) == checkpoint_every:
+                        write_checkpoint(pending)
+                        pending = []
+
+                yield predicted_image
+
+            if pending:
+                write_checkpoint(pending)
+
+        stages = [('decode', decode),
+                  ('crop', lambda images: self.__crop(wells, images, batch_size, buffers, roi)),
+                  ('infer', lambda batches: self.__infer(batches, buffers)),
+                  ('collect', collect)]
+
+        with profiler.stage('load_model'):
+            self.get_engine()
+
+        if pipelined:
+            runner = pipeline(queue_size = queue_size)
+            for name, stage in stages:
+                runner.add_stage(name, stage)
+            results = runner.run()
+            runner.report()
+            if profiler.enabled:
+                for name, stats in runner.stats.items():
+                    profiler.add(name, stats['busy'], stats['items'])
+        else:
+            results = None
+            for name, stage in stages:
+                results = profiler.wrap(name, stage(results))
+            results = list(results)
+
+        profiler.add_frames(len(results))
+
+        frames = [img_no for img_no, _ in results]
+        predictions = [predicted_image for _, predicted_image in results]
+
+        predictions = [pd.concat(predictions, keys = frames)] if frames else []
+        if previous is not None:
+            predictions.insert(0, previous)
+
+        predictions = pd.concat(predictions)
+        predictions.rename_axis(['frame', 'X-coord', 'Y-coord'], inplace = True)
+        if not predictions.index.get_level_values(0).is_monotonic_increasing:
+            predictions.sort_index(level = 0, sort_remaining = False, inplace = True)
+
+        with profiler.stage('filter'):
+            predictions['area'] = get_area(predictions)
+
+            predictions = filter_outliers(predictions, mad_bounds)
+
+        return predictions
+
+
+    def predict_frames(self, wells, frames, batch_size = 1):
+        '''
+            Predict arbitrary frames with the warm engine, eg. frames received by a service
+            or picked interactively. Outliers are not filtered
+
+            input:
+                wells: pandas dictionary of well locations
+                frames: iterable of images
+                batch_size: number of frames fed to the model at once
+
+            output:
+                generator of pandas dictionaries of predicted images, one per frame in order
+        '''
+
+        buffers = self.__get_buffers(wells, batch_size, 1)
+        batches = self.__crop(wells, enumerate(frames), batch_size, buffers)
+
+        for _, predicted_image in self.__infer(batches, buffers):
+            yield predicted_image
+
+    def __get_buffers(self, wells, batch_size, count):
+        '''
+            Fixed pool of batch buffers the wells are cropped straight into,
+            they are handed back once the model has consumed them
+        '''
+
+        buffers = queue.Queue()
+        for _ in range(count):
+            buffers.put(self.__analysis.get_crop_buffer(wells, frames = batch_size))
+
+        return buffers
+
+    def __crop(self, wells, images, batch_size, buffers, roi = False):
+        '''
+            Crop the wells of (frame number, image) pairs into batches of batch_size frames,
+            with roi the images are already the stacked wells (see Data.read_wells)
+        '''
+
+        well_ind, _ = self.__analysis.get_crop_geometry(wells)
+
+        batch, img_nos = buffers.get(), []
+        for img_no, image in images:
+            if roi:
+                batch[len(img_nos)] = image
+            else:
+                self.__analysis.crop_wells(wells, image, out = batch[len(img_nos)])
+            img_nos.append(img_no)
+
+            if len(img_nos) == batch_size:
+                yield img_nos, well_ind, batch
+                batch, img_nos = buffers.get(), []
 
-        def get_area(x,y):
-            '''
-                Area occupied by zebrafish in pixels
-            '''
-            area=0.5*( (x[0]*(y[1]-y[2])) + (x[1]*(y[2]-y[0])) + (x[2]*(y[0]-y[1])) )
-            return np.abs(area)
+        if img_nos:
+            yield img_nos, well_ind, batch
+        else:
+            buffers.put(batch)
+
+    def __infer(self, batches, buffers):
+        '''
+            Predict batches of wells, the buffers are returned to the pool once consumed
+        '''
 
-        def predict_image(image, wells, sess, input, output):
-            '''
-                Predict a single image
-            '''
+        engine = self.get_engine()
+        for img_nos, well_ind, batch in batches:
+            try:
+                predicted_images = self.predict_batch(well_ind, batch[:len(img_nos)], engine)
+            finally:
+                buffers.put(batch)
 
-            well_ind, data = self.__analysis.crop_wells(wells, image)
-            predictions = sess.run(output, feed_dict = {input : data})
-            
-            predictions = np.asarray(predictions).reshape(len(wells), 9)
-            
-            predicted_image = pd.DataFrame(predictions, columns = ['right_eye_y', 'right_eye_x', 'prob_RE',
-                                                                    'left_eye_y', 'left_eye_x', 'prob_LE',
-                                                                    'yolk_y', 'yolk_x', 'prob_Y'],
-                                        index = pd.MultiIndex.from_tuples(well_ind))
-    
-            return predicted_image
+            yield from zip(img_nos, predicted_images)
 
-        if (image):
+    def predict_batch(self, well_ind, batch, engine):
+        '''
+            Predict the wells of several frames in a single engine run
+
+            input:
+                well_ind: list of well indices as returned by crop_wells
+                batch: cropped wells of each frame, array of shape (frames, wells, 2r, 2r, 3)
+                engine: inference engine (see get_engine)
+
+            output:
+                predicted_images: list of pandas dictionaries, one per frame
+        '''
 
-            predicted_image = predict_image(image, wells, sess, input, output)
-            sess.close()
-            return predicted_image
+        data = batch.reshape((-1,) + batch.shape[2:])
 
+        return get_predicted_images(well_ind, engine.run(data))
 
+    def tune_batch_size(self, wells, candidates = (1, 2, 4, 8), repeats = 3):
+        '''
+            Pick the batch size with the best throughput on this machine
+
+            The wells of the first max(candidates) frames are cropped once and each
+            candidate batch size is timed on them (after a warm-up run)
+
+            input:
+                wells: pandas dictionary of well locations
+                candidates: batch sizes to try
+                repeats: number of timed runs for each candidate
+
+            output:
+                batch_size: candidate with the most frames per second
+        '''
+
+        engine = self.get_engine()
+
+        self.__data.reset()
+        batch = self.__analysis.get_crop_buffer(wells, frames = max(candidates))
+        frames = 0
+        while frames < max(candidates):
+            ret, image, _ = self.__data.read()
+            if not ret:
+                break
+            well_ind, _ = self.__analysis.crop_wells(wells, image, out = batch[frames])
+            frames += 1
         self.__data.reset()
 
-        sess, output, input = self.get_session()
-        predictions = []
-        frames = []
+        throughput = {}
+        for batch_size in candidates:
+            if batch_size > frames:
+                continue
 
-        total_frames = self.__data.get_total_frames()
+            self.predict_batch(well_ind, batch[:batch_size], engine)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                self.predict_batch(well_ind, batch[:batch_size], engine)
+            throughput[batch_size] = repeats * batch_size / (time.perf_counter() - start)
 
-        for i in range(total_frames):
-            ret, image, img_no = self.__data.read()
+            print("Batch size {}: {:.2f} frames/s".format(batch_size, throughput[batch_size]), flush = True)
 
-            frames.append(img_no)
+        return max(throughput, key = throughput.get)
 
+    def get_calibration_crops(self, wells, frames = 16):
+        '''
+            Crops of the wells of frames spread evenly over the experiment, to calibrate
+            a quantized model (see quantize_model) and measure its deviation
+
+            input:
+                wells: pandas dictionary of well locations
+                frames: number of frames sampled
+
+            output:
+                crops: array of shape (frames*wells, 2r, 2r, 3)
+        '''
+
+        total_frames = self.__data.get_total_frames()
+        samples = np.unique(np.linspace(0, total_frames - 1, min(frames, total_frames)).astype(int))
+
+        crops = self.__analysis.get_crop_buffer(wells, frames = len(samples))
+        read = 0
+        for sample in samples:
+            self.__data.seek(sample)
+            ret, image, _ = self.__data.read()
             if not ret:
-                print("Can't receive frame (stream end?). Exiting ...")
                 break
+            self.__analysis.crop_wells(wells, image, out = crops[read])
+            read += 1
+        self.__data.reset()
 
-            predicted_image = predict_image(image, wells, sess, input, output)
-            predictions.append(predicted_image)
+        return crops[:read].reshape((-1,) + crops.shape[2:])
 
-            if (i%10) == 0:
-                print ("Analyzed {}/{} images".format(i, total_frames), flush = True)
+    def get_deviation_report(self, model_path, crops, batch_size = 96):
+        '''
+            Compare another version of the model (eg. quantized, see quantize_model) to the model
+            of this predictor: keypoint deviation and speed-up on the same crops
 
-        predictions = pd.concat(predictions, keys = frames)
-        predictions.rename_axis(['frame', 'X-coord', 'Y-coord'], inplace = True)
+            input:
+                model_path: location of the other model
+                crops: array of wells of shape (crops, 2r, 2r, 3) (see get_calibration_crops)
+                batch_size: number of crops per engine run
 
-        sess.close()
+            output:
+                deviation: pandas dictionary of keypoint deviations (see get_keypoint_deviation)
+        '''
 
-        predictions['area'] = predictions.apply(lambda row: get_area([row['left_eye_x'],
-                                                              row['right_eye_x'],
-                                                              row['yolk_x']], 
-                                                             [row['left_eye_y'],
-                                                              row['right_eye_y'],
-                                                              row['yolk_y']]), axis = 1)
+        other = ENGINES[get_engine_name(model_path)](model_path, **self.__threads)
 
-        indices = predictions.loc[1, :, :].index.tolist()
+        outputs = []
+        seconds = []
+        for engine in [self.get_engine(), other]:
+            engine.run(crops[:batch_size])
+            start = time.perf_counter()
+            outputs.append(np.concatenate([engine.run(crops[i:i + batch_size]) for i in range(0, len(crops), batch_size)]))
+            seconds.append(time.perf_counter() - start)
 
-        for _, idx, idy in indices:
-            
-            areas = ([predictions.loc[:, idx, idy]['area'].median(),
-                                stats.median_abs_deviation(predictions.loc[:, idx, idy]['area'].tolist())])
-            upper_bound = areas[0] + np.Inf
-            lower_bound = areas[0] - np.Inf
-            cond = (predictions.loc[:, idx, idy]['area'] < lower_bound) | (predictions.loc[:, idx, idy]['area'] > upper_bound)
-            cond = np.tile(cond, [predictions.loc[:, idx, idy].shape[1], 1]).transpose()
+        other.close()
 
-            predictions.loc[:, idx, idy] = predictions.loc[:, idx, idy].mask(cond).values
+        deviation = get_keypoint_deviation(*outputs)
 
-        return predictions
+        print("Keypoint deviation of {} on {} crops:".format(os.path.basename(model_path), len(crops)))
+        print(deviation.to_string(float_format = '{:.3f}'.format))
+        print("Speed-up: {:.2f}x ({:.1f} crops/s instead of {:.1f})".format(seconds[0] / seconds[1], len(crops) / seconds[1],
+                                                                        len(crops) / seconds[0]), flush = True)
 
+        return deviation
 
-    def get_session(self):
+    def get_engine(self):
         '''
-            Get a tensorflow session
+            Get the inference engine of the model (see ENGINES), started on first use
         '''
-        sess = tf.Session(graph=self.__graph)
-        output = sess.graph.get_tensor_by_name("import/concat_1:0")
-        input = sess.graph.get_tensor_by_name("import/Placeholder:0")
+        if self.__engine is None:
+            self.__engine = ENGINES[self.__engine_name](self.__model_path, **self.__threads)
+
+        return self.__engine
 
-        return sess, output, input
+    def close(self):
+        '''
+            Release the inference engine, it is started again if the predictor is used
+        '''
+        if self.__engine is not None:
+            self.__engine.close()
+            self.__engine = None
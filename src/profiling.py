@@ -0,0 +1,200 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+
+# Timing of the stages of an analysis (decoding, cropping, inference, outlier
+# filter, behaviours), to find out what bounds a slow run
+
+# marks an exhausted iterator
+_END = object()
+
+
+def get_peak_rss():
+    '''
+        Peak resident memory of this process in MB, None where it is not available (Windows)
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+class profiler:
+
+    def __init__(self, enabled = True):
+        '''
+            Accumulate the time spent in each stage of an analysis
+
+            Stages are timed exclusively: the time a stage spends waiting on a
+            nested stage (eg. cropping pulling frames from decoding) is only
+            counted for the nested stage, so the stages add up to the run time.
+            Stages running in parallel threads (see pipeline) add their busy time
+            and can add up to more than the run time
+
+            A disabled profiler hands back iterators unchanged and times nothing
+
+            input:
+                enabled: time the stages
+        '''
+
+        self.enabled = enabled
+        self.frames = 0
+        self.stages = {}
+        self.__start = time.perf_counter()
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def add(self, name, seconds, calls = 1):
+        '''
+            Add time spent in a stage, eg. measured by another component
+        '''
+
+        with self.__lock:
+            stats = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stats['seconds'] += seconds
+            stats['calls'] += calls
+
+    def add_frames(self, frames):
+        '''
+            Count frames fully processed, the stages are reported per frame
+        '''
+
+        self.frames += frames
+
+    def stage(self, name):
+        '''
+            Context manager timing the code run inside it as a stage
+        '''
+
+        if not self.enabled:
+            return contextlib.nullcontext()
+
+        return self.__stage(name)
+
+    def wrap(self, name, iterable):
+        '''
+            Time the production of every item of an iterable as a stage,
+            the time the consumer spends on an item is not counted
+
+            output:
+                iterable: the same items, the iterable itself if the profiler is disabled
+        '''
+
+        if not self.enabled:
+            return iterable
+
+        return self.__wrap(name, iterable)
+
+    def get_metrics(self):
+        '''
+            output:
+                metrics: dictionary of the run time, frames/s, peak memory and
+                         of the total and per frame time of each stage
+        '''
+
+        wall = time.perf_counter() - self.__start
+        metrics = {'frames': self.frames,
+                   'wall_seconds': wall,
+                   'frames_per_second': self.frames / wall if wall > 0 else 0.0,
+                   'peak_rss_mb': get_peak_rss(),
+                   'stages': {}}
+
+        for name, stats in self.stages.items():
+            metrics['stages'][name] = {
+                'seconds': stats['seconds'],
+                'calls': stats['calls'],
+                'ms_per_frame': 1000 * stats['seconds'] / self.frames if self.frames else None,
+                'share': stats['seconds'] / wall if wall > 0 else 0.0,
+            }
+
+        return metrics
+
+    def report(self):
+        '''
+            Print the time of each stage, the stage with the largest share bounds the run
+
+            output:
+                metrics: see get_metrics
+        '''
+
+        metrics = self.get_metrics()
+
+        print("{} frames in {:.2f} s, {:.2f} frames/s, peak memory {}".format(
+                    metrics['frames'], metrics['wall_seconds'], metrics['frames_per_second'],
+                    '{:.0f} MB'.format(metrics['peak_rss_mb']) if metrics['peak_rss_mb'] is not None else 'unknown'),
+              flush = True)
+        for name, stats in metrics['stages'].items():
+            print("{:>14}: {:8.2f} s {:6.1%} {:>14}".format(
+                        name, stats['seconds'], stats['share'],
+                        '{:.2f} ms/frame'.format(stats['ms_per_frame']) if stats['ms_per_frame'] is not None else ''),
+                  flush = True)
+
+        return metrics
+
+    def write(self, filename):
+        '''
+            Write the metrics to a json file
+        '''
+
+        with open(filename, 'w') as f:
+            json.dump(self.get_metrics(), f, indent = 2)
+
+    def __get_stack(self):
+        '''
+            Time spent in the nested stages of each stage running in this thread
+        '''
+
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+
+        return self.__local.stack
+
+    def __enter(self):
+
+        self.__get_stack().append(0.0)
+
+        return time.perf_counter()
+
+    def __exit(self, name, start, calls = 1):
+
+        elapsed = time.perf_counter() - start
+        stack = self.__get_stack()
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+
+        self.add(name, elapsed - nested, calls)
+
+    @contextlib.contextmanager
+    def __stage(self, name):
+
+        start = self.__enter()
+        try:
+            yield
+        finally:
+            self.__exit(name, start)
+
+    def __wrap(self, name, iterable):
+
+        iterator = iter(iterable)
+        while True:
+            item = _END
+            start = self.__enter()
+            try:
+                item = next(iterator, _END)
+            finally:
+                self.__exit(name, start, calls = 0 if item is _END else 1)
+
+            if item is _END:
+                return
+            yield item
+
+
+# shared by the routines called without a profiler
+NO_PROFILER = profiler(enabled = False)
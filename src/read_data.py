@@ -1,13 +1,236 @@
+import collections
+import concurrent.futures
 import glob
+import hashlib
+import json
+import os
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 
 
+def get_image_sequence(filename):
+    '''
+        List the files of an image sequence the way cv2.VideoCapture does:
+        the first index is the first existing file among 0 to 4 and the
+        sequence stops at the first missing index
+
+        input :
+            filename : pattern of the image sequence (eg. img_%02d.jpg)
+
+        output :
+            filenames : list of the files in the sequence
+    '''
+
+    filenames = []
+    for first in range(5):
+        if os.path.exists(filename % first):
+            break
+    else:
+        return filenames
+
+    while os.path.exists(filename % (first + len(filenames))):
+        filenames.append(filename % (first + len(filenames)))
+
+    return filenames
+
+# libjpeg scales JPEGs down while decoding (DCT scaling), which is much
+# faster than decoding the full image and resizing it
+REDUCED_COLOR = {2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def decode_image(filename, scale = 1):
+    '''
+        Decode a single image, runs inside the worker pool of Data
+
+        At full scale the image is decoded by cv2.VideoCapture rather than cv2.imread,
+        so that the pixels are identical to the ones of a sequential read (the video
+        backends and libjpeg round the colour conversion differently)
+
+        input :
+            filename : image file
+            scale : 1, or 2, 4, 8 to decode the image at 1/scale of its resolution
+    '''
+
+    if scale != 1:
+        return cv2.imread(filename, REDUCED_COLOR[scale])
+
+    ret, frame = cv2.VideoCapture(filename).read()
+
+    return frame if ret else None
+
+def decode_wells(filename, bounds):
+    '''
+        Decode a single image and return only its stacked well crops, runs inside
+        the worker pool of Data so that full frames never leave the worker
+    '''
+
+    frame = decode_image(filename)
+    if frame is None:
+        return None
+
+    return crop_frame(frame, bounds)
+
+def crop_frame(frame, bounds, out = None):
+    '''
+        Copy regions of a frame into a stacked array
+
+        input :
+            frame : decoded image
+            bounds : list of (top, bottom, left, right) pixel bounds, all of the same size
+            out : preallocated array of shape (regions, height, width, channels),
+                  a new array is allocated if None
+
+        output :
+            out : the stacked regions
+    '''
+
+    if out is None:
+        top, bottom, left, right = bounds[0]
+        out = np.empty((len(bounds), bottom - top, right - left, frame.shape[2]), dtype = frame.dtype)
+
+    for i, (top, bottom, left, right) in enumerate(bounds):
+        out[i] = frame[top:bottom, left:right]
+
+    return out
+
+def reduce_image(image, scale):
+    '''
+        Downscale a decoded image by scale, for inputs that cannot be decoded at reduced scale
+    '''
+
+    if scale == 1:
+        return image
+
+    height, width = image.shape[:2]
+    return cv2.resize(image, (width // scale, height // scale), interpolation = cv2.INTER_AREA)
+
+
+class crop_cache:
+
+    def __init__(self, directory, filenames, frames, bounds):
+        '''
+            Decoded well crops of every frame of an experiment in a memory-mapped
+            uint8 array of shape (frames, wells, 2r, 2r, 3), so that later passes over
+            the wells (eg. inference with another model) read them without decoding
+
+            The array is keyed by the crop bounds and by the names, sizes and
+            modification dates of the image files, changed images or wells start a
+            new array. The disk space is frames x wells x (2r)^2 x 3 bytes, eg. 9 GB
+            for 1400 frames of a 96 well plate
+
+            Workers of several shards of an experiment can share the arrays: they are
+            created once (see __create), every worker then maps the same files
+
+            input:
+                directory: folder the arrays are written to
+                filenames: files of the images (or the video)
+                frames: number of frames
+                bounds: list of (top, bottom, left, right) pixel bounds of the wells
+                        (see analysis.get_crop_geometry)
+        '''
+
+        self.bounds = [tuple(int(bound) for bound in well) for well in bounds]
+        top, bottom, left, right = self.bounds[0]
+
+        sha = hashlib.sha256(json.dumps(self.bounds).encode())
+        for filename in filenames:
+            stat = os.stat(filename)
+            sha.update('{}:{}:{}'.format(os.path.basename(filename), stat.st_size, stat.st_mtime_ns).encode())
+        name = os.path.join(directory, 'crops_' + sha.hexdigest()[:16])
+
+        os.makedirs(directory, exist_ok = True)
+        shape = (frames, len(bounds), bottom - top, right - left, 3)
+        if not (os.path.exists(name + '.npy') and os.path.exists(name + '.filled.npy')):
+            self.__create(name, shape)
+
+        self.__crops = np.load(name + '.npy', mmap_mode = 'r+')
+        self.__filled = np.load(name + '.filled.npy', mmap_mode = 'r+')
+
+        self.__checked = bounds
+
+    def __create(self, name, shape):
+        '''
+            Create empty arrays, unless another worker already did. They are written
+            under temporary names and linked in place, which fails instead of replacing
+            (and truncating) arrays another worker is already filling. The crops are
+            linked first, so flags never exist without their crops
+        '''
+
+        temporary = '{}.{}.tmp'.format(name, os.getpid())
+        arrays = [('.npy', np.uint8, shape), ('.filled.npy', bool, shape[:1])]
+
+        for suffix, dtype, array_shape in arrays:
+            np.lib.format.open_memmap(temporary + suffix, mode = 'w+', dtype = dtype, shape = array_shape).flush()
+
+        for suffix, _, _ in arrays:
+            try:
+                os.link(temporary + suffix, name + suffix)
+            except FileExistsError:
+                pass
+            os.remove(temporary + suffix)
+
+    def matches(self, bounds):
+        '''
+            Whether wells with these bounds are cached
+        '''
+
+        if bounds is self.__checked:
+            return True
+        if [tuple(int(bound) for bound in well) for well in bounds] != self.bounds:
+            return False
+
+        self.__checked = bounds
+        return True
+
+    def has(self, frame_no):
+        '''
+            Whether the wells of a frame (numbered from 1) are cached
+        '''
+
+        return 0 < frame_no <= len(self.__filled) and bool(self.__filled[frame_no - 1])
+
+    def read(self, frame_no, out = None):
+        '''
+            Wells of a cached frame, copied into out if given
+        '''
+
+        if out is None:
+            return np.array(self.__crops[frame_no - 1])
+
+        out[...] = self.__crops[frame_no - 1]
+        return out
+
+    def write(self, frame_no, crops):
+        '''
+            Cache the wells of a frame
+        '''
+
+        if 0 < frame_no <= len(self.__filled):
+            self.__crops[frame_no - 1] = crops
+            self.__filled[frame_no - 1] = True
+
+    def get_cached_frames(self):
+        '''
+            Number of frames whose wells are cached
+        '''
+
+        return int(self.__filled.sum())
+
+    def close(self):
+        '''
+            Write the cached wells to disk
+        '''
+
+        self.__crops.flush()
+        self.__filled.flush()
+
+
 class Data:
 
-    def __init__(self, filename):
+    def __init__(self, filename, workers = 1, prefetch = None, backend = 'thread'):
         '''
             Load zebrafish images for analysis
             it can be:
@@ -16,8 +239,37 @@ class Data:
 
             input :
                 filename : filename of a video or series of images as described above
+                workers : number of threads or processes decoding the frames of an image
+                          sequence in parallel. With 1 worker, or for videos, frames are
+                          decoded one at a time by cv2.VideoCapture
+                prefetch : number of frames decoded ahead of the one being read
+                           (default 2*workers)
+                backend : 'thread' or 'process' pool used to decode the frames
         '''
 
+        self.__filename = filename
+        self.__filenames = get_image_sequence(filename) if '%' in filename else None
+        self.__executor = None
+        self.__crops = None
+        # frame read last from the crop cache, while the capture has not moved
+        self.__cached_position = None
+
+        if workers > 1 and self.__filenames is not None:
+            self.__prefetch = prefetch if prefetch else 2*workers
+
+            if backend == 'process':
+                self.__executor = concurrent.futures.ProcessPoolExecutor(max_workers = workers)
+            elif backend == 'thread':
+                self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+            else:
+                raise ValueError("backend should be 'thread' or 'process'")
+
+            self.__window = collections.deque()
+            self.__window_bounds = None
+            self.__position = 0
+            self.__scheduled = 0
+            return
+
         iterator = cv2.VideoCapture(filename)
 
         self.__iterator = iterator
@@ -27,18 +279,61 @@ class Data:
             resets the video to its initial frame
         '''
 
-        self.__iterator.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.seek(0)
+
+    def seek(self, frame):
+        '''
+            Move to a given frame, the next read returns frame number frame + 1
+        '''
+
+        if self.__executor is not None:
+            for future in self.__window:
+                future.cancel()
+            self.__window.clear()
+            self.__position = frame
+            self.__scheduled = frame
+            return
+
+        self.__cached_position = None
+        self.__iterator.set(cv2.CAP_PROP_POS_FRAMES, frame)
+
+    def use_crop_cache(self, directory, bounds):
+        '''
+            Cache the wells read by read_wells with these bounds in a memory-mapped
+            array (see crop_cache). Frames already cached are read from it without
+            decoding, the others are decoded and added to it
+
+            input:
+                directory: folder of the cache
+                bounds: list of (top, bottom, left, right) pixel bounds of the wells
 
-    def read(self, plot = False):
+            output:
+                cache: the crop_cache
+        '''
+
+        filenames = self.__filenames if self.__filenames is not None else [self.__filename]
+        self.__crops = crop_cache(directory, filenames, self.get_total_frames(), bounds)
+
+        return self.__crops
+
+    def read(self, plot = False, scale = 1):
         '''
             Get the next image
 
+            input:
+                scale : 1, or 2, 4, 8 to get the image at 1/scale of its resolution.
+                        JPEG sequences are then decoded at reduced scale by libjpeg,
+                        which is much faster than a full decode
+
             ouput:
                 ret : logical indicating if read was successful
                 frame : next frame
         '''
 
-        ret, frame = self.__iterator.read()
+        if scale not in (1, 2, 4, 8):
+            raise ValueError('scale should be 1, 2, 4 or 8')
+
+        ret, frame, frame_no = self.__next_frame(scale)
         # if frame is read correctly ret is True
         if not ret:
             print("Can't receive frame (stream end?). Exiting ...")
@@ -49,10 +344,33 @@ class Data:
             ax.imshow(frame)
             plt.show()
 
-        frame_no = int(self.__iterator.get(cv2.CAP_PROP_POS_FRAMES))
-
         return ret, frame, frame_no
 
+    def read_wells(self, bounds, out = None):
+        '''
+            Get the wells of the next image, without keeping the full frame.
+            With parallel workers the frames are cropped inside the workers,
+            so the prefetch window only holds the (much smaller) well crops
+
+            input:
+                bounds : list of (top, bottom, left, right) pixel bounds of the wells
+                         (see analysis.get_crop_geometry)
+                out : preallocated array the wells are written into
+                      (see analysis.get_crop_buffer), allocated if None
+
+            ouput:
+                ret : logical indicating if read was successful
+                cropped_wells : array of the wells of the next frame
+                frame_no : frame number
+        '''
+
+        ret, cropped_wells, frame_no = self.__next_frame(bounds = bounds, out = out)
+        if not ret:
+            print("Can't receive frame (stream end?). Exiting ...")
+            return ret, cropped_wells, 0
+
+        return ret, cropped_wells, frame_no
+
     def get_shape(self):
         '''
             Get the shape of images
@@ -77,4 +395,131 @@ class Data:
             output :
                 total frames in the imaging set
         '''
-        return int(self.__iterator.get(cv2.CAP_PROP_FRAME_COUNT))
\ No newline at end of file
+        if self.__executor is not None:
+            return len(self.__filenames)
+
+        return int(self.__iterator.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def close(self):
+        '''
+            Stop the decoding workers
+        '''
+        if self.__executor is not None:
+            self.reset()
+            self.__executor.shutdown(wait = True)
+        if self.__crops is not None:
+            self.__crops.close()
+
+    def __next_frame(self, scale = 1, bounds = None, out = None):
+        '''
+            Decode the next frame, either directly or from the prefetch window.
+            If bounds are given only the stacked wells are returned
+        '''
+
+        cached = self.__crops is not None and bounds is not None and self.__crops.matches(bounds)
+
+        if self.__executor is None and cached:
+            frame_no = self.__get_position() + 1
+            if self.__crops.has(frame_no):
+                # the capture only moves once a frame has to be decoded
+                self.__cached_position = frame_no
+                return True, self.__crops.read(frame_no, out), frame_no
+
+        if self.__executor is None and self.__cached_position is not None:
+            self.__iterator.set(cv2.CAP_PROP_POS_FRAMES, self.__cached_position)
+            self.__cached_position = None
+
+        if self.__executor is None and bounds is not None:
+            ret, frame, frame_no = self.__next_frame()
+            if not ret:
+                return ret, frame, frame_no
+            frame = crop_frame(frame, bounds, out)
+            if cached:
+                self.__crops.write(frame_no, frame)
+            return ret, frame, frame_no
+
+        if self.__executor is None:
+            if scale != 1 and self.__filenames is not None:
+                # decode the file at reduced scale and move the capture past it
+                frame_no = int(self.__iterator.get(cv2.CAP_PROP_POS_FRAMES)) + 1
+                if frame_no > len(self.__filenames):
+                    return False, None, 0
+
+                frame = decode_image(self.__filenames[frame_no - 1], scale)
+                self.__iterator.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+                return frame is not None, frame, frame_no
+
+            ret, frame = self.__iterator.read()
+            if ret:
+                frame = reduce_image(frame, scale)
+            return ret, frame, int(self.__iterator.get(cv2.CAP_PROP_POS_FRAMES))
+
+        if bounds is not self.__window_bounds:
+            # the window holds full frames but wells are requested, or the other way round
+            for future in self.__window:
+                future.cancel()
+            self.__window.clear()
+            self.__scheduled = self.__position
+            self.__window_bounds = bounds
+
+        if scale != 1:
+            # reduced frames are decoded here, the window is not topped up with full frames
+            if self.__position >= len(self.__filenames):
+                return False, None, 0
+            if self.__window:
+                # the full frame scheduled for this position is not needed
+                future = self.__window.popleft()
+                if future is not None:
+                    future.cancel()
+            else:
+                self.__scheduled += 1
+
+            frame = decode_image(self.__filenames[self.__position], scale)
+            self.__position += 1
+
+            return frame is not None, frame, self.__position
+
+        # keep the window of frames being decoded full, futures are consumed
+        # in submission order so frames come out in sequence order
+        while (len(self.__window) < self.__prefetch) and (self.__scheduled < len(self.__filenames)):
+            if cached and self.__crops.has(self.__scheduled + 1):
+                # read from the cache when its turn comes
+                future = None
+            elif bounds is None:
+                future = self.__executor.submit(decode_image, self.__filenames[self.__scheduled])
+            else:
+                future = self.__executor.submit(decode_wells, self.__filenames[self.__scheduled], bounds)
+            self.__window.append(future)
+            self.__scheduled += 1
+
+        if not self.__window:
+            return False, None, 0
+
+        future = self.__window.popleft()
+        if future is None:
+            self.__position += 1
+            return True, self.__crops.read(self.__position, out), self.__position
+
+        frame = future.result()
+        self.__position += 1
+
+        if frame is not None and cached:
+            self.__crops.write(self.__position, frame)
+
+        if frame is not None and out is not None:
+            out[...] = frame
+            frame = out
+
+        return frame is not None, frame, self.__position
+
+    def __get_position(self):
+        '''
+            Number of the last frame read
+        '''
+
+        if self.__executor is not None:
+            return self.__position
+        if self.__cached_position is not None:
+            return self.__cached_position
+
+        return int(self.__iterator.get(cv2.CAP_PROP_POS_FRAMES))
@@ -0,0 +1,444 @@
+import collections
+import http.server
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from data_analysis import analyze_stream
+from predictions import ENGINES, filter_outliers, get_area, get_engine_name, get_predicted_images
+from read_data import Data, decode_image
+from storage import RESULT_FORMATS, read_wells
+from video_analysis import analysis
+
+# Long running inference server: experiments and batches of frames submitted by
+# several clients are predicted by a single warm model
+
+
+class job:
+
+    def __init__(self, id, request):
+        '''
+            Experiment folder or batch of frames submitted to the server
+
+            input:
+                id: job number
+                request: dictionary describing the job (see server.submit)
+        '''
+
+        self.id = id
+        self.request = request
+        self.kind = 'experiment' if 'experiment_dir' in request else 'frames'
+        self.state = 'queued'
+        self.error = None
+        self.results_file = None
+        self.predictions = None
+        self.total_frames = None
+        self.times = {'submitted': time.time()}
+
+        self.__lock = threading.Lock()
+        self.__predicted = {}
+        self.__frames_read = 0
+        self.__read_done = False
+        self.__finished = threading.Event()
+
+    def add_frame(self):
+        '''
+            Count a frame sent for inference
+        '''
+        with self.__lock:
+            self.__frames_read += 1
+
+    def add_prediction(self, frame_no, predicted_image):
+        '''
+            Store the prediction of a frame, called by the inference thread
+        '''
+        with self.__lock:
+            self.__predicted[frame_no] = predicted_image
+            self.__check_finished()
+
+    def finish_reading(self):
+        '''
+            Mark that every frame was sent for inference
+        '''
+        with self.__lock:
+            self.__read_done = True
+            self.__check_finished()
+
+    def fail(self, error):
+
+        self.state = 'failed'
+        self.error = error
+        self.times['finished'] = time.time()
+        self.__finished.set()
+
+    def wait(self, timeout = None):
+        '''
+            Wait until every frame is predicted (or the job failed)
+        '''
+        return self.__finished.wait(timeout)
+
+    def get_predictions(self):
+        '''
+            Predictions of all the frames, indexed by (frame, X-coord, Y-coord)
+        '''
+        frames = sorted(self.__predicted)
+        predictions = pd.concat([self.__predicted[frame] for frame in frames], keys = frames)
+
+        return predictions.rename_axis(['frame', 'X-coord', 'Y-coord'])
+
+    def status(self):
+        '''
+            Summary of the job, as returned by the server
+        '''
+        with self.__lock:
+            predicted = len(self.__predicted)
+
+        return {'id': self.id, 'kind': self.kind, 'state': self.state, 'error': self.error,
+                'total_frames': self.total_frames, 'frames_predicted': predicted,
+                'results_file': self.results_file, 'times': self.times}
+
+    def __check_finished(self):
+
+        if self.__read_done and len(self.__predicted) == self.__frames_read:
+            self.__finished.set()
+
+
+class server:
+
+    def __init__(self, model_path, engine = None, max_crops = 768, max_jobs = 2, queue_size = 16,
+                 intra_op_threads = 0, inter_op_threads = 0):
+        '''
+            Predict experiments and batches of frames submitted by several clients with a
+            single warm model. Every job decodes and crops its frames in its own thread,
+            the crops of all the jobs go through one work queue and are fed to the model
+            together, so that small jobs still fill the batches
+
+            input:
+                model_path: location of the model (see predictions.predict)
+                engine: 'tf' or 'onnx', chosen by the model extension if None
+                max_crops: maximum number of well crops fed to the model at once
+                max_jobs: number of jobs decoding frames at the same time, the others are queued
+                queue_size: number of frames waiting for inference
+                intra_op_threads, inter_op_threads: thread counts of the engine
+        '''
+
+        if engine is None:
+            engine = get_engine_name(model_path)
+
+        self.__engine = ENGINES[engine](model_path, intra_op_threads = intra_op_threads,
+                                        inter_op_threads = inter_op_threads)
+        self.__max_crops = max_crops
+        self.__slots = threading.Semaphore(max_jobs)
+        self.__work = queue.Queue(maxsize = queue_size)
+        self.__jobs = collections.OrderedDict()
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__stats = {'batches': 0, 'crops': 0, 'frames': 0}
+
+        self.__inference = threading.Thread(target = self.__infer, daemon = True)
+        self.__inference.start()
+
+    def submit(self, request):
+        '''
+            Queue a job
+
+            input:
+                request: dictionary describing the job, either an experiment
+                            {'experiment_dir': folder of the images,
+                             'pattern': name of the images (default IMG_%04d.JPG),
+                             'rmin', 'rmax': radius range of the wells,
+                             'starting_image': index of the starting image (default 0),
+                             'mad_bounds': outlier bounds (default none, see filter_outliers),
+                             'output_format': csv, parquet or feather (default csv)}
+                         whose results are written to the experiment folder, or a batch of frames
+                            {'frames': list of image files,
+                             'rmin', 'rmax': radius range of the wells, or
+                             'wells_file': well layout (see storage.write_wells)}
+                         whose predictions are kept by the server (see get_predictions)
+
+            output:
+                id: job number
+        '''
+
+        if 'experiment_dir' not in request and 'frames' not in request:
+            raise ValueError("a job needs an 'experiment_dir' or a list of 'frames'")
+        if 'wells_file' not in request and not ('rmin' in request and 'rmax' in request):
+            raise ValueError("a job needs 'rmin' and 'rmax' or a 'wells_file'")
+        if request.get('output_format', 'csv') not in RESULT_FORMATS:
+            raise ValueError("output_format should be one of {}".format(', '.join(RESULT_FORMATS)))
+
+        with self.__lock:
+            submitted = job(next(self.__ids), request)
+            self.__jobs[submitted.id] = submitted
+
+        threading.Thread(target = self.__run, args = (submitted,), daemon = True).start()
+
+        return submitted.id
+
+    def get_status(self, id = None):
+        '''
+            Status of a job, or of the server and all its jobs if id is None
+        '''
+
+        if id is not None:
+            return self.__get_job(id).status()
+
+        with self.__lock:
+            jobs = [submitted.status() for submitted in self.__jobs.values()]
+            stats = dict(self.__stats)
+
+        stats['crops_per_batch'] = stats['crops'] / stats['batches'] if stats['batches'] else 0.0
+        stats['queued_frames'] = self.__work.qsize()
+
+        return {'jobs': jobs, 'inference': stats}
+
+    def get_predictions(self, id):
+        '''
+            Predictions of a finished batch of frames, indexed by (frame, X-coord, Y-coord)
+            where frame is the position of the image in the batch (from 1)
+        '''
+
+        submitted = self.__get_job(id)
+        if submitted.state != 'done' or submitted.predictions is None:
+            raise KeyError('job {} has no predictions'.format(id))
+
+        return submitted.predictions
+
+    def get_http_server(self, host = '127.0.0.1', port = 8765):
+        '''
+            HTTP interface of the server
+
+                POST /jobs                    submit a job (json request, see submit), returns its id
+                GET  /jobs                    status of the server and of all the jobs
+                GET  /jobs/<id>               status of a job
+                GET  /jobs/<id>/predictions   predictions of a batch of frames (json records)
+
+            output:
+                http_server: ThreadingHTTPServer, run it with serve_forever
+        '''
+
+        owner = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                try:
+                    if parts == ['jobs']:
+                        self.__reply(200, json.dumps(owner.get_status()))
+                    elif len(parts) == 2 and parts[0] == 'jobs':
+                        self.__reply(200, json.dumps(owner.get_status(int(parts[1]))))
+                    elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'predictions':
+                        predictions = owner.get_predictions(int(parts[1]))
+                        self.__reply(200, predictions.reset_index().to_json(orient = 'records'))
+                    else:
+                        self.__reply(404, json.dumps({'error': 'unknown path'}))
+                except (KeyError, ValueError) as e:
+                    self.__reply(404, json.dumps({'error': str(e)}))
+
+            def do_POST(self):
+                if self.path.strip('/') != 'jobs':
+                    self.__reply(404, json.dumps({'error': 'unknown path'}))
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    self.__reply(202, json.dumps({'id': owner.submit(request)}))
+                except ValueError as e:
+                    self.__reply(400, json.dumps({'error': str(e)}))
+
+            def log_message(self, format, *args):
+                pass
+
+            def __reply(self, code, body):
+                body = body.encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return http.server.ThreadingHTTPServer((host, port), handler)
+
+    def serve(self, host = '127.0.0.1', port = 8765):
+        '''
+            Serve the HTTP interface until interrupted (see get_http_server)
+        '''
+
+        http_server = self.get_http_server(host, port)
+        print("Serving on http://{}:{}".format(*http_server.server_address), flush = True)
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
+            self.close()
+
+    def close(self):
+        '''
+            Stop the inference thread and release the engine
+        '''
+
+        self.__work.put(None)
+        self.__inference.join()
+        self.__engine.close()
+
+    def __get_job(self, id):
+
+        with self.__lock:
+            if id not in self.__jobs:
+                raise KeyError('unknown job {}'.format(id))
+            return self.__jobs[id]
+
+    def __run(self, submitted):
+        '''
+            Decode and crop the frames of a job, then write its results once they are predicted
+        '''
+
+        request = submitted.request
+        with self.__slots:
+            submitted.state = 'running'
+            submitted.times['started'] = time.time()
+            try:
+                if submitted.kind == 'experiment':
+                    frames, experiment, wells = self.__read_experiment(submitted)
+                else:
+                    frames, experiment, wells = self.__read_frames(submitted)
+
+                well_ind, _ = experiment.get_crop_geometry(wells)
+                for frame_no, image in frames:
+                    _, crops = experiment.crop_wells(wells, image)
+                    submitted.add_frame()
+                    self.__work.put((submitted, frame_no, well_ind, crops))
+            except Exception:
+                submitted.fail(traceback.format_exc(limit = 1))
+                return
+            finally:
+                submitted.finish_reading()
+
+        submitted.wait()
+        if submitted.state == 'failed':
+            return
+
+        submitted.state = 'analyzing'
+        try:
+            predictions = submitted.get_predictions()
+            predictions['area'] = get_area(predictions)
+            predictions = filter_outliers(predictions, request.get('mad_bounds', (np.inf, np.inf)))
+
+            if submitted.kind == 'experiment':
+                output_format = request.get('output_format', 'csv')
+                submitted.results_file = os.path.join(request['experiment_dir'], 'results' + RESULT_FORMATS[output_format])
+                analyze_stream(predictions, wells, request.get('starting_image', 0), submitted.results_file,
+                               format = output_format)
+            else:
+                submitted.predictions = predictions
+        except Exception:
+            submitted.fail(traceback.format_exc(limit = 1))
+            return
+
+        submitted.state = 'done'
+        submitted.times['finished'] = time.time()
+
+    def __read_experiment(self, submitted):
+
+        request = submitted.request
+        data = Data(os.path.join(request['experiment_dir'], request.get('pattern', 'IMG_%04d.JPG')))
+        submitted.total_frames = data.get_total_frames()
+        if not submitted.total_frames:
+            raise ValueError('no images found in {}'.format(request['experiment_dir']))
+
+        experiment = analysis(data)
+        wells = self.__get_wells(request, experiment)
+
+        def frames():
+            for _ in range(submitted.total_frames):
+                ret, image, frame_no = data.read()
+                if not ret:
+                    break
+                yield frame_no, image
+
+        return frames(), experiment, wells
+
+    def __read_frames(self, submitted):
+
+        request = submitted.request
+        submitted.total_frames = len(request['frames'])
+
+        def frames():
+            for frame_no, filename in enumerate(request['frames'], 1):
+                image = decode_image(filename)
+                if image is None:
+                    raise ValueError('could not read {}'.format(filename))
+                yield frame_no, image
+
+        experiment = analysis(Data(request['frames'][0]))
+        wells = self.__get_wells(request, experiment)
+
+        return frames(), experiment, wells
+
+    def __get_wells(self, request, experiment):
+
+        if 'wells_file' in request:
+            return read_wells(request['wells_file'])
+
+        wells = experiment.detect_wells(R = [request['rmin'], request['rmax']])
+        if wells is None:
+            raise ValueError('wells could not be detected')
+
+        return wells
+
+    def __infer(self):
+        '''
+            Inference thread: frames of every job are taken from the work queue and
+            fed to the model together, as long as their crops have the same size
+        '''
+
+        pending = collections.deque()
+        while True:
+            item = pending.popleft() if pending else self.__work.get()
+            if item is None:
+                return
+
+            batch = [item]
+            crops = len(item[3])
+            deferred = []
+            while crops < self.__max_crops:
+                try:
+                    other = pending.popleft() if pending else self.__work.get_nowait()
+                except queue.Empty:
+                    break
+                if other is None or other[3].shape[1:] != item[3].shape[1:]:
+                    # crops of another size are fed in the next batch
+                    deferred.append(other)
+                    if other is None:
+                        break
+                    continue
+                batch.append(other)
+                crops += len(other[3])
+            pending.extendleft(reversed(deferred))
+
+            try:
+                output = np.asarray(self.__engine.run(np.concatenate([frame_crops for _, _, _, frame_crops in batch])))
+            except Exception:
+                for submitted in set(submitted for submitted, _, _, _ in batch):
+                    submitted.fail(traceback.format_exc(limit = 1))
+                continue
+
+            start = 0
+            for submitted, frame_no, well_ind, frame_crops in batch:
+                stop = start + 3*len(frame_crops)
+                submitted.add_prediction(frame_no, get_predicted_images(well_ind, output[start:stop])[0])
+                start = stop
+
+            with self.__lock:
+                self.__stats['batches'] += 1
+                self.__stats['crops'] += crops
+                self.__stats['frames'] += len(batch)
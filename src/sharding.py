@@ -0,0 +1,99 @@
+import glob
+import json
+import os
+
+from storage import read_predictions, write_predictions
+
+# Routines to split the frames of one experiment between several workers
+# and to stitch their partial predictions back together
+
+
+def get_shard_range(total_frames, shard_index, shard_count):
+    '''
+        Frames predicted by one shard, the frames are split in contiguous
+        ranges whose sizes differ by at most one frame
+
+        input:
+            total_frames: number of frames in the experiment
+            shard_index: index of the shard, from 0 to shard_count - 1
+            shard_count: number of shards
+
+        output:
+            (first, last): first and last frame numbers of the shard (inclusive)
+    '''
+
+    if not 0 <= shard_index < shard_count:
+        raise ValueError('shard_index should be between 0 and shard_count - 1')
+
+    size, remainder = divmod(total_frames, shard_count)
+    first = shard_index * size + min(shard_index, remainder)
+    last = first + size + (1 if shard_index < remainder else 0)
+
+    return first + 1, last
+
+def write_shard(predictions, shard_dir, frame_range, model_hash, wells_hash):
+    '''
+        Write the raw predictions of one shard with a manifest of how they were made
+
+        input:
+            predictions: pandas dictionary of predicted images, without outliers masked
+            shard_dir: folder shared by all the shards of the experiment
+            frame_range: (first, last) frame numbers predicted by the shard
+            model_hash, wells_hash: hashes of the model and well layout (see storage)
+
+        output:
+            filename: parquet file of the shard
+    '''
+
+    os.makedirs(shard_dir, exist_ok = True)
+    filename = os.path.join(shard_dir, 'predictions_{:06d}_{:06d}.parquet'.format(*frame_range))
+
+    write_predictions(predictions, filename)
+    with open(filename.replace('.parquet', '.json'), 'w') as f:
+        json.dump({'frames': list(frame_range), 'model': model_hash, 'wells': wells_hash}, f)
+
+    return filename
+
+def merge_shards(shard_dir, total_frames):
+    '''
+        Stitch the partial predictions of all the shards of an experiment
+
+        The shards have to cover the frames 1 to total_frames without gaps
+        or overlaps and to be predicted with the same model and well layout.
+        Cross-frame quantities (Speed, Turn) and the outlier filter need the
+        whole experiment, so they are computed on the merged predictions
+
+        input:
+            shard_dir: folder the shards were written to (see write_shard)
+            total_frames: number of frames in the experiment
+
+        output:
+            predictions: pandas dictionary of predicted images ordered by frame
+    '''
+
+    manifests = []
+    for filename in sorted(glob.glob(os.path.join(shard_dir, 'predictions_*.json'))):
+        with open(filename) as f:
+            manifests.append((json.load(f), filename.replace('.json', '.parquet')))
+
+    if not manifests:
+        raise FileNotFoundError('No shards found in {}'.format(shard_dir))
+
+    manifests.sort(key = lambda manifest: manifest[0]['frames'][0])
+
+    expected = 1
+    for manifest, filename in manifests:
+        first, last = manifest['frames']
+        if first != expected:
+            raise ValueError('Shards do not cover frames {} to {}'.format(expected, first - 1)
+                             if first > expected else 'Shard {} overlaps the previous shard'.format(filename))
+        if (manifest['model'], manifest['wells']) != (manifests[0][0]['model'], manifests[0][0]['wells']):
+            raise ValueError('Shard {} was predicted with another model or well layout'.format(filename))
+        expected = last + 1
+
+    if expected != total_frames + 1:
+        raise ValueError('Shards do not cover frames {} to {}'.format(expected, total_frames))
+
+    predictions = read_predictions([filename for _, filename in manifests])
+
+    return predictions
@@ -0,0 +1,415 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Routines to save and load predictions on disk
+
+
+def get_file_hash(filename):
+    '''
+        sha256 of a file, read in chunks so that large models fit in memory
+    '''
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def get_wells_hash(wells):
+    '''
+        sha256 of a well layout (labels, centers and radii of the wells)
+    '''
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(wells.index.to_frame().to_numpy(dtype = np.float64)).tobytes())
+    sha.update(np.ascontiguousarray(wells[['center_x', 'center_y', 'radius']].to_numpy(dtype = np.float64)).tobytes())
+
+    return sha.hexdigest()
+
+def get_sequence_hash(filenames):
+    '''
+        sha256 of the content of an image sequence, in order, whatever the file names
+    '''
+    sha = hashlib.sha256()
+    for filename in filenames:
+        sha.update(get_file_hash(filename).encode())
+
+    return sha.hexdigest()
+
+def write_wells(wells, filename):
+    '''
+        Write a well layout to a csv file, so that every worker of an experiment uses the same wells
+    '''
+    # workers starting together may all write the layout, none of them should read a partial file
+    wells.to_csv(filename + '.{}.tmp'.format(os.getpid()))
+    os.replace(filename + '.{}.tmp'.format(os.getpid()), filename)
+
+def read_wells(filename):
+    '''
+        Read a well layout written by write_wells
+
+        output:
+            wells: pandas dictionary of wells indexed by (well_id_x, well_id_y)
+    '''
+    # the layout is hashed (see get_wells_hash), its values have to be read back exactly
+    return pd.read_csv(filename, index_col = ['well_id_x', 'well_id_y'], dtype = np.float64,
+                       float_precision = 'round_trip')
+
+def write_predictions(predictions, filename):
+    '''
+        Write predictions indexed by (frame, X-coord, Y-coord) to a parquet file
+    '''
+    predictions.rename_axis(['frame', 'X-coord', 'Y-coord']).reset_index().to_parquet(filename, index = False)
+
+def read_predictions(filenames):
+    '''
+        Read and concatenate predictions written by write_predictions
+
+        input:
+            filenames: list of parquet files
+
+        output:
+            predictions: pandas dictionary indexed by (frame, X-coord, Y-coord)
+    '''
+    predictions = pd.concat([pd.read_parquet(filename) for filename in filenames], ignore_index = True)
+
+    return predictions.set_index(['frame', 'X-coord', 'Y-coord'])
+
+# Behaviours which are 0/100 flags (NaN where undefined), stored as nullable int8 in compact formats
+FLAG_COLUMNS = ['Move', 'Up', 'Scoot', 'Burst', 'B_Up', 'CW', 'Upw', 'p_Edge']
+
+RESULT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+def compact_results(observations, labels = None):
+    '''
+        Convert behaviours to compact dtypes: nullable int8 flags, categorical labels,
+        small integers for image, period and well numbers and float32 for everything else
+
+        input:
+            observations: pandas dictionary of zebrafish behaviours (see data_analysis.analyze_df)
+            labels: list of the label categories, new labels are appended to it so that
+                    the categories of successive chunks extend each other
+
+        output:
+            observations: pandas dictionary of zebrafish behaviours with compact dtypes
+    '''
+    dtypes = {column: np.float32 for column in observations.columns if observations[column].dtype.kind == 'f'}
+    dtypes.update({column: 'Int8' for column in FLAG_COLUMNS})
+    dtypes.update({'Image': np.int32, 'Period': np.int16, 'Well': np.int16})
+    observations = observations.astype(dtypes)
+
+    if labels is None:
+        labels = []
+    new_labels = pd.unique(observations['Label'])
+    labels.extend(new_labels[~np.isin(new_labels, labels)].tolist())
+    observations['Label'] = pd.Categorical(observations['Label'], categories = labels)
+
+    return observations
+
+def read_results(filename):
+    '''
+        Read behaviours written by results_writer, the format is given by the file extension
+    '''
+    if filename.endswith(RESULT_FORMATS['parquet']):
+        return pd.read_parquet(filename)
+    if filename.endswith(RESULT_FORMATS['feather']):
+        return pd.read_feather(filename)
+
+    return pd.read_csv(filename, index_col = 0)
+
+def read_result_chunks(filename, columns = None, chunk_rows = 1000000):
+    '''
+        Read behaviours written by results_writer a chunk of rows at a time
+
+        input:
+            filename: results file, the format is given by the extension
+            columns: columns to read, None reads them all. Columnar formats skip the others on disk
+            chunk_rows: maximum number of rows in a chunk, feather files are read
+                        one chunk of the writer at a time
+
+        output:
+            generator of pandas dictionaries of behaviours
+    '''
+    if filename.endswith(RESULT_FORMATS['parquet']):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size = chunk_rows, columns = columns):
+            yield batch.to_pandas()
+
+    elif filename.endswith(RESULT_FORMATS['feather']):
+        import pyarrow.ipc
+
+        reader = pyarrow.ipc.open_file(filename)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield (batch.select(columns) if columns else batch).to_pandas()
+
+    else:
+        yield from pd.read_csv(filename, usecols = columns, chunksize = chunk_rows)
+
+
+class results_writer:
+
+    def __init__(self, filename, format = 'csv'):
+        '''
+            Write behaviours to a file, one chunk of frames at a time
+
+            'csv' writes the behaviours as computed, for compatibility with existing tools.
+            'parquet' and 'feather' write columnar files with compact dtypes (see
+            compact_results) which are several times smaller and faster to load
+
+            input:
+                filename: file the behaviours are written to
+                format: 'csv', 'parquet' or 'feather'
+        '''
+
+        if format not in RESULT_FORMATS:
+            raise ValueError("format should be one of {}".format(', '.join(RESULT_FORMATS)))
+
+        self.__filename = filename
+        self.__format = format
+        self.__writer = None
+        self.__schema = None
+        self.__labels = []
+        self.__rows = 0
+
+    def write(self, observations):
+        '''
+            Append behaviours, the rows are numbered after the rows already written
+        '''
+
+        if self.__format == 'csv':
+            observations = observations.set_axis(pd.RangeIndex(self.__rows, self.__rows + len(observations)))
+            observations.to_csv(self.__filename, mode = 'a' if self.__rows else 'w', header = not self.__rows)
+            self.__rows += len(observations)
+            return
+
+        import pyarrow as pa
+
+        observations = compact_results(observations, self.__labels)
+
+        if self.__writer is None:
+            # the label dictionary grows with every chunk, its indices must not depend on the first chunk
+            schema = pa.Schema.from_pandas(observations, preserve_index = False)
+            self.__schema = schema.set(schema.get_field_index('Label'),
+                                       pa.field('Label', pa.dictionary(pa.int32(), pa.string())))
+            self.__writer = self.__open(pa)
+
+        self.__writer.write_table(pa.Table.from_pandas(observations, schema = self.__schema, preserve_index = False))
+        self.__rows += len(observations)
+
+    def close(self):
+        '''
+            Finish the file, compact formats are unreadable until closed
+        '''
+
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+
+    def __open(self, pa):
+
+        if self.__format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.ParquetWriter(self.__filename, self.__schema)
+
+        import pyarrow.ipc
+        # later chunks only add labels, which Arrow IPC files store as dictionary deltas
+        return pa.ipc.new_file(self.__filename, self.__schema,
+                               options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas = True))
+
+
+class prediction_cache:
+
+    def __init__(self, directory):
+        '''
+            Raw predictions of whole experiments, so that behaviours can be recomputed
+            with other thresholds without running the model again
+
+            Each entry holds the predictions (before the outlier filter), the well layout
+            they were made with and a manifest of the hashes of the model, the wells and
+            the images. An entry is only reused for the same model and images
+
+            input:
+                directory: folder the entries are written to
+        '''
+
+        self.__directory = directory
+
+    def get_frames_hash(self, filenames):
+        '''
+            Hash of the images, the same as get_sequence_hash. The hash of each file is kept
+            in images.csv with its size and modification date, like crop_cache keys its
+            arrays, so that only new or changed images are read again
+
+            input:
+                filenames: files of the images, in order
+
+            output:
+                frames_hash: hash of the images
+        '''
+
+        index_file = os.path.join(self.__directory, 'images.csv')
+
+        known = {}
+        if os.path.exists(index_file):
+            index = pd.read_csv(index_file, dtype = {'file': str, 'sha256': str}, keep_default_na = False)
+            known = {row.file: (row.size, row.mtime_ns, row.sha256) for row in index.itertuples()}
+
+        rows = []
+        changed = False
+        sha = hashlib.sha256()
+        for filename in filenames:
+            stat = os.stat(filename)
+            name = os.path.basename(filename)
+            size, mtime_ns, file_hash = known.get(name, (None, None, None))
+            if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                file_hash = get_file_hash(filename)
+                changed = True
+            rows.append((name, stat.st_size, stat.st_mtime_ns, file_hash))
+            sha.update(file_hash.encode())
+
+        if changed or len(rows) != len(known):
+            os.makedirs(self.__directory, exist_ok = True)
+            temporary_file = index_file + '.{}.tmp'.format(os.getpid())
+            pd.DataFrame(rows, columns = ['file', 'size', 'mtime_ns', 'sha256']).to_csv(temporary_file, index = False)
+            os.replace(temporary_file, index_file)
+
+        return sha.hexdigest()
+
+    def load(self, model_hash, frames_hash, wells_hash = None):
+        '''
+            Load the most recent predictions of the images by the model
+
+            input:
+                model_hash: hash of the model file (see get_file_hash), None accepts any model
+                frames_hash: hash of the images (see get_frames_hash)
+                wells_hash: hash of the well layout (see get_wells_hash), None accepts any layout
+
+            output:
+                predictions: pandas dictionary of predicted images, None if there is no such entry
+                wells: pandas dictionary of the wells the predictions were made with
+        '''
+
+        entries = []
+        for filename in glob.glob(os.path.join(self.__directory, '*.json')):
+            with open(filename) as f:
+                manifest = json.load(f)
+            if manifest['frames'] != frames_hash:
+                continue
+            if model_hash is not None and manifest['model'] != model_hash:
+                continue
+            if wells_hash is not None and manifest['wells'] != wells_hash:
+                continue
+            entries.append((os.path.getmtime(filename), filename[:-len('.json')]))
+
+        if not entries:
+            return None, None
+
+        _, entry = max(entries)
+
+        return read_predictions([entry + '.parquet']), read_wells(entry + '.wells.csv')
+
+    def save(self, predictions, wells, model_hash, frames_hash):
+        '''
+            Add the raw predictions of an experiment, replacing an entry with the same hashes
+
+            output:
+                filename: parquet file of the predictions
+        '''
+
+        os.makedirs(self.__directory, exist_ok = True)
+
+        manifest = {'model': model_hash, 'wells': get_wells_hash(wells), 'frames': frames_hash}
+        entry = os.path.join(self.__directory,
+                             hashlib.sha256(json.dumps(manifest, sort_keys = True).encode()).hexdigest()[:16])
+
+        write_predictions(predictions, entry + '.parquet.tmp')
+        os.replace(entry + '.parquet.tmp', entry + '.parquet')
+        write_wells(wells, entry + '.wells.csv')
+        # the manifest is written last, an interrupted save leaves no usable entry
+        with open(entry + '.json', 'w') as f:
+            json.dump(manifest, f)
+
+        return entry + '.parquet'
+
+
+class checkpoint:
+
+    def __init__(self, directory, model_hash, wells_hash):
+        '''
+            Periodic checkpoint of the frames predicted so far, so that an
+            interrupted run can resume where it stopped
+
+            Every call to write appends a new parquet part to the directory.
+            A manifest records the model and the well layout the predictions
+            were made with, parts made with another model or layout are never reused
+
+            input:
+                directory: folder the parts are written to
+                model_hash: hash of the model file (see get_file_hash)
+                wells_hash: hash of the well layout (see get_wells_hash)
+        '''
+
+        self.__directory = directory
+        self.__manifest = {'model': model_hash, 'wells': wells_hash}
+        self.__parts = 0
+
+        os.makedirs(directory, exist_ok = True)
+
+    def load(self):
+        '''
+            Load the predictions of a previous run with the same model and well layout
+
+            output:
+                predictions: pandas dictionary of the predicted frames, None if there are none
+        '''
+
+        parts = self.__get_parts()
+        manifest_file = os.path.join(self.__directory, 'manifest.json')
+
+        if not parts or not os.path.exists(manifest_file):
+            return None
+
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+        if manifest != self.__manifest:
+            print("Checkpoint in {} was made with another model or well layout, ignoring it".format(self.__directory))
+            return None
+
+        # new parts are numbered after the last existing one
+        self.__parts = int(os.path.basename(parts[-1])[len('part-'):-len('.parquet')]) + 1
+
+        return read_predictions(parts)
+
+    def clear(self):
+        '''
+            Remove all the parts and start a new checkpoint
+        '''
+
+        for part in self.__get_parts():
+            os.remove(part)
+        self.__parts = 0
+
+        with open(os.path.join(self.__directory, 'manifest.json'), 'w') as f:
+            json.dump(self.__manifest, f)
+
+    def write(self, predictions):
+        '''
+            Append predictions indexed by (frame, X-coord, Y-coord) as a new part
+        '''
+
+        filename = os.path.join(self.__directory, 'part-{:05d}.parquet'.format(self.__parts))
+        write_predictions(predictions, filename + '.tmp')
+        # the rename is atomic, a run killed while writing never leaves a truncated part
+        os.replace(filename + '.tmp', filename)
+        self.__parts += 1
+
+    def __get_parts(self):
+
+        return sorted(glob.glob(os.path.join(self.__directory, 'part-*.parquet')))
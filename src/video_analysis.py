@@ -1,13 +1,146 @@
+import concurrent.futures
 import errno
+import glob
 import os
+import queue
 import random
+import shutil
+import tempfile
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
-from read_data import Data
+from read_data import Data, crop_frame, reduce_image
+from storage import read_wells, write_wells
+
+
+# well layouts are cached with a grayscale thumbnail of the plate at 1/THUMBNAIL_SCALE
+THUMBNAIL_SCALE = 4
+
+def get_fingerprint(gray):
+    '''
+        Perceptual (difference) hash of an image: 64 bits telling whether each pixel
+        of a 9x8 thumbnail is brighter than its right neighbour. Changes of exposure,
+        JPEG noise or the fish inside the wells barely change it
+
+        input :
+            gray : grayscale image
+
+        output :
+            fingerprint : 64 bit integer
+    '''
+
+    small = cv2.resize(gray, (9, 8), interpolation = cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+
+    return int.from_bytes(bits.tobytes(), 'big')
+
+def get_shift(reference, gray):
+    '''
+        Translation between two grayscale images of the same size by phase correlation
+
+        output :
+            (dx, dy) : sub-pixel shift of gray relative to reference
+    '''
+
+    window = np.outer(np.hanning(reference.shape[0]), np.hanning(reference.shape[1]))
+    cross = np.fft.fft2(window * gray) * np.conj(np.fft.fft2(window * reference))
+    correlation = np.fft.ifft2(cross / np.maximum(np.abs(cross), 1e-9)).real
+
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+
+    shift = []
+    for axis, size in enumerate(correlation.shape):
+        # refine the peak with a parabola through its neighbours, the correlation wraps around
+        before, after = list(peak), list(peak)
+        before[axis], after[axis] = (peak[axis] - 1) % size, (peak[axis] + 1) % size
+        c0, c1, c2 = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+        offset = 0.5 * (c0 - c2) / (c0 - 2*c1 + c2) if (c0 - 2*c1 + c2) != 0 else 0.0
+
+        position = peak[axis] + offset
+        shift.append(position - size if position > size / 2 else position)
+
+    return shift[1], shift[0]
+
+def get_lattice_index(values, gap):
+    '''
+        Lattice index of 1D coordinates: sorted coordinates further apart than gap
+        start a new cluster, and clusters are numbered by their distance to the
+        first one in lattice steps, so an entirely missed row or column keeps its number
+
+        output :
+            index : integer index of each coordinate, starting at 0
+    '''
+
+    order = np.argsort(values, kind = 'stable')
+    clusters = np.empty(len(values), dtype = np.int64)
+    clusters[order] = np.concatenate([[0], np.cumsum(np.diff(values[order]) > gap)])
+
+    centers = np.bincount(clusters, weights = values) / np.bincount(clusters)
+    if len(centers) == 1:
+        return clusters
+
+    # the median step is the lattice step as long as less than half of the rows (or columns) are missed
+    step = np.median(np.diff(centers))
+
+    return np.rint((centers - centers[0]) / step).astype(np.int64)[clusters]
+
+def label_wells(circles, fill_missing = True):
+    '''
+        Label detected circles with the column (well_id_x) and row (well_id_y) of the plate
+
+        The centers are clustered into columns and rows (see get_lattice_index), then a
+        lattice center = origin + column * column_step + row * row_step is fitted to them
+        by least squares, which also holds for a slightly rotated plate. Circles far from
+        their lattice point, or sharing it with a closer circle, are not wells
+
+        input :
+            circles : array of (center_x, center_y, radius) of the detected circles
+            fill_missing : add the wells missed by the detection at their lattice point
+
+        output :
+            wells : pandas dictionary of wells indexed by (well_id_x, well_id_y),
+                    all with the median radius (see analysis.detect_wells)
+    '''
+
+    circles = np.asarray(circles, dtype = np.float64).reshape(-1, 3)
+    centers, radius = circles[:, :2], np.median(circles[:, 2])
+
+    columns = get_lattice_index(centers[:, 0], radius)
+    rows = get_lattice_index(centers[:, 1], radius)
+
+    design = np.column_stack([np.ones(len(circles)), columns, rows])
+    lattice, _, _, _ = np.linalg.lstsq(design, centers, rcond = None)
+    distance = np.hypot(*(centers - design @ lattice).T)
+
+    # keep the closest circle to each lattice point, within half a radius of it
+    keys = columns * (rows.max() + 1) + rows
+    order = np.lexsort((distance, keys))
+    first = np.concatenate([[True], np.diff(keys[order]) != 0])
+    keep = order[first & (distance[order] < radius / 2)]
+    columns, rows, centers = columns[keep], rows[keep], centers[keep]
+
+    if fill_missing:
+        grid_columns, grid_rows = np.meshgrid(np.arange(columns.max() + 1), np.arange(rows.max() + 1), indexing = 'ij')
+        missing = np.ones(grid_columns.shape, dtype = bool)
+        missing[columns, rows] = False
+        if missing.any():
+            print("Filling {} wells missed by the detection".format(int(missing.sum())))
+            filled = np.column_stack([np.ones(missing.sum()), grid_columns[missing], grid_rows[missing]])
+            columns = np.concatenate([columns, grid_columns[missing]])
+            rows = np.concatenate([rows, grid_rows[missing]])
+            centers = np.concatenate([centers, filled @ lattice])
+
+    order = np.lexsort((rows, columns))
+    wells = pd.DataFrame({'well_id_x': columns[order].astype(np.float64),
+                          'well_id_y': rows[order].astype(np.float64),
+                          'center_x': centers[order, 0],
+                          'center_y': centers[order, 1],
+                          'radius': np.ceil(radius)})
+
+    return wells.set_index(['well_id_x', 'well_id_y'])
 
 
 class analysis:
@@ -25,8 +158,9 @@ class analysis:
             raise TypeError('Data_to_analyze is not of type Data')
 
         self.__Data = Data_to_analyze
+        self.__geometry = None
 
-    def detect_wells( self, R, image = None ):
+    def detect_wells( self, R, image = None, scale = 1 ):
         '''
             Detect all the wells which satisfy minRadius < well_radius < maxRadius
             using the HoughCircles method.
@@ -35,6 +169,9 @@ class analysis:
                 R = [minRadius, maxRadius]
                 image = specific image where the wells need to be detected
                         if (None) : take the first image from the folder
+                scale = 1, or 2, 4, 8 to detect the wells on an image reduced by scale
+                        (decoded at reduced scale if image is None). Radii and centers
+                        are returned in full resolution coordinates
             output :
                 wells : Pandas dataframe indicating well locations
                         DataFrame Discription :
@@ -48,45 +185,134 @@ class analysis:
 
         # initialize the image for well detection
         if image is None:
-            ret, image, _ = self.__Data.read()
+            ret, image, _ = self.__Data.read(scale = scale)
             if not ret:
                 print("Can't receive frame (stream end?). Exiting ...")
                 return None
             # reset the video to its initial frame
             self.__Data.reset()
+        else:
+            image = reduce_image(image, scale)
 
         # workflow for detecting wells
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        wells = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1, 150, minRadius = int(R[0]), maxRadius = int(R[1]))
-        wells = sorted(wells[0], key = lambda x: (x[0], x[1]))
-        wells = np.asarray(wells)
-
-        wells = np.append(np.zeros([len(wells), 2]), wells, axis = 1)
+        # the accumulator votes scale with the circumference, hence the threshold (default 100)
+        # wells cannot be closer than two radii, which lets dense plates (384, 1536 wells) be detected
+        wells = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1, min(150, 2 * R[0]) / scale, param2 = 100 / scale,
+                                 minRadius = int(R[0] / scale), maxRadius = int(np.ceil(R[1] / scale)))
+        if wells is None:
+            print("No wells detected")
+            return None
+        wells = wells[0]
+
+        if scale != 1:
+            # pixel i of the reduced image covers pixels [i*scale, (i+1)*scale) at full resolution
+            wells[:, :2] = wells[:, :2] * scale + (scale - 1) / 2
+            wells[:, 2] = wells[:, 2] * scale
 
         # HoughCircles detects each of the wells seperately,
         # However, it is nacessary to label the wells based on their (x, y) coordinates in the images
         # So that they can be directly referenced later
 
-        return self.__label_wells(wells)
+        return label_wells(wells)
+
+    def load_or_detect_wells(self, R, cache_dir, image = None, scale = 1, max_distance = 16, max_shift = 2):
+        '''
+            Reuse the wells detected on an earlier run of the same plate, detect them otherwise
+
+            Layouts are stored in cache_dir under a key made of the image size, the radius
+            range and a fingerprint of the plate (see get_fingerprint). A stored layout is
+            reused only if its fingerprint is close to the one of the image and the plate
+            has not moved by more than max_shift pixels since it was detected (see get_shift).
+            Otherwise the wells are detected (see detect_wells) and added to the cache
+
+            input :
+                R = [minRadius, maxRadius]
+                cache_dir = folder where the well layouts are stored
+                image = specific image where the wells need to be detected
+                        if (None) : take the first image from the folder
+                scale = scale the wells are detected at (see detect_wells)
+                max_distance = maximum number of differing fingerprint bits
+                max_shift = maximum displacement of the plate in pixels
+            output :
+                wells : Pandas dataframe indicating well locations (see detect_wells)
+        '''
+
+        if image is None:
+            ret, thumbnail, _ = self.__Data.read(scale = THUMBNAIL_SCALE)
+            if not ret:
+                print("Can't receive frame (stream end?). Exiting ...")
+                return None
+            self.__Data.reset()
+        else:
+            thumbnail = reduce_image(image, THUMBNAIL_SCALE)
+
+        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+        fingerprint = get_fingerprint(thumbnail)
+        key = '{}x{}_{}-{}'.format(thumbnail.shape[0], thumbnail.shape[1], int(R[0]), int(R[1]))
+
+        candidates = []
+        for entry in glob.glob(os.path.join(cache_dir, key + '_*')):
+            if not os.path.exists(os.path.join(entry, 'wells.csv')):
+                # left incomplete by an earlier version
+                continue
+            distance = bin(fingerprint ^ int(entry.rsplit('_', 1)[1], 16)).count('1')
+            if distance <= max_distance:
+                candidates.append((distance, entry))
+
+        for _, entry in sorted(candidates):
+            reference = cv2.imread(os.path.join(entry, 'thumbnail.png'), cv2.IMREAD_GRAYSCALE)
+            dx, dy = get_shift(reference, thumbnail)
+            if np.hypot(dx, dy) * THUMBNAIL_SCALE <= max_shift:
+                print("Reusing the wells detected in {}".format(entry), flush = True)
+                return read_wells(os.path.join(entry, 'wells.csv'))
+
+        wells = self.detect_wells(R, image = image, scale = scale)
+        if wells is None:
+            return None
+
+        # the entry is written to a hidden folder and renamed once complete, so that
+        # an interrupted run or another worker never leaves a partial entry
+        entry = os.path.join(cache_dir, '{}_{:016x}'.format(key, fingerprint))
+        os.makedirs(cache_dir, exist_ok = True)
+        partial = tempfile.mkdtemp(prefix = '.', dir = cache_dir)
+        cv2.imwrite(os.path.join(partial, 'thumbnail.png'), thumbnail)
+        write_wells(wells, os.path.join(partial, 'wells.csv'))
+
+        if os.path.isdir(entry) and not os.path.exists(os.path.join(entry, 'wells.csv')):
+            shutil.rmtree(entry, ignore_errors = True)
+        try:
+            os.rename(partial, entry)
+        except OSError:
+            # another worker stored the same plate first
+            shutil.rmtree(partial, ignore_errors = True)
 
-    def plot_wells(self, wells, image = None, img_file = None, R = []):
+        return wells
+
+    def plot_wells(self, wells, image = None, img_file = None, R = [], scale = 1):
         '''
             Once you've detected the wells you can plot them using this function
 
             input :
                 wells : pandas dictionary of detected wells
                 image : specific image on which wells are to be plotted
+                scale : 1, or 2, 4, 8 to plot on an image reduced by scale,
+                        which is enough for an overview and much faster to decode
         '''
 
         if image is None:
-            ret, image, _ = self.__Data.read()
+            ret, image, _ = self.__Data.read(scale = scale)
             if not ret:
                 print("Can't receive frame (stream end?). Exiting ...")
                 return None
             # reset the video to its initial frame
             self.__Data.reset()
+        else:
+            image = reduce_image(image, scale)
 
         wells = wells[['center_x', 'center_y', 'radius']].to_numpy()
+        wells[:, :2] = (wells[:, :2] - (scale - 1) / 2) / scale
+        wells[:, 2] = wells[:, 2] / scale
 
         fig, ax = plt.subplots(figsize = (12, 12))
         ax.imshow(image)
@@ -102,13 +328,21 @@ class analysis:
         plt.show()
 
 
-    def crop_to_video(self, wells, crop_dir = None, no_wells_to_record = 6):
+    def crop_to_video(self, wells, crop_dir = None, no_wells_to_record = 6, wells_to_record = None, workers = 1):
         '''
             Crop each of the wells into single images and write them as a video
 
+            The frames are decoded once for all the videos (from the crop cache if the
+            data has one, see Data.use_crop_cache) and the videos are encoded by worker
+            threads, each writing its share of the wells
+
             input :
                 wells : pandas dictionary of detected wells
                 crop_dir : locations where the videos are to be stored
+                no_wells_to_record : number of randomly chosen wells to record, None records every well
+                wells_to_record : list of (well_id_x, well_id_y) of the wells to record,
+                                  instead of randomly chosen ones
+                workers : number of threads encoding the videos
 
             output :
                 filenames : locations of all filenames
@@ -125,104 +359,146 @@ class analysis:
             if e.errno != errno.EEXIST:
                 raise e
 
-        well_no = 0
-        VideoWriter = {}
-        height, width, channels = self.__Data.get_shape()
-        size = (height, width)
+        well_ind, bounds = self.get_crop_geometry(wells)
+        positions = {well: i for i, well in enumerate(well_ind)}
+
+        if wells_to_record is not None:
+            missing = [well for well in wells_to_record if tuple(well) not in positions]
+            if missing:
+                raise ValueError('Wells {} were not detected'.format(missing))
+            recorded = [positions[tuple(well)] for well in wells_to_record]
+        elif no_wells_to_record is None:
+            recorded = list(range(len(well_ind)))
+        else:
+            recorded = [positions[well] for well in random.sample(well_ind, no_wells_to_record)]
 
         # create videowriter elements foreach of the wells
         filenames = []
-        random_wells = random.sample(wells.index.values.tolist(), no_wells_to_record)
-        for well_ind in random_wells:
-            filename = os.path.join(path,
-                                    '{:02d}_{:02d}.avi'.format(int(well_ind[0]), int(well_ind[1])))
+        writers = []
+        for i in recorded:
+            top, bottom, left, right = bounds[i]
+            filename = os.path.join(path, '{:02d}_{:02d}.avi'.format(int(well_ind[i][0]), int(well_ind[i][1])))
             filenames.append(filename)
-            VideoWriter[well_ind] = cv2.VideoWriter(filename,
-                                                    cv2.VideoWriter_fourcc(*'DIVX'),
-                                                    10,
-                                                    (2*int(wells.loc[well_ind]['radius']),
-                                                    2*int(wells.loc[well_ind]['radius'])))
+            writers.append(cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'DIVX'), 10, (right - left, bottom - top)))
 
         print ('Saving cropped images in {} as a videos'.format(path))
 
-        self.__Data.reset()
-        while (True):
-            ret, image, _ = self.__Data.read()
-            if not ret:
-                print("Can't receive frame (stream end?). Exiting ...")
-                break
-
-            for well_ind in random_wells:
-                xc, yc, r = wells.loc[well_ind]
-                cropped = image[int(yc)-int(r):int(yc)+int(r), int(xc)-int(r):int(xc)+int(r), :]
-                VideoWriter[well_ind].write(cropped)
-
-        for _, w in VideoWriter.items():
+        def encode(shares, frames):
+            # the frames of a video are written in order by a single thread
+            while True:
+                crops = frames.get()
+                if crops is None:
+                    return
+                for i, writer in shares:
+                    writer.write(crops[i])
+
+        workers = max(1, min(workers, len(writers)))
+        queues = [queue.Queue(maxsize = 4) for _ in range(workers)]
+        shares = list(zip(recorded, writers))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(encode, shares[i::workers], queues[i]) for i in range(workers)]
+
+            def put(crops):
+                for frames, future in zip(queues, futures):
+                    while True:
+                        try:
+                            frames.put(crops, timeout = 0.1)
+                            break
+                        except queue.Full:
+                            if future.done():
+                                # raises the error which stopped the worker
+                                future.result()
+
+            try:
+                self.__Data.reset()
+                while (True):
+                    # a new array every frame, the workers may still be encoding the previous ones
+                    ret, crops, _ = self.__Data.read_wells(bounds)
+                    if not ret:
+                        break
+                    put(crops)
+            finally:
+                put(None)
+
+        for future in futures:
+            future.result()
+
+        for w in writers:
             w.release()
 
-        print('Wrote {} videos to {}'.format(len(VideoWriter), path))
+        print('Wrote {} videos to {}'.format(len(writers), path))
 
         self.__Data.reset()
 
         return filenames
 
-    def crop_wells(self, wells, image):
+    def get_crop_geometry(self, wells):
         '''
-            crop each well and return a numpy array
+            Pixel bounds of each well, computed once per plate layout so that
+            cropping a frame needs no pandas lookups
 
             input :
                 wells : pandas dictionary of detected wells
-                image : image to be cropped
 
             output :
-                cropped_wells : a numpy array of cropped images
+                well_ind : list of well indices
+                bounds : list of (top, bottom, left, right) pixel bounds of each well
         '''
 
-        cropped_images = np.full((len(wells.index), 2*int(wells.loc[(0, 0)]['radius']),
-                                        2*int(wells.loc[(0, 0)]['radius']), 3), 0)
+        if self.__geometry is not None and self.__geometry[0] is wells:
+            return self.__geometry[1], self.__geometry[2]
+
+        xc = wells['center_x'].to_numpy().astype(int)
+        yc = wells['center_y'].to_numpy().astype(int)
+        r = wells['radius'].to_numpy().astype(int)
 
-        for i, well_ind in enumerate(wells.index.values.tolist()):
-            xc, yc, r = wells.loc[well_ind]
-            cropped = image[int(yc)-int(r):int(yc)+int(r), int(xc)-int(r):int(xc)+int(r), :]
-            cropped_images[i, :, :, :] = cropped
+        well_ind = wells.index.values.tolist()
+        bounds = list(zip((yc - r).tolist(), (yc + r).tolist(), (xc - r).tolist(), (xc + r).tolist()))
 
-        return wells.index.values.tolist(), cropped_images
+        self.__geometry = (wells, well_ind, bounds)
 
-    def __label_wells(self, wells):
+        return well_ind, bounds
+
+    def get_crop_buffer(self, wells, frames = None, dtype = np.uint8):
         '''
-            Label the (x, y) coordinates for each well
+            Allocate an array that cropped wells can be written into (see crop_wells)
 
             input :
                 wells : pandas dictionary of detected wells
+                frames : number of frames held by the buffer, None for a single frame
+                dtype : dtype of the buffer, uint8 for raw pixels or the model input dtype
 
             output :
-                wells : pandas dictionary with labelled wells
+                buffer : uninitialized array of shape ([frames,] wells, 2r, 2r, 3)
         '''
 
+        size = 2*int(wells['radius'].iloc[0])
+        shape = (len(wells.index), size, size, 3)
+        if frames is not None:
+            shape = (frames,) + shape
 
-        x_ref = wells[0, 2]; y_ref= wells[0, 3]; r_ref = wells[0, 4]
-        x_ind = np.nonzero((wells[:, 2] > x_ref - r_ref) & (wells[:, 2] < x_ref + r_ref))[0]
-        y_ind = np.nonzero((wells[:, 3] > y_ref - r_ref) & (wells[:, 3] < y_ref + r_ref))[0]
-
-        median_x = []
-        median_y = []
+        return np.empty(shape, dtype = dtype)
 
-        for index in x_ind:
-            median = np.median(wells[(wells[:, 3] > (wells[index, 3] - r_ref)) & (wells[:, 3] < (wells[index, 3] + r_ref)), 3])
-            wells[(wells[:, 3] > (wells[index, 3] - r_ref)) & (wells[:, 3] < (wells[index, 3] + r_ref)), 1] = median
-            median_y.append(median)
+    def crop_wells(self, wells, image, out = None):
+        '''
+            crop each well and return a numpy array
 
-        for index in y_ind:
-            median = np.median(wells[(wells[:, 2] > (wells[index, 2] - r_ref)) & (wells[:, 2] < (wells[index, 2] + r_ref)), 2])
-            wells[(wells[:, 2] > (wells[index, 2] - r_ref)) & (wells[:, 2] < (wells[index, 2] + r_ref)), 0] = median
-            median_x.append(median)
+            input :
+                wells : pandas dictionary of detected wells
+                image : image to be cropped
+                out : preallocated array the wells are written into (see get_crop_buffer),
+                      reusing it avoids any allocation per frame. A new uint8 array is
+                      allocated if None
 
-        wells = pd.DataFrame(wells, columns=['well_id_x', 'well_id_y', 'center_x', 'center_y', 'radius'])
+            output :
+                well_ind : list of well indices
+                cropped_wells : a numpy array of cropped images
+        '''
 
-        wells.replace({'well_id_x' : dict(zip(sorted(median_x), np.arange(0, len(median_x), 1, dtype = np.int16)))}, inplace = True)
-        wells.replace({'well_id_y' : dict(zip(sorted(median_y), np.arange(0, len(median_y), 1, dtype = np.int16)))}, inplace = True)
-        wells['radius'] = np.ceil(wells['radius'].median())
+        well_ind, bounds = self.get_crop_geometry(wells)
 
-        wells.set_index(['well_id_x', 'well_id_y'], inplace = True)
+        if out is None:
+            out = self.get_crop_buffer(wells)
 
-        return wells
+        return well_ind, crop_frame(image, bounds, out)
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+# Fixtures shared by the tests, run from this folder
+
+# the synthetic plates, predictions and stub model are the ones of the benchmarks
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../benchmarks'))
+
+
+@pytest.fixture
+def make_predictions():
+    '''
+        Builder of predictions of 4 wells for a list of consecutive frames, the same
+        for the same frames so that saved and expected predictions compare
+    '''
+    from synthetic import get_predictions
+
+    return lambda frames: get_predictions(len(frames), 4, seed = frames[0], first_frame = frames[0])
+
+@pytest.fixture(scope = 'session')
+def model_path(tmp_path_factory):
+    '''
+        Frozen graph with the input/output names of an exported DLC model,
+        predicting 3 body parts from simple statistics of each crop
+    '''
+    pytest.importorskip('tensorflow')
+
+    from synthetic import write_stub_model
+
+    return write_stub_model(str(tmp_path_factory.mktemp('model') / 'model.pb'))
+
+@pytest.fixture(scope = 'session')
+def write_plate_images():
+    '''
+        Writer of sequences of 96 well plate images with randomly placed spots
+    '''
+    def write_images(folder, frames, rng):
+
+        for i in range(1, frames + 1):
+            image = np.full((1460, 2180, 3), 30, dtype = np.uint8)
+            for row in range(8):
+                for column in range(12):
+                    cv2.circle(image, (100 + 180*column, 100 + 180*row), 70, (200, 200, 200), 4, cv2.LINE_AA)
+            for _ in range(50):
+                cv2.circle(image, (int(rng.integers(100, 2080)), int(rng.integers(100, 1360))), 6,
+                           (int(rng.integers(0, 255)),)*3, -1)
+            cv2.imwrite(os.path.join(str(folder), 'IMG_{:04d}.JPG'.format(i)), image)
+
+        return os.path.join(str(folder), 'IMG_%04d.JPG')
+
+    return write_images
@@ -0,0 +1,120 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+sys.path.append(os.path.join(os.getcwd(), '../benchmarks'))
+
+import synthetic
+from data_analysis import THRESHOLDS, analyze_df, analyze_df_vectorized, analyze_stream, summarize, summarize_results
+from storage import compact_results, read_results
+
+def get_predictions(frames = 6, wells = 384, missing = 25, dtype = np.float32, seed = 0):
+    '''
+        Synthetic predictions with the area the outlier filter adds, and their wells
+    '''
+    predictions = synthetic.get_predictions(frames, wells, seed = seed, missing = missing, dtype = dtype)
+    predictions['area'] = 1.0
+
+    return predictions, synthetic.get_wells(wells)
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('missing', [0, 25])
+def test_analyze_df_vectorized(dtype, missing):
+
+    predictions, wells = get_predictions(missing = missing, dtype = dtype)
+
+    reference = analyze_df(predictions.copy(), wells, starting_image = 3)
+    observations = analyze_df_vectorized(predictions, wells, starting_image = 3)
+
+    pd.testing.assert_frame_equal(observations, reference, check_exact = True)
+
+def test_analyze_df_vectorized_thresholds():
+
+    predictions, wells = get_predictions(frames = 250)
+
+    reference = analyze_df_vectorized(predictions, wells, starting_image = 0)
+    pd.testing.assert_frame_equal(analyze_df_vectorized(predictions, wells, 0, thresholds = THRESHOLDS), reference)
+
+    observations = analyze_df_vectorized(predictions, wells, 0, thresholds = {'burst': 50, 'edge': 80, 'period': 50})
+    speed = observations['Speed']
+
+    assert (observations['Burst'].dropna() == np.where(speed.dropna() > 50, 100, 0)).all()
+    assert (observations['Scoot'].dropna() == np.where((speed.dropna() > 3) & (speed.dropna() < 50), 100, 0)).all()
+    assert (observations['p_Edge'] == np.where(observations['Edge'] > 80, 100, 0)).all()
+    assert (observations['Period'] == observations['Image'] // 50 + 1).all()
+    pd.testing.assert_series_equal(observations['Move'], reference['Move'])
+
+    with pytest.raises(ValueError):
+        analyze_df_vectorized(predictions, wells, 0, thresholds = {'scoot': 5})
+
+def test_analyze_df_vectorized_nan():
+
+    predictions, wells = get_predictions(frames = 3, missing = 0)
+    predictions.loc[2, :, :] = np.nan
+
+    observations = analyze_df_vectorized(predictions, wells, starting_image = 0)
+
+    assert observations['Up'].isna().sum() == len(wells)
+    assert observations['Speed'].isna().sum() == 3 * len(wells)
+    assert observations['Turn'].isna().sum() == 3 * len(wells)
+    assert (observations.loc[observations['Image'] == 2, 'Upw'] == 0).all()
+
+@pytest.mark.parametrize('chunk_frames', [1, 4, 10])
+@pytest.mark.parametrize('missing', [0, 25])
+def test_analyze_stream(tmp_path, chunk_frames, missing):
+
+    predictions, wells = get_predictions(missing = missing)
+
+    analyze_df_vectorized(predictions, wells, starting_image = 3).to_csv(tmp_path / 'batch.csv')
+    rows = analyze_stream(predictions, wells, 3, str(tmp_path / 'stream.csv'), chunk_frames = chunk_frames)
+
+    assert rows == len(predictions)
+    assert (tmp_path / 'stream.csv').read_text() == (tmp_path / 'batch.csv').read_text()
+
+@pytest.mark.parametrize('format', ['parquet', 'feather'])
+def test_analyze_stream_compact(tmp_path, format):
+
+    predictions, wells = get_predictions()
+    filename = str(tmp_path / ('results.' + format))
+
+    analyze_stream(predictions, wells, 3, filename, chunk_frames = 4, format = format)
+    observations = read_results(filename)
+
+    expected = compact_results(analyze_df_vectorized(predictions, wells, starting_image = 3))
+    pd.testing.assert_frame_equal(observations, expected, check_exact = True)
+    assert observations['Move'].dtype == 'Int8'
+    assert observations['X'].dtype == np.float32
+
+def test_summarize():
+
+    predictions, wells = get_predictions(frames = 250, wells = 12)
+    observations = analyze_df_vectorized(predictions, wells, starting_image = 0)
+
+    summary = summarize(observations)
+
+    grouped = observations.groupby(['Well', 'Period'])
+    assert len(summary) == 12 * 3
+    assert (summary['Frames'] == grouped.size()).all()
+    for column in ['Move', 'Up', 'Burst', 'Speed']:
+        np.testing.assert_allclose(summary[column], grouped[column].mean())
+    np.testing.assert_allclose(summary['Tabs'], grouped['Tabs'].sum())
+
+@pytest.mark.parametrize('format', ['csv', 'parquet', 'feather'])
+def test_summarize_stream(tmp_path, format):
+
+    predictions, wells = get_predictions(frames = 250, wells = 12)
+    filename = str(tmp_path / ('results.' + format))
+
+    analyze_stream(predictions, wells, 0, filename, chunk_frames = 30, format = format,
+                   summary_file = str(tmp_path / 'summary.csv'))
+
+    expected = summarize(analyze_df_vectorized(predictions, wells, starting_image = 0))
+    streamed = pd.read_csv(tmp_path / 'summary.csv', index_col = ['Well', 'Period'])
+
+    pd.testing.assert_frame_equal(streamed, expected, check_exact = False, check_dtype = False)
+    pd.testing.assert_frame_equal(summarize_results(filename, chunk_rows = 500), expected,
+                                  check_exact = False, check_dtype = False, rtol = 1e-5)
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+
+from pipeline import pipeline
+
+def get_pipeline(fail_at = None):
+
+    def source(_):
+        yield from range(100)
+
+    def square(items):
+        for item in items:
+            if item == fail_at:
+                raise ValueError('stage failed')
+            yield item**2
+
+    def pairs(items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == 2:
+                yield tuple(batch)
+                batch = []
+
+    runner = pipeline(queue_size = 2)
+    runner.add_stage('source', source)
+    runner.add_stage('square', square)
+    runner.add_stage('pairs', pairs)
+
+    return runner
+
+def test_run():
+
+    runner = get_pipeline()
+    results = runner.run()
+
+    assert results == [(i**2, (i + 1)**2) for i in range(0, 100, 2)]
+
+    report = runner.report()
+    assert report['square']['items'] == 100
+    assert report['pairs']['items'] == 50
+    assert report['pairs']['max_queue_depth'] <= 2
+
+def test_run_error():
+
+    runner = get_pipeline(fail_at = 42)
+
+    with pytest.raises(ValueError):
+        runner.run()
+
+def test_busy_time():
+
+    def source(_):
+        yield from range(20)
+
+    def fast(items):
+        for item in items:
+            time.sleep(0.01)
+            yield item
+
+    def slow(items):
+        for item in items:
+            time.sleep(0.05)
+            yield item
+
+    runner = pipeline(queue_size = 4)
+    runner.add_stage('source', source)
+    runner.add_stage('fast', fast)
+    runner.add_stage('slow', slow)
+    runner.run()
+
+    # the time waiting on the slow stage is not busy, and only subtracted once
+    for name, stats in runner.stats.items():
+        assert 0 <= stats['busy'] <= stats['wall']
+    assert 0.15 <= runner.stats['fast']['busy'] < 0.5
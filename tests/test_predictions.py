@@ -0,0 +1,144 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+
+pytest.importorskip('tensorflow.compat.v1')
+
+from predictions import BODY_PARTS, convert_to_onnx, filter_outliers, hold_out_crops, predict, quantize_model
+from read_data import Data
+from video_analysis import analysis
+
+@pytest.fixture(scope = 'module')
+def images(tmp_path_factory, write_plate_images):
+    '''
+        Sequence of 96 well plate images with randomly placed spots
+    '''
+    return write_plate_images(tmp_path_factory.mktemp('images'), 7, np.random.default_rng(0))
+
+def test_predict_batch(images, model_path):
+
+    data = Data(images)
+    experiment = analysis(data)
+    wells = experiment.detect_wells(R = [60, 80])
+    infer = predict(data, experiment, model_path)
+
+    batch = experiment.get_crop_buffer(wells, frames = 5)
+    for i in range(5):
+        _, image, _ = data.read()
+        well_ind, _ = experiment.crop_wells(wells, image, out = batch[i])
+
+    engine = infer.get_engine()
+    single = [infer.predict_batch(well_ind, batch[i:i+1], engine)[0] for i in range(5)]
+    batched = infer.predict_batch(well_ind, batch, engine)
+    infer.close()
+
+    assert len(batched) == 5
+    for reference, predicted_image in zip(single, batched):
+        pd.testing.assert_frame_equal(predicted_image, reference, check_exact = True)
+
+def test_predict_frames(images, model_path):
+
+    data = Data(images)
+    experiment = analysis(data)
+    wells = experiment.detect_wells(R = [60, 80])
+
+    with predict(data, experiment, model_path) as infer:
+        predictions = infer.predict(wells, batch_size = 2)
+        engine = infer.get_engine()
+
+        frames = []
+        for i in [3, 1, 2]:
+            data.seek(i - 1)
+            frames.append(data.read()[1])
+        predicted_images = list(infer.predict_frames(wells, frames, batch_size = 2))
+        single = infer.predict(wells, image = frames[0])
+
+        # the engine stays warm between calls
+        assert infer.get_engine() is engine
+
+    columns = predicted_images[0].columns
+    for frame, predicted_image in zip([3, 1, 2], predicted_images):
+        pd.testing.assert_frame_equal(predicted_image, predictions.loc[frame, columns], check_names = False, check_exact = True)
+    pd.testing.assert_frame_equal(single, predicted_images[0], check_exact = True)
+
+def test_filter_outliers():
+
+    index = pd.MultiIndex.from_tuples([(frame, x, y) for frame in range(1, 6) for x, y in [(0.0, 0.0), (0.0, 1.0)]],
+                                      names = ['frame', 'X-coord', 'Y-coord'])
+    predictions = pd.DataFrame({'yolk_x': 1.0, 'area': [10.0, 1.0, 11.0, 1.0, 12.0, 1.0, 50.0, 1.0, 9.0, 1.0]}, index = index)
+
+    unfiltered = filter_outliers(predictions.copy())
+    assert not unfiltered.isna().any().any()
+
+    filtered = filter_outliers(predictions.copy(), mad_bounds = (3, 3))
+    assert filtered.isna().all(axis = 1).tolist() == [False]*6 + [True] + [False]*3
+
+def test_predict_frame_range(images, model_path):
+
+    data = Data(images)
+    experiment = analysis(data)
+    wells = experiment.detect_wells(R = [60, 80])
+    infer = predict(data, experiment, model_path)
+
+    predictions = infer.predict(wells, batch_size = 2)
+    shards = [infer.predict(wells, batch_size = 2, frame_range = frame_range) for frame_range in [(1, 3), (4, 7)]]
+
+    pd.testing.assert_frame_equal(pd.concat(shards), predictions, check_exact = True)
+
+def test_onnx_engine(images, model_path, tmp_path):
+
+    pytest.importorskip('tf2onnx')
+    pytest.importorskip('onnxruntime')
+
+    onnx_path = convert_to_onnx(model_path, str(tmp_path / 'model.onnx'))
+
+    data = Data(images)
+    experiment = analysis(data)
+    wells = experiment.detect_wells(R = [60, 80])
+
+    reference = predict(data, experiment, model_path).predict(wells, batch_size = 2)
+    predictions = predict(data, experiment, onnx_path, intra_op_threads = 1, inter_op_threads = 1).predict(wells, batch_size = 2)
+
+    pd.testing.assert_frame_equal(predictions, reference, check_exact = False, rtol = 1e-5, atol = 1e-3)
+
+@pytest.mark.parametrize('frames, held_out', [(16, [3, 7, 11, 15]), (3, [2]), (1, [])])
+def test_hold_out_crops(frames, held_out):
+
+    crops = np.arange(frames*5).reshape(frames*5, 1, 1, 1) // 5
+
+    calibration_crops, held_out_crops = hold_out_crops(crops, 5)
+
+    assert sorted(set(held_out_crops.ravel())) == held_out
+    assert sorted(set(calibration_crops.ravel())) == sorted(set(range(frames)) - set(held_out))
+    assert len(calibration_crops) + len(held_out_crops) == frames*5
+
+@pytest.mark.parametrize('mode', ['int8', 'float16'])
+def test_quantize_model(images, model_path, tmp_path, mode):
+
+    pytest.importorskip('tf2onnx')
+    pytest.importorskip('onnxruntime')
+
+    onnx_path = convert_to_onnx(model_path, str(tmp_path / 'model.onnx'))
+
+    data = Data(images)
+    experiment = analysis(data)
+    wells = experiment.detect_wells(R = [60, 80])
+    infer = predict(data, experiment, onnx_path)
+
+    crops = infer.get_calibration_crops(wells, frames = 3)
+    assert crops.shape == (3*96, 140, 140, 3)
+
+    quantized_path = quantize_model(onnx_path, crops, mode = mode)
+    assert quantized_path == str(tmp_path / 'model.{}.onnx'.format(mode))
+    # the model is written to a temporary file first
+    assert not [filename for filename in os.listdir(str(tmp_path)) if filename.endswith('.tmp')]
+
+    deviation = infer.get_deviation_report(quantized_path, crops)
+    assert deviation.index.tolist() == BODY_PARTS
+    # the keypoints of the toy model are pixel statistics in [0, 255]
+    assert (deviation['max_px'] < 2).all()
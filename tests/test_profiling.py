@@ -0,0 +1,47 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+
+from profiling import NO_PROFILER, profiler
+
+def slow(items, seconds):
+    for item in items:
+        time.sleep(seconds)
+        yield item
+
+def test_profiler(tmp_path):
+
+    stages = profiler()
+    source = stages.wrap('source', slow(range(5), 0.01))
+    results = list(stages.wrap('double', (2 * item for item in slow(source, 0.02))))
+    with stages.stage('after'):
+        time.sleep(0.01)
+    stages.add_frames(len(results))
+
+    assert results == [0, 2, 4, 6, 8]
+
+    # the nested source is not counted in the consuming stage
+    metrics = stages.get_metrics()
+    assert metrics['stages']['source']['calls'] == 5
+    assert metrics['stages']['source']['seconds'] == pytest.approx(0.05, abs = 0.02)
+    assert metrics['stages']['double']['seconds'] == pytest.approx(0.10, abs = 0.03)
+    assert metrics['stages']['after']['ms_per_frame'] == pytest.approx(2, abs = 1)
+    assert metrics['frames'] == 5
+
+    stages.write(str(tmp_path / 'metrics.json'))
+    with open(tmp_path / 'metrics.json') as f:
+        assert json.load(f)['stages'].keys() == metrics['stages'].keys()
+
+def test_disabled_profiler():
+
+    items = iter(range(3))
+
+    assert NO_PROFILER.wrap('source', items) is items
+    with NO_PROFILER.stage('after'):
+        pass
+    assert NO_PROFILER.stages == {}
@@ -0,0 +1,196 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+
+import read_data
+from read_data import Data
+
+@pytest.fixture(scope = 'module')
+def images(tmp_path_factory):
+    '''
+        Sequence of distinct random images starting at IMG_0001.JPG
+    '''
+    folder = tmp_path_factory.mktemp('images')
+    rng = np.random.default_rng(0)
+    for i in range(1, 10):
+        cv2.imwrite(str(folder / 'IMG_{:04d}.JPG'.format(i)), rng.integers(0, 255, (120, 160, 3), dtype = np.uint8))
+
+    return str(folder / 'IMG_%04d.JPG')
+
+def read_all(data):
+
+    frames = []
+    while True:
+        ret, frame, frame_no = data.read()
+        if not ret:
+            return frames
+        frames.append((frame_no, frame))
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_parallel_read(images, backend):
+
+    reference = Data(images)
+    data = Data(images, workers = 3, prefetch = 4, backend = backend)
+
+    assert data.get_total_frames() == reference.get_total_frames() == 9
+    assert data.get_shape() == reference.get_shape()
+
+    expected = read_all(reference)
+    frames = read_all(data)
+
+    assert [frame_no for frame_no, _ in frames] == list(range(1, 10))
+    assert [frame_no for frame_no, _ in frames] == [frame_no for frame_no, _ in expected]
+    for (_, frame), (_, expected_frame) in zip(frames, expected):
+        assert (frame == expected_frame).all()
+
+    data.reset()
+    data.read()
+    ret, frame, frame_no = data.read()
+
+    assert ret
+    assert frame_no == 2
+    assert (frame == expected[1][1]).all()
+
+    data.close()
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_read_reduced(images, workers):
+
+    data = Data(images, workers = workers)
+
+    ret, frame, frame_no = data.read(scale = 4)
+    assert ret
+    assert frame.shape == (30, 40, 3)
+    assert frame_no == 1
+
+    ret, frame, frame_no = data.read()
+    assert frame.shape == (120, 160, 3)
+    assert frame_no == 2
+
+    data.close()
+
+def test_read_reduced_decodes_no_full_frame(images, monkeypatch):
+
+    scales = []
+    def decode_image(filename, scale = 1):
+        scales.append(scale)
+        return cv2.imread(filename, read_data.REDUCED_COLOR[scale]) if scale != 1 else cv2.imread(filename)
+
+    monkeypatch.setattr(read_data, 'decode_image', decode_image)
+    data = Data(images, workers = 4)
+
+    for frame_no in (1, 2):
+        ret, frame, reduced_frame_no = data.read(scale = 4)
+        assert ret
+        assert reduced_frame_no == frame_no
+    assert scales == [4, 4]
+
+    ret, frame, frame_no = data.read()
+    assert frame_no == 3
+    assert frame.shape == (120, 160, 3)
+
+    data.close()
+
+@pytest.mark.parametrize('workers, backend', [(1, 'thread'), (3, 'thread'), (2, 'process')])
+def test_read_wells(images, workers, backend):
+
+    bounds = [(10, 42, 20, 52), (60, 92, 100, 132), (0, 32, 0, 32)]
+    reference = read_all(Data(images))
+    data = Data(images, workers = workers, backend = backend)
+
+    out = np.empty((3, 32, 32, 3), dtype = np.uint8)
+    for frame_no, frame in reference[:4]:
+        ret, cropped_wells, well_frame_no = data.read_wells(bounds, out = out)
+
+        assert ret
+        assert well_frame_no == frame_no
+        assert cropped_wells is out
+        for i, (top, bottom, left, right) in enumerate(bounds):
+            assert (cropped_wells[i] == frame[top:bottom, left:right]).all()
+
+    # switching back to full frames continues from the same position
+    ret, frame, frame_no = data.read()
+    assert frame_no == 5
+    assert (frame == reference[4][1]).all()
+
+    data.close()
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_crop_cache(images, tmp_path, monkeypatch, workers):
+
+    bounds = [(10, 42, 20, 52), (60, 92, 100, 132), (0, 32, 0, 32)]
+    reference = read_all(Data(images))
+
+    # a first pass stopped after 4 frames fills part of the cache
+    data = Data(images, workers = workers)
+    cache = data.use_crop_cache(str(tmp_path), bounds)
+    for _ in range(4):
+        data.read_wells(bounds)
+    data.close()
+    assert cache.get_cached_frames() == 4
+
+    data = Data(images, workers = workers)
+    cache = data.use_crop_cache(str(tmp_path), list(bounds))
+    assert cache.get_cached_frames() == 4
+
+    data.seek(2)
+    for frame_no, frame in reference[2:]:
+        ret, cropped_wells, well_frame_no = data.read_wells(bounds)
+
+        assert ret
+        assert well_frame_no == frame_no
+        for i, (top, bottom, left, right) in enumerate(bounds):
+            assert (cropped_wells[i] == frame[top:bottom, left:right]).all()
+    assert not data.read_wells(bounds)[0]
+    assert cache.get_cached_frames() == 9
+
+    # full frames still decode from the right position
+    data.seek(3)
+    ret, frame, frame_no = data.read()
+    assert frame_no == 4
+    assert (frame == reference[3][1]).all()
+    data.close()
+
+    # a complete cache is read without decoding anything
+    monkeypatch.setattr(read_data, 'decode_wells', None)
+    data = Data(images, workers = workers)
+    data.use_crop_cache(str(tmp_path), bounds)
+    if workers == 1:
+        monkeypatch.setattr(cv2.VideoCapture, 'read', None, raising = False)
+    out = np.empty((3, 32, 32, 3), dtype = np.uint8)
+    for frame_no, frame in reference:
+        ret, cropped_wells, well_frame_no = data.read_wells(bounds, out = out)
+        assert well_frame_no == frame_no
+        assert (cropped_wells[1] == frame[60:92, 100:132]).all()
+    data.close()
+
+def test_crop_cache_shared(images, tmp_path, monkeypatch):
+
+    bounds = [(10, 42, 20, 52), (60, 92, 100, 132)]
+    filenames = read_data.get_image_sequence(images)
+    crops = np.full((2, 32, 32, 3), 7, dtype = np.uint8)
+
+    first = read_data.crop_cache(str(tmp_path), filenames, 9, bounds)
+    first.write(1, crops)
+
+    # a worker started at the same time did not see the arrays yet
+    monkeypatch.setattr(read_data.os.path, 'exists', lambda path: False)
+    second = read_data.crop_cache(str(tmp_path), filenames, 9, bounds)
+    monkeypatch.undo()
+    second.write(2, crops + 1)
+
+    for cache in [first, second]:
+        assert cache.get_cached_frames() == 2
+        assert (cache.read(1) == crops).all()
+        assert (cache.read(2) == crops + 1).all()
+    # the arrays are shared, no temporary array is left behind
+    assert len(os.listdir(str(tmp_path))) == 2
+    assert not [filename for filename in os.listdir(str(tmp_path)) if '.tmp' in filename]
+
+    first.close()
+    second.close()
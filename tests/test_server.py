@@ -0,0 +1,103 @@
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+
+pytest.importorskip('tensorflow.compat.v1')
+
+from data_analysis import analyze_stream
+from predictions import predict
+from read_data import Data
+from server import server
+from storage import write_wells
+from video_analysis import analysis
+
+@pytest.fixture(scope = 'module')
+def experiments(tmp_path_factory, write_plate_images):
+    '''
+        Two experiment folders of 96 well plate images with randomly placed spots
+    '''
+    rng = np.random.default_rng(0)
+    folders = []
+    for experiment in range(2):
+        folder = tmp_path_factory.mktemp('experiment')
+        write_plate_images(folder, 4, rng)
+        folders.append(str(folder))
+
+    return folders
+
+def request(url, job = None):
+
+    data = json.dumps(job).encode() if job is not None else None
+    with urllib.request.urlopen(urllib.request.Request(url, data = data)) as response:
+        return json.loads(response.read())
+
+def test_server(experiments, model_path, tmp_path):
+
+    wells = analysis(Data(os.path.join(experiments[1], 'IMG_%04d.JPG'))).detect_wells(R = [60, 80])
+    write_wells(wells, str(tmp_path / 'wells.csv'))
+
+    inference = server(model_path, max_crops = 4*96)
+    http_server = inference.get_http_server(port = 0)
+    threading.Thread(target = http_server.serve_forever, daemon = True).start()
+    url = 'http://127.0.0.1:{}/jobs'.format(http_server.server_address[1])
+
+    try:
+        ids = [request(url, {'experiment_dir': folder, 'rmin': 60, 'rmax': 80}) ['id'] for folder in experiments]
+        frames = [os.path.join(experiments[1], 'IMG_{:04d}.JPG'.format(i)) for i in [3, 4]]
+        ids.append(request(url, {'frames': frames, 'wells_file': str(tmp_path / 'wells.csv')})['id'])
+
+        for _ in range(600):
+            states = [request(url + '/{}'.format(id))['state'] for id in ids]
+            if all(state in ('done', 'failed') for state in states):
+                break
+            time.sleep(0.1)
+        assert states == ['done']*3, request(url)
+
+        predicted = pd.DataFrame(request(url + '/{}/predictions'.format(ids[2])))
+        assert request(url)['inference']['frames'] == 10
+    finally:
+        http_server.shutdown()
+        inference.close()
+
+    for folder in experiments:
+        data = Data(os.path.join(folder, 'IMG_%04d.JPG'))
+        experiment = analysis(data)
+        wells = experiment.detect_wells(R = [60, 80])
+        with predict(data, experiment, model_path) as infer:
+            predictions = infer.predict(wells)
+        analyze_stream(predictions, wells, 0, str(tmp_path / 'results.csv'))
+
+        with open(os.path.join(folder, 'results.csv')) as served, open(str(tmp_path / 'results.csv')) as expected:
+            assert served.read() == expected.read()
+
+    # the frames of a batch are numbered by their position in the batch
+    expected = predictions.loc[[3, 4]].reset_index()
+    np.testing.assert_array_equal(predicted['frame'], expected['frame'] - 2)
+    np.testing.assert_array_equal(predicted[['X-coord', 'Y-coord']], expected[['X-coord', 'Y-coord']])
+    np.testing.assert_allclose(predicted[['yolk_x', 'yolk_y', 'area']], expected[['yolk_x', 'yolk_y', 'area']], rtol = 1e-6)
+
+def test_server_errors(model_path, tmp_path):
+
+    inference = server(model_path)
+    try:
+        with pytest.raises(ValueError):
+            inference.submit({'rmin': 60, 'rmax': 80})
+
+        id = inference.submit({'experiment_dir': str(tmp_path), 'rmin': 60, 'rmax': 80})
+        for _ in range(100):
+            if inference.get_status(id)['state'] == 'failed':
+                break
+            time.sleep(0.05)
+        assert inference.get_status(id)['state'] == 'failed'
+        assert 'no images' in inference.get_status(id)['error']
+    finally:
+        inference.close()
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+
+from sharding import get_shard_range, merge_shards, write_shard
+
+@pytest.mark.parametrize('total_frames, shard_count', [(10, 1), (10, 3), (1400, 7), (2, 4)])
+def test_get_shard_range(total_frames, shard_count):
+
+    ranges = [get_shard_range(total_frames, i, shard_count) for i in range(shard_count)]
+    frames = [frame for first, last in ranges for frame in range(first, last + 1)]
+
+    assert frames == list(range(1, total_frames + 1))
+    assert max(last - first for first, last in ranges) - min(last - first for first, last in ranges) <= 1
+
+def test_merge_shards(tmp_path, make_predictions):
+
+    # shards finishing in any order are stitched by frame
+    for frame_range in [(5, 7), (1, 2), (3, 4)]:
+        write_shard(make_predictions(list(range(frame_range[0], frame_range[1] + 1))), str(tmp_path), frame_range, 'model', 'wells')
+
+    predictions = merge_shards(str(tmp_path), 7)
+    expected = pd.concat([make_predictions([1, 2]), make_predictions([3, 4]), make_predictions([5, 6, 7])])
+
+    pd.testing.assert_frame_equal(predictions, expected.rename_axis(['frame', 'X-coord', 'Y-coord']))
+
+    # missing frames at the end
+    with pytest.raises(ValueError):
+        merge_shards(str(tmp_path), 8)
+
+def test_merge_shards_mismatch(tmp_path, make_predictions):
+
+    write_shard(make_predictions([1, 2]), str(tmp_path), (1, 2), 'model', 'wells')
+    write_shard(make_predictions([3, 4]), str(tmp_path), (3, 4), 'other model', 'wells')
+
+    with pytest.raises(ValueError):
+        merge_shards(str(tmp_path), 4)
+
+    write_shard(make_predictions([2, 3, 4]), str(tmp_path), (2, 4), 'model', 'wells')
+    os.remove(os.path.join(str(tmp_path), 'predictions_000003_000004.json'))
+
+    # frame 2 is predicted by two shards
+    with pytest.raises(ValueError):
+        merge_shards(str(tmp_path), 4)
@@ -0,0 +1,104 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+
+import storage
+from storage import checkpoint, get_sequence_hash, get_wells_hash, prediction_cache, read_wells, write_wells
+
+def get_wells(radius = 76.0):
+
+    index = pd.MultiIndex.from_tuples([(x, y) for x in [0.0, 1.0] for y in [0.0, 1.0]], names = ['well_id_x', 'well_id_y'])
+    return pd.DataFrame({'center_x': [100.0, 100.0, 300.0, 300.0], 'center_y': [100.0, 300.0, 100.0, 300.0],
+                         'radius': radius}, index = index)
+
+def test_checkpoint(tmp_path, make_predictions):
+
+    saved = checkpoint(str(tmp_path), 'model', get_wells_hash(get_wells()))
+    saved.clear()
+    saved.write(make_predictions([1, 2]))
+    saved.write(make_predictions([3]))
+
+    predictions = checkpoint(str(tmp_path), 'model', get_wells_hash(get_wells())).load()
+    expected = pd.concat([make_predictions([1, 2]), make_predictions([3])]).rename_axis(['frame', 'X-coord', 'Y-coord'])
+
+    pd.testing.assert_frame_equal(predictions, expected)
+
+    # parts of another model or well layout are never reused
+    assert checkpoint(str(tmp_path), 'other model', get_wells_hash(get_wells())).load() is None
+    assert checkpoint(str(tmp_path), 'model', get_wells_hash(get_wells(radius = 80.0))).load() is None
+
+def test_checkpoint_numbering(tmp_path, make_predictions):
+
+    saved = checkpoint(str(tmp_path), 'model', 'wells')
+    saved.clear()
+    for frame in range(1, 4):
+        saved.write(make_predictions([frame]))
+    os.remove(str(tmp_path / 'part-00001.parquet'))
+
+    resumed = checkpoint(str(tmp_path), 'model', 'wells')
+    assert sorted(resumed.load().index.get_level_values(0).unique()) == [1, 3]
+
+    resumed.write(make_predictions([2]))
+    assert sorted(os.listdir(str(tmp_path))) == ['manifest.json', 'part-00000.parquet', 'part-00002.parquet', 'part-00003.parquet']
+
+def test_wells(tmp_path):
+
+    wells = get_wells()
+    write_wells(wells, str(tmp_path / 'wells.csv'))
+
+    pd.testing.assert_frame_equal(read_wells(str(tmp_path / 'wells.csv')), wells, check_exact = True)
+
+def test_prediction_cache(tmp_path, make_predictions):
+
+    images = []
+    for i in range(3):
+        images.append(str(tmp_path / 'IMG_{:04d}.JPG'.format(i)))
+        with open(images[-1], 'wb') as f:
+            f.write(bytes([i]) * 100)
+    frames_hash = get_sequence_hash(images)
+
+    cache = prediction_cache(str(tmp_path / 'predictions'))
+    assert cache.load('model', frames_hash) == (None, None)
+
+    cache.save(make_predictions([1, 2]), get_wells(), 'model', frames_hash)
+    predictions, wells = cache.load('model', frames_hash, get_wells_hash(get_wells()))
+
+    pd.testing.assert_frame_equal(predictions, make_predictions([1, 2]).rename_axis(['frame', 'X-coord', 'Y-coord']))
+    pd.testing.assert_frame_equal(wells, get_wells())
+    assert cache.load(None, frames_hash)[0] is not None
+
+    # predictions of another model, layout or images are never reused
+    assert cache.load('other model', frames_hash) == (None, None)
+    assert cache.load('model', frames_hash, get_wells_hash(get_wells(radius = 80.0))) == (None, None)
+    with open(images[1], 'wb') as f:
+        f.write(bytes([7]) * 100)
+    assert cache.load('model', get_sequence_hash(images)) == (None, None)
+
+def test_frames_hash(tmp_path, monkeypatch):
+
+    images = []
+    for i in range(3):
+        images.append(str(tmp_path / 'IMG_{:04d}.JPG'.format(i)))
+        with open(images[-1], 'wb') as f:
+            f.write(bytes([i]) * 100)
+
+    cache = prediction_cache(str(tmp_path / 'predictions'))
+    assert cache.get_frames_hash(images) == get_sequence_hash(images)
+
+    # unchanged images are not read again
+    hashed = []
+    get_file_hash = storage.get_file_hash
+    monkeypatch.setattr(storage, 'get_file_hash', lambda filename: hashed.append(filename) or get_file_hash(filename))
+    frames_hash = cache.get_frames_hash(images)
+    assert hashed == []
+    assert frames_hash == get_sequence_hash(images)
+
+    hashed.clear()
+    with open(images[1], 'wb') as f:
+        f.write(bytes([7]) * 120)
+    frames_hash = cache.get_frames_hash(images)
+    assert hashed == [images[1]]
+    assert frames_hash == get_sequence_hash(images)
@@ -0,0 +1,168 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), '../src'))
+
+from read_data import Data
+from video_analysis import analysis, label_wells
+
+def get_plate(rows = 8, columns = 12, radius = 70, pitch = 180, margin = 100):
+    '''
+        Synthetic image of a multi well plate
+    '''
+    image = np.full((2*margin + pitch*(rows - 1), 2*margin + pitch*(columns - 1), 3), 30, dtype = np.uint8)
+    for row in range(rows):
+        for column in range(columns):
+            cv2.circle(image, (margin + pitch*column, margin + pitch*row), radius, (200, 200, 200), 4, cv2.LINE_AA)
+
+    return image
+
+@pytest.fixture(scope = 'module')
+def images(tmp_path_factory):
+
+    folder = tmp_path_factory.mktemp('images')
+    for i in range(1, 4):
+        cv2.imwrite(str(folder / 'IMG_{:04d}.JPG'.format(i)), get_plate())
+
+    return str(folder / 'IMG_%04d.JPG')
+
+def test_crop_wells(images):
+
+    experiment = analysis(Data(images))
+    wells = experiment.detect_wells(R = [60, 80])
+    image = cv2.imread(images % 1)
+
+    well_ind, cropped_wells = experiment.crop_wells(wells, image)
+
+    assert well_ind == wells.index.values.tolist()
+    assert cropped_wells.shape == (96, 138, 138, 3)
+    assert cropped_wells.dtype == np.uint8
+
+    for i, well in enumerate(well_ind):
+        xc, yc, r = wells.loc[well]
+        assert (cropped_wells[i] == image[int(yc)-int(r):int(yc)+int(r), int(xc)-int(r):int(xc)+int(r), :]).all()
+
+    buffer = experiment.get_crop_buffer(wells, frames = 2)
+    _, cropped = experiment.crop_wells(wells, image, out = buffer[1])
+
+    assert np.shares_memory(cropped, buffer)
+    assert (buffer[1] == cropped_wells).all()
+
+@pytest.mark.parametrize('rows, columns', [(8, 12), (16, 24), (32, 48)])
+def test_label_wells(rows, columns):
+
+    rng = np.random.default_rng(rows)
+    pitch, angle = 60.0, np.deg2rad(0.5)
+    column, row = [index.ravel() for index in np.meshgrid(np.arange(columns), np.arange(rows), indexing = 'ij')]
+    x = 50 + pitch * (column * np.cos(angle) - row * np.sin(angle)) + rng.normal(0, 0.5, column.size)
+    y = 40 + pitch * (column * np.sin(angle) + row * np.cos(angle)) + rng.normal(0, 0.5, column.size)
+    circles = np.column_stack([x, y, rng.uniform(22.2, 22.8, column.size)])
+
+    # missed wells, a whole missed column and a spurious circle between wells
+    detected = np.ones(column.size, dtype = bool)
+    detected[rng.choice(column.size, 10, replace = False)] = False
+    detected[column == 1] = False
+    shuffled = rng.permutation(np.concatenate([circles[detected], [[50 + 1.5 * pitch, 40 + 1.5 * pitch, 23]]]))
+
+    wells = label_wells(shuffled)
+
+    assert len(wells) == rows * columns
+    assert wells.index.tolist() == list(zip(column.astype(float), row.astype(float)))
+    assert np.abs(wells['center_x'] - x).max() < 3
+    assert np.abs(wells['center_y'] - y).max() < 3
+    assert (wells['radius'] == 23).all()
+
+    unfilled = label_wells(shuffled, fill_missing = False)
+    assert len(unfilled) == detected.sum()
+    assert (unfilled[['center_x', 'center_y']].to_numpy() == wells.loc[unfilled.index, ['center_x', 'center_y']].to_numpy()).all()
+
+def read_video(filename):
+
+    video = cv2.VideoCapture(filename)
+    frames = []
+    while True:
+        ret, frame = video.read()
+        if not ret:
+            return frames
+        frames.append(frame)
+
+def test_crop_to_video(images, tmp_path):
+
+    experiment = analysis(Data(images))
+    wells = experiment.detect_wells(R = [60, 80])
+
+    filenames = experiment.crop_to_video(wells, crop_dir = str(tmp_path / 'all'), no_wells_to_record = None, workers = 3)
+    reference = experiment.crop_to_video(wells, crop_dir = str(tmp_path / 'single'), wells_to_record = [(0, 0), (11, 7)])
+
+    assert len(filenames) == 96
+    assert reference == [str(tmp_path / 'single' / '00_00.avi'), str(tmp_path / 'single' / '11_07.avi')]
+    for filename in reference:
+        frames = read_video(filename)
+        expected = read_video(filename.replace('single', 'all'))
+
+        assert len(frames) == len(expected) == 3
+        assert frames[0].shape == (138, 138, 3)
+        for frame, expected_frame in zip(frames, expected):
+            assert (frame == expected_frame).all()
+
+    with pytest.raises(ValueError):
+        experiment.crop_to_video(wells, crop_dir = str(tmp_path / 'single'), wells_to_record = [(12, 0)])
+
+@pytest.mark.parametrize('scale', [2, 4, 8])
+def test_detect_wells_reduced(images, scale):
+
+    experiment = analysis(Data(images))
+    reference = experiment.detect_wells(R = [60, 80]).sort_index()
+    wells = experiment.detect_wells(R = [60, 80], scale = scale).sort_index()
+
+    assert (wells.index == reference.index).all()
+    assert np.abs(wells[['center_x', 'center_y']] - reference[['center_x', 'center_y']]).max().max() <= scale/2 + 3
+    assert np.abs(wells['radius'] - reference['radius']).max() <= scale + 0.05 * reference['radius'].max()
+
+def test_load_or_detect_wells_incomplete(tmp_path):
+
+    cache_dir = str(tmp_path / 'cache')
+    experiment = analysis(Data(str(tmp_path / 'IMG_%04d.JPG')))
+
+    # nothing is stored when no well is found
+    blank = np.full_like(get_plate(), 30)
+    assert experiment.load_or_detect_wells([60, 80], cache_dir, image = blank) is None
+    assert not os.path.exists(cache_dir) or os.listdir(cache_dir) == []
+
+    # an entry without its layout, eg. of an interrupted run, is replaced
+    wells = experiment.load_or_detect_wells([60, 80], cache_dir, image = get_plate())
+    entry, = os.listdir(cache_dir)
+    os.remove(os.path.join(cache_dir, entry, 'wells.csv'))
+
+    assert experiment.load_or_detect_wells([60, 80], cache_dir, image = get_plate()).equals(wells)
+    assert os.listdir(cache_dir) == [entry]
+    assert sorted(os.listdir(os.path.join(cache_dir, entry))) == ['thumbnail.png', 'wells.csv']
+
+def test_load_or_detect_wells(tmp_path):
+
+    cache_dir = str(tmp_path / 'cache')
+    # uneven lighting, as on a real rig
+    plate = get_plate()
+    height, width = plate.shape[:2]
+    lighting = 0.8 + 0.4 * np.outer(np.linspace(1, 0.5, height), np.linspace(0, 1, width))
+    plate = (plate * lighting[..., np.newaxis]).astype(np.uint8)
+    experiment = analysis(Data(str(tmp_path / 'IMG_%04d.JPG')))
+
+    wells = experiment.load_or_detect_wells([60, 80], cache_dir, image = plate)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # the same plate with some noise reuses the stored layout
+    noisy = np.clip(plate + np.random.default_rng(0).normal(0, 2, plate.shape), 0, 255).astype(np.uint8)
+    cached = experiment.load_or_detect_wells([60, 80], cache_dir, image = noisy)
+    assert cached.equals(wells)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # a plate that moved is detected again
+    moved = np.roll(plate, (12, -20), axis = (0, 1))
+    shifted = experiment.load_or_detect_wells([60, 80], cache_dir, image = moved)
+    assert np.abs(shifted['center_x'].mean() - wells['center_x'].mean() + 20) < 2
+    assert np.abs(shifted['center_y'].mean() - wells['center_y'].mean() - 12) < 2